@@ -0,0 +1,21 @@
+"""
+    EventCalendarICal.py
+
+    This action serves the events of the EventCalendar macro as an icalendar
+    feed, e.g. http://example.org/CalendarPage?action=EventCalendarICal&category=CategoryEventCalendar
+
+    Only the categories shown by the macro on the page are served.
+
+    The feed is built by the macro itself, so the macro must be installed as
+    'EventCalendar' (set MACRO_NAME below if you installed it under another name).
+
+    @license: GPL
+"""
+from MoinMoin import wikiutil
+
+MACRO_NAME = 'EventCalendar'
+
+
+def execute(pagename, request):
+    streamical = wikiutil.importPlugin(request.cfg, 'macro', MACRO_NAME, 'streamical')
+    streamical(pagename, request)
@@ -0,0 +1,25 @@
+"""
+    EventCalendarRebuild.py
+
+    This action brings the events of an EventCalendar category up to date,
+    e.g. from cron: http://example.org/CalendarPage?action=EventCalendarRebuild&category=CategoryEventCalendar
+
+    Only the categories shown by the macro on the page are rebuilt.
+
+    It is meant for wikis whose calendar views may use stale events for a
+    while (Globs.stale_maxage in the macro), so that no page view waits for
+    a rebuild.
+
+    The rebuild is done by the macro itself, so the macro must be installed as
+    'EventCalendar' (set MACRO_NAME below if you installed it under another name).
+
+    @license: GPL
+"""
+from MoinMoin import wikiutil
+
+MACRO_NAME = 'EventCalendar'
+
+
+def execute(pagename, request):
+    rebuildevents = wikiutil.importPlugin(request.cfg, 'macro', MACRO_NAME, 'rebuildevents')
+    rebuildevents(pagename, request)
@@ -0,0 +1,79 @@
+"""
+    Benchmark of the EventCalendar event page parser.
+
+    It builds a synthetic event page with thousands of event headings and
+    reports the cost per parsed event of getEventRecordFromPage().
+
+    Usage: python benchmark_parser.py [number of events ...]
+
+    The macro imports MoinMoin, so run it with MoinMoin (and its dependencies)
+    on the python path.
+"""
+import imp, os, sys, time
+
+MACRO_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'macro', 'EventCalendar-099b.py')
+
+DEFAULT_SIZES = [500, 1000, 2000, 4000]
+
+EVENT_TEMPLATES = [
+    u'=== Meeting %(num)d ===\n start:: 2018-%(month)02d-%(day)02d 10:00\n end:: 2018-%(month)02d-%(day)02d 11:30\n description:: meeting number %(num)d\n label:: Meeting\n\n',
+    u'=== Trip %(num)d ===\n start:: %(monthname)s %(day)d, 2018\n end:: 2018/%(month)02d/%(endday)02d\n bgcolor:: #aabbcc\n\n',
+    u'=== Weekly %(num)d ===\n start:: 18%(month)02d%(day)02d 7:00pm\n end:: 21:00\n recur:: 1 week until 2019-12-31\n\n',
+    ]
+
+MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December')
+
+
+class BenchRequest:
+    """ the parser only needs a request to count heading ids """
+    pass
+
+
+def makepage(numevents):
+    page = [u' default_bgcolor:: #c0c0c0\n default_description:: synthetic event\n label_def:: Meeting, #00ff00\n\n']
+
+    for num in range(numevents):
+        month = num % 12 + 1
+        day = num % 27 + 1
+        values = {'num': num, 'month': month, 'day': day, 'endday': day + 1, 'monthname': MONTHS[month - 1]}
+        page.append(EVENT_TEMPLATES[num % len(EVENT_TEMPLATES)] % values)
+
+    page.append(u'----\nCategoryEventCalendar\n')
+
+    return u''.join(page)
+
+
+def bench(macro, numevents, repeat=3):
+    pagecontent = makepage(numevents)
+    best = None
+
+    for run in range(repeat):
+        macro.Globs.request = BenchRequest()
+        macro.Globs.errormsg = ''
+
+        starttime = time.time()
+        eventrecords, labelrecords = macro.getEventRecordFromPage(pagecontent, u'BenchmarkPage')
+        elapsed = time.time() - starttime
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    assert len(eventrecords) == numevents, macro.Globs.errormsg
+
+    return best
+
+
+def main(args):
+    sizes = [int(arg) for arg in args] or DEFAULT_SIZES
+
+    macro = imp.load_source('EventCalendar', MACRO_FILE)
+    macro.Globs.months = MONTHS
+
+    print '%8s %12s %16s' % ('events', 'total (s)', 'per event (us)')
+    for numevents in sizes:
+        elapsed = bench(macro, numevents)
+        print '%8d %12.3f %16.1f' % (numevents, elapsed, elapsed * 1000000.0 / numevents)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
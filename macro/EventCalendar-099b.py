@@ -144,6 +144,10 @@ CategoryEventCalendar
 
         * It caches all the page list of the specified category and the event information.
         * If you added/removed a page into/from a category, you need to do 'Delete cache' in the macro page.
+        * Recurrences are cached per month. Month caches unused for Globs.rangecache_ttl days are swept,
+          and at most Globs.rangecache_maxentries (Globs.rangecache_maxbytes) of them are kept, the least recently used going first.
+        * The html of the views is cached until the events change (Globs.viewcache); these caches are swept with the month caches,
+          but at most Globs.viewcache_maxentries (Globs.viewcache_maxbytes) of them are kept, so that they do not push out the month caches.
 
         * 'MonthCalendar.py' developed by Thomas Waldmann <ThomasWaldmann@gmx.de> has inspired this macro.
         * Much buggy.. : please report bugs and suggest your ideas.
@@ -154,10 +158,12 @@ CategoryEventCalendar
 from MoinMoin import wikiutil, config, search, caching
 from MoinMoin.Page import Page
 from MoinMoin.action import AttachFile
-from dateutil import parser
-import re, calendar, time, datetime
+from MoinMoin.logfile import editlog
+from MoinMoin.util import timefuncs, lock
+from dateutil import parser, rrule
+import re, calendar, time, datetime, bisect, heapq
 import codecs, os, urllib, sha
-import tempfile
+import tempfile, threading
 import icalendar
 
 try:
@@ -168,6 +174,29 @@ except ImportError:
 # Set pickle protocol, see http://docs.python.org/lib/node64.html
 PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
 
+# icalendar properties of the exported calendar
+ICAL_PRODID = '-//moinmo.in//EventCalendar/'
+ICAL_VERSION = '1.0'
+
+# version of the event store, to be raised when the format of its caches changes
+EVENTSTORE_VERSION = 2
+
+# version of the event page parser, to be raised when the records it makes change
+PARSER_VERSION = 1
+
+# first word of the header line of the caches, followed by the versions of the
+# event store and of the parser, and by the change generation of the sources
+CACHE_MAGIC = 'EventCalendar'
+
+# cache keys of the recurrences per month and of the html of the views, and
+# of the caches which the former versions kept with the macro page
+RANGECACHE_KEY = re.compile(r'^(recurrences_\d{6}(_lastweekday)?|view_[0-9a-f]{40})$')
+LEGACY_CACHE_KEY = re.compile(r'^((events|eventindex|calevents)_\d*-\d*|recurrences_\d{6}(_lastweekday)?|events|labels|eventpages|eventcalerrormsglist|eventsgeneration)$')
+
+# calls of the macro in the wiki text of a page, with their arguments (the
+# macro is called by the name it is installed under)
+MACRO_CALL = re.compile(r'(?:<<|\[\[)%s(?:\((.*?)\))?(?:>>|\]\])' % re.escape(__name__.split('.')[-1]))
+
 
 # The following line sets the calendar to have either Sunday or Monday as
 # the first day of the week. Only SUNDAY or MONDAY (case sensitive) are
@@ -199,6 +228,23 @@ class Globs:
     form_vals = {}
     events = None
     labels = None
+    rawevents = None   # events and labels of the event store, validated once per request (see getrawevents())
+    rawlabels = None
+    eventversion = 0
+    icalaction = 'EventCalendarICal'   # name of the action serving the icalendar feed
+    rangecache_maxentries = 120   # month caches of recurrences kept per category, for all its calendar pages
+    rangecache_maxbytes = 4194304   # bytes
+    viewcache_maxentries = 240   # view caches kept per category, apart from the month caches
+    viewcache_maxbytes = 8388608   # bytes
+    rangecache_ttl = 30   # days since the last use
+    memcache_maxentries = 64   # unpickled cache entries kept in memory by the process
+    recordcache_revisions = 3   # parsed revisions kept per event page
+    parse_processes = 0   # processes parsing the event pages on rebuilds, 0: none (the request parses them)
+    parse_minpages = 8   # pages to parse at least, for starting the processes
+    rebuild_wait = 5   # seconds to wait for the rebuild of the events by another request
+    rebuild_locktimeout = 120   # seconds after which the lock of a rebuild is considered stale
+    stale_maxage = 0   # seconds for which views may use events older than the pages, 0: never
+    viewcache = 1   # caches the html of the views until the events change, 0: never
 
 
 class Params:
@@ -228,1452 +274,2699 @@ class EventcalError(Exception):
         return repr(self.value)
 
 
-def execute(macro, args):
-
-    request = macro.request
-    formatter = macro.formatter
-
-    # INITIALIZATION ----------------------------------------
-    setglobalvalues(macro)
-    getparams(args)
-
-    # allowed actions
-    allowed_action = ['monthly',
-                      'list',
-                      'simple',
-                      'upcoming',
-                      'daily',
-                      'weekly']
-    default_action = Params.firstview
-
-    # Internal variables
-    cal_action = ''
-    form_vals = {}
-
-    create_ical_from_events()
-
-    # PROCESSING ARGUEMENTS ----------------------------------------
-    if args:
-        args=request.getText(args)
-
-    for item in macro.request.values.items():
-         if not form_vals.has_key(item[0]):
-            try:
-                   form_vals[item[0]]=item[1]
-            except AttributeError:
-                pass
-
-    # PROCESSING ACTIONS ----------------------------------------
-    cal_action = form_vals.get('calaction', default_action)
-    page_action = form_vals.get('action', 'show')
-
-    if not cal_action in allowed_action:
-        cal_action = default_action
-
-    form_vals['calaction'] = cal_action
-
-    Globs.form_vals = form_vals
-
-    # CONTROL FUNCTIONS ----------------------------------------
-
-    html = []
-    html_result = ''
-
-    Globs.cal_action = cal_action
-    Globs.page_action = page_action
+class EventPageParser:
+    """ Regular expressions of the event data format, compiled once at import
 
+    getEventRecordFromPage() and geteventfield() used to compile these on every
+    call, i.e. once per page and once per event heading.
+    """
 
-    # redirect to the appropriate view
-    if cal_action == 'monthly':
-        html_result = showcalendar()
-
-    if cal_action == 'list':
-        html_result = showeventlist()
+    flags = re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE
 
-    if cal_action == 'simple':
-        html_result = showsimplecalendar()
+    # page defaults and label definitions
+    regex_page_bgcolor = r"""
+(?P<req_field>^[ ]+default_bgcolor::[ ]+)
+(
+    (?P<pagebgcolor>\#[0-9a-fA-F]{6})
+    \s*?
+    $
+)?
+"""
 
-    if cal_action == 'upcoming':
-        html_result = showupcomingeventlist()
+    regex_page_description = r"""
+(?P<req_field>^[ ]+default_description::[ ]+)
+(
+    (?P<pagedescription>.*?)
+    \s*?
+    $
+)?
+"""
 
-    if cal_action == 'daily':
-        html_result = showdailycalendar()
+    regex_label_definition = r"""
+(?P<reqfield>^[ ]+label_def::[ ]+)
+(
+	(?P<name>[^,^:^\s]+?)
+	[,: ]+
+	(?P<bgcolor>\#[0-9a-fA-F]{6})
+	\s*?
+	$
+)?
+"""
 
-    if cal_action == 'weekly':
-        html_result = showweeklycalendar()
+    # event heading: the detail of an event runs up to the next heading
+    regex_heading = r"""
+^\s*(?P<hmarker>=+)\s(?P<eventtitle>.*?)\s(?P=hmarker) $
+"""
 
-    if cal_action == 'ical':
-        create_ical_from_events()
+    # a line holding one of the fields below; only its prefix is checked here
+    regex_fieldline = r"""
+^[ ]+
+(?P<field>default_bgcolor|default_description|label_def|start|end|bgcolor|description|recur|label)
+::(?=[ ])
+"""
 
-    # format output
-    html.append( html_result )
-    html.append( showmenubar() )
+    # fields of an event
 
-    if Params.showerror and Globs.errormsg:
-        html.append(u'<p><i><font size="2" color="#aa0000"><ol>%s</ol></font></i>' % Globs.errormsg)
+    # START DATE REGEX ----------------------------
+    regex_startdate = r"""
+(?P<reqfield>^[ ]+start::(?=[ ]+))
+(
+    (?P<startdate>
+        [ ]+
+        (
+            (?P<startdate1>
+            	(?P<startyear1>19\d{2} | 20\d{2} | \d{2} )
+            	[./-]
+            	(?P<startmonth1>1[012] | 0[1-9] | [1-9])
+            	[./-]
+            	(?P<startday1>3[01] | 0[1-9] | [12]\d | [1-9])
+            )
+            |
+            (?P<startdate2>
+            	(?P<startmonth2>january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug|september|sep|october|oct|november|nov|december|dec)
+            	[ ]+
+            	(?P<startday2>3[01] | 0[1-9] | [12]\d | [1-9])
+            	(?: st | nd | rd | th )?
+            	[ ,]+
+            	(?P<startyear2>19\d{2} | 20\d{2} | \d{2})
+            )
+            |
+            (?P<startdate3>
+            	(?P<startyear3>19\d{2} | 20\d{2} | \d{2} )
+            	(?P<startmonth3>1[012] | 0[1-9])
+            	(?P<startday3>3[01] | 0[1-9] | [12]\d)
+            )
+        )
+    )
+    (?P<starttime>
+        [ ,]+
+        (
+            (?P<starttime1>
+            	(?P<starthour1> 1[0-2] | [0]?[1-9] )
+            	(
+            		(?: [.:])
+            		(?P<startminute1>[0-5]\d{0,1} | [6-9])
+            	)?
+            	[ ]*
+            	(?P<am1> am | pm | p | a )
+            )
+            |
+            (?P<starttime2>
+            	(?P<starthour2> | [01]\d{0,1} | 2[0-3] | [1-9])
+            	(
+            		(?: [.:])
+            		(?P<startminute2>[0-5]\d{0,1} | [6-9])
+            	)?
+            )
+            |
+            (?P<starttime3>
+            	(?P<starthour3> [01]\d | 2[0-3])
+            	(?P<startminute3> [0-5]\d)?
+            )
+            |
+            (?P<starttime4>
+            	(?P<starthour4> 0[1-9] | 1[0-2])
+            	(?P<startminute4> [0-5]\d)?
+            	[ ]*
+            	(?P<am4> am | pm | p | a )
+            )
+        )
+    )?
+    \s*?
+    $
+)?
+"""
 
-    if Params.debug and Globs.debugmsg:
-        html.append(u'<p><b>Debug messages:</b><font color="#000099"><ol>%s</ol></font>' % Globs.debugmsg)
+    # END DATE REGEX ----------------------------
+    regex_enddate = r"""
+(?P<reqfield>^[ ]+end::(?=[ ]+))
+(
+    (?P<enddate>
+        [ ]+
+        (
+            (?P<enddate1>
+            	(?P<endyear1>19\d{2} | 20\d{2} | \d{2} )
+            	[./-]
+            	(?P<endmonth1>1[012] | 0[1-9] | [1-9])
+            	[./-]
+            	(?P<endday1>3[01] | 0[1-9] | [12]\d | [1-9])
+            )
+            |
+            (?P<enddate2>
+            	(?P<endmonth2>january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug|september|sep|october|oct|november|nov|december|dec)
+            	[ ]+
+            	(?P<endday2>3[01] | 0[1-9] | [12]\d | [1-9])
+            	(?: st | nd | rd | th )?
+            	[ ,]+
+            	(?P<endyear2>19\d{2} | 20\d{2} | \d{2})
+            )
+            |
+            (?P<enddate3>
+            	(?P<endyear3>19\d{2} | 20\d{2} | \d{2} )
+            	(?P<endmonth3>1[012] | 0[1-9])
+            	(?P<endday3>3[01] | 0[1-9] | [12]\d)
+            )
+        )
+    )?
+    (?P<endtime>
+        [ ,]+
+        (
+            (?P<endtime1>
+            	(?P<endhour1> 1[0-2] | [0]?[1-9] )
+            	(
+            		(?: [.:])
+            		(?P<endminute1>[0-5]\d{0,1} | [6-9])
+            	)?
+            	[ ]*
+            	(?P<am1> am | pm | p | a )
+            )
+            |
+            (?P<endtime2>
+            	(?P<endhour2> | [01]\d{0,1} | 2[0-3] | [1-9])
+            	(
+            		(?: [.:])
+            		(?P<endminute2>[0-5]\d{0,1} | [6-9])
+            	)?
+            )
+            |
+            (?P<endtime3>
+            	(?P<endhour3> [01]\d | 2[0-3])
+            	(?P<endminute3> [0-5]\d)?
+            )
+            |
+            (?P<endtime4>
+            	(?P<endhour4> 0[1-9] | 1[0-2])
+            	(?P<endminute4> [0-5]\d)?
+            	[ ]*
+            	(?P<am4> am | pm | p | a )
+            )
+        )
+    )?
+    \s*?
+    $
+)?
+"""
 
-    return formatter.rawHTML(u''.join(html))
+    regex_bgcolor = r"""
+(?P<reqfield>^[ ]+bgcolor::[ ]+)
+(
+    (?P<bgcolor>\#[0-9a-fA-F]{6})?
+    \s*?
+    $
+)?
+"""
 
+    regex_description = r"""
+(?P<reqfield>^[ ]+description::[ ]+)
+(
+    (?P<description>.*?)
+    \s*?
+    $
+)?
+"""
 
-def getparams(args):
-    """ process arguments """
+    regex_recur = r"""
+(?P<reqfield>^[ ]+recur::[ ]+)
+(
+    (?P<recur_freq>\d+|last)
+    \s+
+    (?P<recur_type>weekday|day|week|month|year)
+    (
+    	\s+
+    	(?P<recur_until_req>until)
+    	\s+
+    	(?P<recur_until>
+            (?P<enddate>
+                (?P<enddate1>
+                	(?P<endyear1>19\d{2} | 20\d{2} | \d{2} )
+                	[./-]
+                	(?P<endmonth1>1[012] | 0[1-9] | [1-9])
+                	[./-]
+                	(?P<endday1>3[01] | 0[1-9] | [12]\d | [1-9])
+                )
+                |
+                (?P<enddate2>
+                	(?P<endmonth2>january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug|september|sep|october|oct|november|nov|december|dec)
+                	\s+
+                	(?P<endday2>3[01] | 0[1-9] | [12]\d | [1-9])
+                	(?: st | nd | rd | th )?
+                	[\s,]+
+                	(?P<endyear2>19\d{2} | 20\d{2} | \d{2})
+                )
+                |
+                (?P<enddate3>
+                	(?P<endyear3>19\d{2} | 20\d{2} | \d{2} )
+                	(?P<endmonth3>1[012] | 0[1-9])
+                	(?P<endday3>3[01] | 0[1-9] | [12]\d)
+                )
+            )?
+        )?
+    )?
+    \s*?
+    $
+)?
+"""
+
+    regex_label = r"""
+(?P<reqfield>^[ ]+label::[ ]+)
+(
+	(?P<name>[^,^:^\s]+?)
+	\s*?
+	$
+)?
+"""
+
+    # need help on regular expressions for more efficient/flexible form
+
+    pattern_page_bgcolor = re.compile(regex_page_bgcolor, flags)
+    pattern_page_description = re.compile(regex_page_description, flags)
+    pattern_label_definition = re.compile(regex_label_definition, flags)
+    pattern_heading = re.compile(regex_heading, flags)
+    pattern_fieldline = re.compile(regex_fieldline, flags)
+    pattern_startdate = re.compile(regex_startdate, flags)
+    pattern_enddate = re.compile(regex_enddate, flags)
+    pattern_bgcolor = re.compile(regex_bgcolor, flags)
+    pattern_description = re.compile(regex_description, flags)
+    pattern_recur = re.compile(regex_recur, flags)
+    pattern_label = re.compile(regex_label, flags)
+
+
+class EventRecord(object):
+    """ An event read from a wiki page
+
+    Dates are proleptic ordinals (startday, endday, untilday) and times are
+    minutes of the day (startminute, endminute, None if not given), so the
+    loader and the views compare and subtract them without parsing strings.
+    It still reads like the old event dict, e.g. event['startdate'] gives
+    '20051004' and event['starttime'] '1700', for the code formatting them.
+
+    Records are pickled as tuples (see pack()), never as instances.
+    """
+
+    __slots__ = ('id', 'title', 'refer', 'hid', 'bgcolor', 'label', 'description',
+                 'startday', 'startminute', 'endday', 'endminute',
+                 'recur_freq', 'recur_type', 'untilday', 'date_len', 'time_len')
+
+    clone = 0
+
+    # label and refer strings are shared by many events
+    interned = {}
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+        self.refer = self.interned.setdefault(self.refer, self.refer)
+        self.label = self.interned.setdefault(self.label, self.label)
+
+    def pack(self):
+        return tuple([getattr(self, name) for name in self.__slots__])
+
+    def unpack(packed):
+        return EventRecord(*packed)
+    unpack = staticmethod(unpack)
+
+    def __getitem__(self, key):
+        if key == 'startdate':
+            return formatdateordinal(self.startday)
+        elif key == 'enddate':
+            return formatdateordinal(self.endday)
+        elif key == 'starttime':
+            return formatminute(self.startminute)
+        elif key == 'endtime':
+            return formatminute(self.endminute)
+        elif key == 'recur_until':
+            if self.untilday:
+                return formatdateordinal(self.untilday)
+            return ''
+
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def has_key(self, key):
+        return key in ('startdate', 'enddate', 'starttime', 'endtime', 'recur_until', 'clone') or key in self.__slots__
+
+
+class EventOccurrence(object):
+    """ A recurrence of an event
+
+    It only holds its own id and days; the other fields (title, description,
+    bgcolor, ...) are read from the master EventRecord, so recurrences don't
+    copy the event. Like the record it reads like an event dict.
+    """
+
+    __slots__ = ('id', 'master', 'startday', 'endday')
+
+    clone = 1
+
+    def __init__(self, e_id, master, startday, endday):
+        self.id = e_id
+        self.master = master
+        self.startday = startday
+        self.endday = endday
+
+    def __getattr__(self, name):
+        # only called for the fields not held here
+        return getattr(self.master, name)
+
+    def __getitem__(self, key):
+        if key == 'id':
+            return self.id
+        elif key == 'startdate':
+            return formatdateordinal(self.startday)
+        elif key == 'enddate':
+            return formatdateordinal(self.endday)
+        elif key == 'clone':
+            return 1
+        else:
+            return self.master[key]
+
+    def has_key(self, key):
+        return self.master.has_key(key)
+
+
+class EventIndex:
+    """ Sorted interval index over the events of a date range
+
+    It answers "which events overlap this day/range" with a binary search over
+    the start dates instead of keeping a list of event ids for every single
+    day. Entries are (start, end, seq, e_id) with proleptic ordinals as start
+    and end, and seq the order the events were added in; results come back in
+    that order, which is what the views used to get from the per-day lists.
+    """
+
+    def __init__(self, entries=None):
+        self.entries = entries or []
+        self.build()
+
+    def build(self):
+        self.entries.sort()
+        self.starts = [entry[0] for entry in self.entries]
+
+        # no event is longer than this, so starts before (date - maxlen) can be skipped
+        self.maxlen = 0
+        for start, end, seq, e_id in self.entries:
+            self.maxlen = max(self.maxlen, end - start)
+
+    def add(self, e_id, startday, endday):
+        # call build() when done adding
+        self.entries.append((startday, endday, len(self.entries), e_id))
+
+    def overlapping(self, datefrom, dateto):
+        """ ids of the events overlapping [datefrom, dateto] ('20051004' format) """
+
+        ordfrom = getdateordinal(datefrom)
+        ordto = getdateordinal(dateto)
+
+        lo = bisect.bisect_left(self.starts, ordfrom - self.maxlen)
+        hi = bisect.bisect_right(self.starts, ordto)
+
+        found = [(seq, e_id) for start, end, seq, e_id in self.entries[lo:hi] if end >= ordfrom]
+        found.sort()
+
+        return [e_id for seq, e_id in found]
+
+    def eventsofday(self, cur_date):
+        """ ids of the events on cur_date, sorted by comp_cal_events """
+
+        day_events = self.overlapping(cur_date, cur_date)
+        day_events.sort(comp_cal_events)
+
+        return day_events
+
+    def daylists(self, dates):
+        """ working lists of event ids for the given dates, as the views consume them
+
+        Only the dates having events get an entry.
+        """
+
+        cal_events = {}
+
+        for cur_date in dates:
+            day_events = self.eventsofday(cur_date)
+            if day_events:
+                cal_events[cur_date] = day_events
+
+        return cal_events
+
+
+def execute(macro, args):
+
+    request = macro.request
+    formatter = macro.formatter
+
+    # INITIALIZATION ----------------------------------------
+    setglobalvalues(macro)
+    getparams(args)
+
+    # allowed actions
+    allowed_action = ['monthly',
+                      'list',
+                      'simple',
+                      'upcoming',
+                      'daily',
+                      'weekly']
+    default_action = Params.firstview
+
+    # Internal variables
+    cal_action = ''
+    form_vals = {}
+
+    # PROCESSING ARGUEMENTS ----------------------------------------
+    if args:
+        args=request.getText(args)
+
+    for item in macro.request.values.items():
+         if not form_vals.has_key(item[0]):
+            try:
+                   form_vals[item[0]]=item[1]
+            except AttributeError:
+                pass
+
+    # PROCESSING ACTIONS ----------------------------------------
+    cal_action = form_vals.get('calaction', default_action)
+    page_action = form_vals.get('action', 'show')
+
+    if not cal_action in allowed_action:
+        cal_action = default_action
+
+    form_vals['calaction'] = cal_action
+
+    Globs.form_vals = form_vals
+
+    # CONTROL FUNCTIONS ----------------------------------------
+
+    html = []
+    html_result = ''
+
+    Globs.cal_action = cal_action
+    Globs.page_action = page_action
+
+
+    events, labels = getrawevents()
+
+    # the events may have been rebuilt by another calendar page of the category
+    if formatter.page.exists() and icalneedsupdate():
+        create_ical_from_events(events)
+
+    # the same view of the same events is served from its cache
+    cache_view = getviewcache(args)
+    html_result = loadviewcache(cache_view)
+
+    if html_result is None:
+
+        # redirect to the appropriate view
+        if cal_action == 'monthly':
+            html_result = showcalendar()
+
+        if cal_action == 'list':
+            html_result = showeventlist()
+
+        if cal_action == 'simple':
+            html_result = showsimplecalendar()
+
+        if cal_action == 'upcoming':
+            html_result = showupcomingeventlist()
+
+        if cal_action == 'daily':
+            html_result = showdailycalendar()
+
+        if cal_action == 'weekly':
+            html_result = showweeklycalendar()
+
+        storeviewcache(cache_view, html_result)
+
+    # format output
+    html.append( html_result )
+    html.append( showmenubar() )
+
+    if Params.showerror and Globs.errormsg:
+        html.append(u'<p><i><font size="2" color="#aa0000"><ol>%s</ol></font></i>' % Globs.errormsg)
+
+    if Params.debug and Globs.debugmsg:
+        html.append(u'<p><b>Debug messages:</b><font color="#000099"><ol>%s</ol></font>' % Globs.debugmsg)
+
+    return formatter.rawHTML(u''.join(html))
+
+
+def getparams(args):
+    """ process arguments """
+
+    params = {}
+    if args:
+        # Arguments are comma delimited key=value pairs
+        sargs = args.split(',')
+
+        for item in sargs:
+            sitem = item.split('=')
+
+            if len(sitem) == 2:
+                key, value = sitem[0], sitem[1]
+                params[key.strip()] = value.strip()
+
+    # category name:
+    # default: 'CategoryEventCalendar'
+    Params.category = params.get('category', Globs.defaultcategory)
+
+    # menu bar: shows menubar or not (1: show, 0: no menubar)
+    # default: 1
+    try:
+        Params.menubar = int(params.get('menubar', 1))
+    except (TypeError, ValueError):
+        Params.menubar = 1
+
+    # calendar width in pixel or percent (monthly)
+    # default: 600px
+    Params.monthlywidth = params.get('monthlywidth', '600')
+    if Params.monthlywidth:
+        Params.monthlywidth = ' width="%s" ' % Params.monthlywidth
+
+    # calendar width in pixel or percent (weekly)
+    # default: 600px
+    Params.weeklywidth = params.get('weeklywidth', '600')
+    if Params.weeklywidth:
+        Params.weeklywidth = ' width="%s" ' % Params.weeklywidth
+
+    # calendar width in pixel or percent (daily)
+    # default: 600px
+    Params.dailywidth = params.get('dailywidth', '600')
+    if Params.monthlywidth:
+        Params.dailywidth = ' width="%s" ' % Params.dailywidth
+
+    # calendar width in pixel or percent (simply)
+    # default: 150px
+    Params.simplewidth = params.get('simplewidth', '150')
+    if Params.simplewidth:
+        # Params.simplewidth = Params.simplewidth.replace('%', '%%')
+        Params.simplewidth = ' width="%s" ' % Params.simplewidth
+
+    # calendar view: monthly, list, simple
+    # default: 'monthly'
+    Params.firstview = params.get('firstview', 'monthly')
+
+    # calendar date: in YYYYMM format (in monthly, simple view)
+    # default: current month
+    Params.curdate = params.get('curdate', '')
+
+    # upcoming range: # of days for upcoming event list
+    # default: 7
+    try:
+        Params.upcomingrange = int(params.get('upcomingrange', Globs.upcomingrange))
+    except (TypeError, ValueError):
+        Params.upcomingrange = Globs.upcomingrange
+
+    # number of calendar: # of calendar for monthly & simple view
+    # default: 1
+    try:
+        Params.numcal = int(params.get('numcal', '1'))
+    except (TypeError, ValueError):
+        Params.numcal = 1
+
+    # change view enabled?
+    # default: 1
+    try:
+        Params.changeview = int(params.get('changeview', '1'))
+    except (TypeError, ValueError):
+        Params.changeview = 1
+
+    # shows the event at the last weekday if the recurred weekday is not available.
+    # default: 0
+    try:
+        Params.showlastweekday = int(params.get('showlastweekday', '0'))
+    except (TypeError, ValueError):
+        Params.showlastweekday = 0
+
+    # show error message?
+    # default: 1
+    try:
+        Params.showerror = int(params.get('showerror', '1'))
+    except (TypeError, ValueError):
+        Params.showerror = 1
+
+    # show week number?
+    # default: 0
+    try:
+        Params.showweeknumber = int(params.get('showweeknumber', '0'))
+    except (TypeError, ValueError):
+        Params.showweeknumber = 0
+
+    # default bgcolor
+    Params.bgcolor = '#ddffdd'
+
+
+def setglobalvalues(macro):
+
+    request = macro.request
+    formatter = macro.formatter
+
+    Globs.formatter = formatter
+    setrequestvalues(request, formatter.page)
+
+
+def setrequestvalues(request, page):
+    """ set the global values which depend only on the request and the page """
+
+    # Useful variables
+    Globs.baseurl = request.getBaseURL() + '/'
+    Globs.pagename = page.page_name
+    Globs.request = request
+    Globs.pageurl = '%s/%s' % (request.getScriptname(), wikiutil.quoteWikinameURL(page.page_name))
+
+    # This fixes the subpages bug. subname is now used instead of pagename when creating certain urls
+    Globs.subname = Globs.pagename.split('/')[-1]
+
+    Globs.pagepath = page.getPagePath()
+
+    # european / US differences
+    months = ('January','February','March','April','May','June','July','August','September','October','November','December')
+
+    # Set things up for Monday or Sunday as the first day of the week
+    if calendar.firstweekday() == calendar.MONDAY:
+        wkend = 6
+        wkdays = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+    elif calendar.firstweekday() == calendar.SUNDAY:
+        wkend = 0
+        wkdays = ('Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat')
+
+    Globs.months = months
+    Globs.wkdays = wkdays
+    Globs.wkend = wkend
+
+    year, month, day, h, m, s, wd, yd, ds = request.user.getTime(time.time())
+    Globs.today = datetime.date(year, month, day)
+    Globs.now = datetime.time(h, m, s)
+
+    Globs.debugmsg = ''
+    Globs.errormsg = ''
+
+    Globs.rawevents = None
+    Globs.rawlabels = None
+
+
+def showReferPageParsed(event, targettext='title', showdesc=0):
+    request = Globs.request
+    pagename = Globs.pagename
+
+    refer = event['refer']
+    targettext = event[targettext]
+    startdate = event['startdate']
+    enddate = event['enddate']
+    description = event['description']
+    starttime = event['starttime']
+    endtime = event['endtime']
+    hid = event['hid']
+
+    refer_url = '%s/%s' % (request.getScriptname(), wikiutil.quoteWikinameURL(refer))
+
+    if not Params.changeview:
+        refer_url = ''
+        hid = ''
+
+    if showdesc:
+        if (startdate == enddate) and (starttime and endtime):
+            timedescription = '(%s:%s ~ %s:%s)' % (starttime[:2], starttime[2:], endtime[:2], endtime[2:])
+            if description:
+                timedescription = '%s ' % timedescription
+        else:
+            timedescription = ''
+
+        targetlink = '<a href="%s#%s" title="%s%s">%s</a>' % ( refer_url, hid, timedescription, wikiutil.escape(description), wikiutil.escape(targettext) )
+
+    else:
+        targetlink = '<a href="%s#%s">%s</a>' % ( refer_url, hid, wikiutil.escape(targettext))
+
+    return targetlink
+
+
+def showReferPageParsedForLabel(thelabel, targettext='name', showdesc=1):
+    request = Globs.request
+    pagename = Globs.pagename
+
+    labels = Globs.labels
+
+    label_bgcolor = ''
+    refer = ''
+
+    if labels and labels.has_key(thelabel):
+        targettext = labels[thelabel][targettext]
+        refer = labels[thelabel]['refer']
+        if showdesc:
+            label_bgcolor = labels[thelabel]['bgcolor']
+
+    if not refer:
+        return '<i>%s</i>' % thelabel
+
+    refer_url = '%s/%s' % (request.getScriptname(), wikiutil.quoteWikinameURL(refer))
+
+    if showdesc:
+        targetlink = '<a href="%s" title="%s">%s</a>' % ( refer_url, label_bgcolor, wikiutil.escape(targettext) )
+    else:
+        targetlink = '<a href="%s">%s</a>' % ( refer_url, wikiutil.escape(targettext))
+
+    return targetlink
+
+
+def getheadingid(request, referpage, title):
+
+    pntt = (referpage + title).encode(config.charset)
+    hid = "head-" + sha.new(pntt).hexdigest()
+
+    if not hasattr(request, '_eventcal_headings'):
+        request._eventcal_headings = {}
+
+    request._eventcal_headings.setdefault(pntt, 0)
+    request._eventcal_headings[pntt] += 1
+    if request._eventcal_headings[pntt] > 1:
+        hid += '-%d'%(request._eventcal_headings[pntt],)
+
+    return hid
+
+
+def getquerystring(req_fields):
+
+    m_query = []
+    tmp_form_vals = Globs.form_vals
+
+    # format querystring
+    # action should be poped out
+    for field in req_fields:
+        if tmp_form_vals.has_key(field):
+            m_query.append(u'%s=%s' % (field, tmp_form_vals[field]) )
+
+    if 'prevcalaction' in req_fields:
+        if not tmp_form_vals.has_key('prevcalaction'):
+            m_query.append(u'%s=%s' % ('prevcalaction', tmp_form_vals['calaction']) )
+
+    m_query = u'&'.join(m_query)
+
+    if m_query:
+        m_query = '&%s' % m_query
+
+    return m_query
+
+
+def showmenubar():
+    """ Bottom menu bar """
+
+    request = Globs.request
+    cal_action = Globs.cal_action
+    page_name = Globs.pagename
+
+    page_url = Globs.pageurl
+
+    if not Params.menubar: return ''
+
+    if cal_action == 'simple':
+        menuwidth = Params.simplewidth
+    elif cal_action == 'monthly':
+        menuwidth = Params.monthlywidth
+    else:
+        menuwidth = ''
+
+    left_menu_selected = []
+    right_menu_selected = []
+
+    # Go Today
+    year, month, day = gettodaydate()
+    mnu_curmonthcal = u'<a href="%s?calaction=%s&caldate=%d%02d%02d%s" title="Go Today">[Today]</a>' % (page_url, cal_action, year, month, day, getquerystring(['numcal']))
+
+    # List View
+    mnu_listview = u'<a href="%s?calaction=list%s" title="List of all events">[List]</a>' % (page_url, getquerystring(['caldate', 'numcal']))
+
+    # Monthly View
+    mnu_monthview = u'<a href="%s?calaction=monthly%s" title="Monthly view">[Monthly]</a>' % (page_url, getquerystring(['caldate', 'numcal']) )
+
+    # Simple Calendar View
+    mnu_simpleview = u'<a href="%s?calaction=simple%s" title="Simple calendar view">[Simple]</a>' % (page_url, getquerystring(['caldate', 'numcal']) )
+
+    # Upcoming Event List
+    mnu_upcomingview = u'<a href="%s?calaction=upcoming%s" title="Upcoming event list">[Upcoming]</a>' % (page_url, getquerystring(['caldate', 'numcal']) )
+
+    # Daily View
+    mnu_dayview = u'<a href="%s?calaction=daily%s" title="Daily view">[Daily]</a>' % (page_url, getquerystring(['caldate', 'numcal']) )
+
+    # Weekly View
+    mnu_weekview = u'<a href="%s?calaction=weekly%s" title="Weekly view">[Weekly]</a>' % (page_url, getquerystring(['caldate', 'numcal']) )
+
+    # iCalendar download
+    mnu_ical = u'<a href="%s?action=%s&category=%s" title="icalendar download">[ical]</a>' % (page_url, Globs.icalaction, wikiutil.url_quote_plus(Params.category))
+
+    html = [
+        u'\r\n',
+        u'<table class="eventcalendar_menubar" %s>',
+        u'  <tr>',
+        u'  <td class="eventcalendar_menubar" align="left">%s</td>',
+        u'  <td class="eventcalendar_menubar" align="right">%s</td>',
+        u'  </tr>',
+        u'</table>',
+        ]
+
+    if cal_action == 'list':
+        left_menu_selected.append(mnu_monthview)
+        left_menu_selected.append(mnu_weekview)
+        left_menu_selected.append(mnu_dayview)
+        left_menu_selected.append(mnu_simpleview)
+        left_menu_selected.append(mnu_ical)
+        right_menu_selected.append(mnu_upcomingview)
+
+    elif cal_action == 'simple':
+        left_menu_selected.append(mnu_monthview)
+        left_menu_selected.append(mnu_weekview)
+        left_menu_selected.append(mnu_dayview)
+        left_menu_selected.append(mnu_ical)
+        right_menu_selected.append(mnu_listview)
+        right_menu_selected.append(mnu_upcomingview)
+        right_menu_selected.append(mnu_curmonthcal)
+
+    elif cal_action == 'upcoming':
+        left_menu_selected.append(mnu_monthview)
+        left_menu_selected.append(mnu_weekview)
+        left_menu_selected.append(mnu_dayview)
+        left_menu_selected.append(mnu_simpleview)
+        left_menu_selected.append(mnu_ical)
+        right_menu_selected.append(mnu_listview)
+
+    elif cal_action == 'weekly':
+        left_menu_selected.append(mnu_monthview)
+        left_menu_selected.append(mnu_dayview)
+        left_menu_selected.append(mnu_simpleview)
+        left_menu_selected.append(mnu_ical)
+        right_menu_selected.append(mnu_upcomingview)
+        right_menu_selected.append(mnu_listview)
+        right_menu_selected.append(mnu_curmonthcal)
+
+    elif cal_action == 'daily':
+        left_menu_selected.append(mnu_monthview)
+        left_menu_selected.append(mnu_weekview)
+        left_menu_selected.append(mnu_simpleview)
+        left_menu_selected.append(mnu_ical)
+        right_menu_selected.append(mnu_upcomingview)
+        right_menu_selected.append(mnu_listview)
+        right_menu_selected.append(mnu_curmonthcal)
+
+    else:
+        left_menu_selected.append(mnu_weekview)
+        left_menu_selected.append(mnu_dayview)
+        left_menu_selected.append(mnu_simpleview)
+        left_menu_selected.append(mnu_ical)
+        right_menu_selected.append(mnu_upcomingview)
+        right_menu_selected.append(mnu_listview)
+        right_menu_selected.append(mnu_curmonthcal)
+
+    left_menu_selected = u'\r\n'.join(left_menu_selected)
+    right_menu_selected = u'\r\n'.join(right_menu_selected)
+
+    html = u'\r\n'.join(html)
+    html = html % (menuwidth, left_menu_selected, right_menu_selected)
+
+    return html
+
+
+def getdatefield(str_date):
+    str_year = ''
+    str_month = ''
+    str_day = ''
+
+    if len(str_date) == 6:
+        # year+month
+        str_year = str_date[:4]
+        str_month = str_date[4:]
+        str_day = '1'
+
+    elif len(str_date) == 8:
+        # year+month+day
+        str_year = str_date[:4]
+        str_month = str_date[4:6]
+        str_day = str_date[6:]
+
+    elif len(str_date) == 10:
+        # year+?+month+?+day
+        str_year = str_date[:4]
+        str_month = str_date[5:7]
+        str_day = str_date[8:]
+
+    else:
+        raise ValueError
+
+    # It raises exception if the input date is incorrect
+    temp = datetime.date(int(str_year), int(str_month), int(str_day))
+
+    return temp.year, temp.month, temp.day
+
+
+def gettimefield(str_time):
+    str_hour = ''
+    str_min = ''
+
+    if len(str_time) == 4:
+        # hour+minute
+        str_hour = str_time[:2]
+        str_min = str_time[2:]
+
+    elif len(str_time) == 5:
+        # hour+?+minute
+        str_hour = str_time[:2]
+        str_min = str_time[3:]
+
+    else:
+        raise ValueError
+
+    # It raises exception if the input date is incorrect
+    temp = datetime.time(int(str_hour), int(str_min))
+
+    return temp.hour, temp.minute
+
+
+def gettodaydate():
+    today = Globs.today
+    return today.year, today.month, today.day
+
+
+def cal_listhead():
+
+    html = [
+        u'  <tr>',
+        u'      <td class="list_head">Title</td>',
+        u'      <td class="list_head">Start Date</td>',
+        u'      <td class="list_head">End Date</td>',
+        u'      <td class="list_head">Recurrence</td>',
+        u'      <td class="list_head">Label</td>',
+        u'      <td class="list_head">Description</td>',
+        u'      <td class="list_head">Reference</td>',
+        u'  </tr>',
+        ]
+
+    return u'\r\n'.join(html)
+
+
+def showeventlist():
+
+    debug('Show Calendar: List view')
+
+    request = Globs.request
+    formatter = Globs.formatter
+
+    html_event_rows = []
+    html_list_header = cal_listhead()
+
+    # read all the events
+    events, eventindex, labels = loadEvents()
+
+    # sort events
+    sorted_eventids = events.keys()
+    sorted_eventids.sort(comp_list_events)
+
+    for eid in sorted_eventids:
+        if not events[eid]['clone']:
+            html_event_rows.append( listshow_event(events[eid]) )
+
+    html_event_rows = u'\r\n'.join(html_event_rows)
+
+    html_list_table = [
+        u'\r\n<div id="eventlist">',
+        u'<table class="eventlist">',
+        u'%s' % html_list_header,
+        u'%s' % html_event_rows,
+        u'</table>',
+        u'</div>',
+        ]
+    html_list_table = u'\r\n'.join(html_list_table)
+
+    return html_list_table
+
+
+def listshow_event(event):
+
+    if event['recur_freq']:
+        if event['recur_freq'] == -1:
+            recur_desc = 'last %s' % event['recur_type']
+        else:
+            recur_desc = 'every %d %s' % (event['recur_freq'], event['recur_type'])
+
+        if event['recur_until']:
+             recur_desc = '%s until %s' % (recur_desc, formatcfgdatetime(event['recur_until']))
+    else:
+        recur_desc = ''
+
+    html = [
+        u'  <tr>',
+        u'  <td class="list_entry">%s</td>' % converttext(event['title']),
+        u'  <td class="list_entry">%s</td>' % formatcfgdatetime(event['startdate'], event['starttime']),
+        u'  <td class="list_entry">%s</td>' % formatcfgdatetime(event['enddate'], event['endtime']),
+        u'  <td class="list_entry">%s</td>' % recur_desc,
+        u'  <td class="list_entry">%s</td>' % showReferPageParsedForLabel(event['label']),
+        u'  <td class="list_entry">%s</td>' % converttext(event['description']),
+        u'  <td class="list_entry">%s</td>' % showReferPageParsed(event, 'refer'),
+        u'  </tr>',
+        ]
+
+    return u'\r\n'.join(html)
+
+
+def showupcomingeventlist():
+
+    debug('Show Calendar: Upcoming Event View')
+
+    request = Globs.request
+    formatter = Globs.formatter
+
+    html_event_rows = []
+    html_list_header = cal_listhead()
+
+    year, month, day = gettodaydate()
+    day_delta = datetime.timedelta(days=Params.upcomingrange)
+    cur_date = datetime.date(year, month, day)
+    next_range = cur_date + day_delta
+
+    # set ranges of events
+    datefrom = u'%04d%02d%02d' % (year, month, day)
+    dateto = u'%04d%02d%02d' % (next_range.year, next_range.month, next_range.day)
+
+    # read the upcoming events, in the order of the list
+    upcoming_events, labels = loadUpcomingEvents(datefrom, dateto)
+
+    nowtime = formattimeobject(Globs.now)
+    todaydate = formatdateobject(Globs.today)
+
+    datefrom = formatcfgdatetime(cur_date, nowtime)
+    #u'%04d-%02d-%02d %s:%s' % (year, month, day, nowtime[:2], nowtime[2:])
+    dateto = formatcfgdatetime(formatdateobject(next_range))
+    #u'%04d-%02d-%02d' % (next_range.year, next_range.month, next_range.day)
+
+    for cur_event in upcoming_events:
+        if cur_event['enddate'] >= todaydate:
+            if (not cur_event['endtime']) or cur_event['endtime'] >= nowtime:
+                html_event_rows.append( listshow_event(cur_event) )
+
+    html_event_rows = u'\r\n'.join(html_event_rows)
+
+    html_list_table = [
+        u'\r\n<div id="eventlist">',
+        u'<table class="eventlist">',
+        u'<tr><td colspan="7" class="list_entry" style="border-width: 0px;"><b>Upcoming Event List: %s ~ %s</b><p><br><p></td></tr>' % (datefrom, dateto),
+        u'%s' % html_list_header,
+        u'%s' % html_event_rows,
+        u'</table>',
+        u'</div>',
+        ]
+    html_list_table = u'\r\n'.join(html_list_table)
+
+    return html_list_table
+
+
+def showcalendar():
+
+    request = Globs.request
+    formatter = Globs.formatter
+    form_vals = Globs.form_vals
+
+    html = []
+
+    if form_vals.has_key('caldate'):
+        try:
+            year, month, str_temp = getdatefield(form_vals['caldate'])
+        except (TypeError, ValueError):
+            errormsgcode('invalid_caldate')
+            year, month, dy = gettodaydate()
+
+    elif Params.curdate:
+        try:
+            year, month, str_temp = getdatefield(Params.curdate)
+        except (TypeError, ValueError):
+            errormsgcode('invalid_curdate')
+            year, month, dy = gettodaydate()
+
+    else:
+        year, month, dy = gettodaydate()
+
+    # check number of calendar
+    numcal = Params.numcal
+
+    if form_vals.has_key('numcal'):
+        try:
+            numcal = int(form_vals['numcal'])
+        except (TypeError, ValueError):
+            errormsgcode('invalid_numcal')
+
+    if numcal < 1:
+        numcal = 1
+    elif numcal > 12:
+        numcal = 12
+
+    # read the events of all the months at once
+    monthsevents = loadMonthsEvents(year, month, numcal)
+
+    for index in range(numcal):
+
+        cyear, cmonth = yearmonthplusoffset(year, month, index)
+
+        cal_html = showeventcalendar(cyear, cmonth, monthsevents)
+        html.append(cal_html)
+
+    return u''.join(html)
+
+
+def showdailycalendar():
+
+    request = Globs.request
+    formatter = Globs.formatter
+
+    form_vals = Globs.form_vals
+
+    if form_vals.has_key('caldate'):
+        try:
+            year, month, dy = getdatefield(form_vals['caldate'])
+
+            if len(form_vals['caldate']) <= 6:
+                tyear, tmonth, tdy = gettodaydate()
+                if tyear == year and month == tmonth:
+                    dy = tdy
+
+        except (TypeError, ValueError):
+            errormsgcode('invalid_caldate')
+            year, month, dy = gettodaydate()
+
+    elif Params.curdate:
+        try:
+            year, month, dy = getdatefield(Params.curdate)
+        except (TypeError, ValueError):
+            errormsgcode('invalid_curdate')
+            year, month, dy = gettodaydate()
+
+    else:
+        year, month, dy = gettodaydate()
+
+    html = showdailyeventcalendar(year, month, dy)
+
+    return u''.join(html)
+
+
+def showweeklycalendar():
+
+    request = Globs.request
+    formatter = Globs.formatter
+
+    form_vals = Globs.form_vals
+
+    if form_vals.has_key('caldate'):
+        try:
+            year, month, dy = getdatefield(form_vals['caldate'])
+
+            if len(form_vals['caldate']) <= 6:
+                tyear, tmonth, tdy = gettodaydate()
+                if tyear == year and month == tmonth:
+                    dy = tdy
+
+        except (TypeError, ValueError):
+            errormsgcode('invalid_caldate')
+            year, month, dy = gettodaydate()
+
+    elif Params.curdate:
+        try:
+            year, month, dy = getdatefield(Params.curdate)
+        except (TypeError, ValueError):
+            errormsgcode('invalid_curdate')
+            year, month, dy = gettodaydate()
+    else:
+        year, month, dy = gettodaydate()
+
+    html = showweeklyeventcalendar(year, month, dy)
+
+    return u''.join(html)
+
+
+def create_ical_from_events(events):
+    """ Creates icalendar file with events' data
+
+    It is called by the views of the macro page only, when the events.ics
+    attachment is older than the event store, so page views which use the
+    cached events do not touch it; the actions serving the events never do.
+    """
+    debug('Create icalendar file from events')
+
+    request = Globs.request
+
+    cal = icalendar.Calendar()
+    cal.add('prodid', ICAL_PRODID)
+    cal.add('version', ICAL_VERSION)
+
+    for item in events.values():
+        cal.add_component(geticalevent(item))
+
+    pagename = Globs.pagename
+
+    AttachFile.add_attachment(request,
+                              pagename,
+                              'events.ics',
+                              cal.to_ical(),
+                              overwrite=1)
+
+
+def icalneedsupdate():
+    """ tells whether the events.ics attachment of the page is older than the event store """
+
+    filename = AttachFile.getFilename(Globs.request, Globs.pagename, 'events.ics')
+
+    try:
+        return os.path.getmtime(filename) < Globs.eventversion
+    except os.error:
+        return 1
+
+
+def getpagecalendar(page, category):
+    """ sets the parameters of the calendar of the page showing the category
+
+    The actions take the category from the URL, so only the categories
+    shown by the macro on the page are accepted: any other would export
+    the events of that category, and create its caches. Without category,
+    the first calendar of the page is used. Returns 0 if there is none.
+    """
+
+    for match in MACRO_CALL.finditer(page.get_raw_body()):
+        getparams(match.group(1) or u'')
+
+        if not category or Params.category == category:
+            return 1
+
+    return 0
+
+
+def streamical(pagename, request):
+    """ Sends the events as icalendar feed, one VEVENT at a time
+
+    Called by the EventCalendarICal action. The ETag and Last-Modified
+    headers are derived from the version of the event cache, so polling
+    calendar clients get 304 until the events change.
+    """
+
+    page = Page(request, pagename)
+    setrequestvalues(request, page)
+
+    Globs.page_action = 'show'
+    Globs.form_vals = {}
+    Globs.debugmsg = ''
+    Globs.errormsg = ''
+
+    if not request.user.may.read(pagename):
+        request.status_code = 403
+        return
+
+    if not getpagecalendar(page, request.values.get('category', u'')):
+        request.status_code = 404
+        return
+
+    events, labels = loadEventsFromWikiPages()
+
+    version = Globs.eventversion
+    etag = '%d' % int(version * 1000)
+    lastmodified = datetime.datetime.utcfromtimestamp(int(version))
+
+    if request.if_none_match:
+        notmodified = request.if_none_match.contains(etag)
+    elif request.if_modified_since:
+        notmodified = request.if_modified_since >= lastmodified
+    else:
+        notmodified = 0
+
+    request.headers['ETag'] = '"%s"' % etag
+    request.headers['Last-Modified'] = timefuncs.formathttpdate(int(version))
+
+    if notmodified:
+        request.status_code = 304
+        return
+
+    request.content_type = 'text/calendar; charset=utf-8'
+    request.headers['Content-Disposition'] = 'inline; filename="events.ics"'
+
+    request.write('BEGIN:VCALENDAR\r\n')
+    request.write('PRODID:%s\r\n' % ICAL_PRODID)
+    request.write('VERSION:%s\r\n' % ICAL_VERSION)
+
+    for item in events.values():
+        request.write(geticalevent(item).to_ical())
+
+    request.write('END:VCALENDAR\r\n')
+
+
+def rebuildevents(pagename, request):
+    """ Brings the events of the category up to date, reporting them as text
+
+    Called by the EventCalendarRebuild action, e.g. from cron when the views
+    may use stale events (Globs.stale_maxage).
+    """
+
+    page = Page(request, pagename)
+    setrequestvalues(request, page)
+
+    Globs.page_action = 'rebuild'
+    Globs.form_vals = {}
+    Globs.debugmsg = ''
+    Globs.errormsg = ''
+
+    if not request.user.may.read(pagename):
+        request.status_code = 403
+        return
+
+    if not getpagecalendar(page, request.values.get('category', u'')):
+        request.status_code = 404
+        return
+
+    events, labels = loadEventsFromWikiPages()
+
+    request.content_type = 'text/plain; charset=utf-8'
+    request.write('%s: %d events, %d seconds old\n' % (Params.category.encode('utf-8'), len(events), time.time() - Globs.eventversion))
+
+
+def geticalevent(item):
+    """ Makes icalendar VEVENT component of an event """
+
+    request = Globs.request
+
+    def make_date_time(event, arg_date, arg_time):
+        event_date_time = event[arg_date]+event[arg_time]
+        return parser.parse(event_date_time)
+
+    new_event = icalendar.Event()
+    new_event.add('summary', item['title'])
+    new_event.add('DTSTART', make_date_time(item,
+                                            'startdate',
+                                            'starttime'))
+    new_event.add('DTEND', make_date_time(item, 'enddate', 'endtime'))
+    new_event.add('description', item['description'])
+    new_event.add('category', item['refer'])
+    if item['label']:
+        new_event.add('labels', item['label'])
+    if item['refer']:
+        new_event.add('url',
+                      request.getQualifiedURL()+getEventURL(item['refer'],
+                                                            item['title'],
+                                                            item['hid']))
+
+    return new_event
+
+
+def showsimplecalendar():
+
+    request = Globs.request
+    formatter = Globs.formatter
+    form_vals = Globs.form_vals
+
+    html = []
+
+    if form_vals.has_key('caldate'):
+        try:
+            year, month, str_temp = getdatefield(form_vals['caldate'])
+        except (TypeError, ValueError):
+            errormsgcode('invalid_caldate')
+            year, month, dy = gettodaydate()
+    elif Params.curdate:
+        try:
+            year, month, str_temp = getdatefield(Params.curdate)
+        except (TypeError, ValueError):
+            errormsgcode('invalid_curdate')
+            year, month, dy = gettodaydate()
+    else:
+        year, month, dy = gettodaydate()
 
-    params = {}
-    if args:
-        # Arguments are comma delimited key=value pairs
-        sargs = args.split(',')
+    # check number of calendar
+    numcal = Params.numcal
 
-        for item in sargs:
-            sitem = item.split('=')
+    if form_vals.has_key('numcal'):
+        try:
+            numcal = int(form_vals['numcal'])
+        except (TypeError, ValueError):
+            errormsgcode('invalid_numcal')
 
-            if len(sitem) == 2:
-                key, value = sitem[0], sitem[1]
-                params[key.strip()] = value.strip()
 
-    # category name:
-    # default: 'CategoryEventCalendar'
-    Params.category = params.get('category', Globs.defaultcategory)
+    if numcal < 1:
+        numcal = 1
+    elif numcal > 12:
+        numcal = 12
 
-    # menu bar: shows menubar or not (1: show, 0: no menubar)
-    # default: 1
-    try:
-        Params.menubar = int(params.get('menubar', 1))
-    except (TypeError, ValueError):
-        Params.menubar = 1
+    # read the events of all the months at once
+    monthsevents = loadMonthsEvents(year, month, numcal)
 
-    # calendar width in pixel or percent (monthly)
-    # default: 600px
-    Params.monthlywidth = params.get('monthlywidth', '600')
-    if Params.monthlywidth:
-        Params.monthlywidth = ' width="%s" ' % Params.monthlywidth
+    for index in range(numcal):
 
-    # calendar width in pixel or percent (weekly)
-    # default: 600px
-    Params.weeklywidth = params.get('weeklywidth', '600')
-    if Params.weeklywidth:
-        Params.weeklywidth = ' width="%s" ' % Params.weeklywidth
+        cyear, cmonth = yearmonthplusoffset(year, month, index)
 
-    # calendar width in pixel or percent (daily)
-    # default: 600px
-    Params.dailywidth = params.get('dailywidth', '600')
-    if Params.monthlywidth:
-        Params.dailywidth = ' width="%s" ' % Params.dailywidth
+        cal_html = showsimpleeventcalendar(cyear, cmonth, monthsevents)
+        html.append(cal_html)
 
-    # calendar width in pixel or percent (simply)
-    # default: 150px
-    Params.simplewidth = params.get('simplewidth', '150')
-    if Params.simplewidth:
-        # Params.simplewidth = Params.simplewidth.replace('%', '%%')
-        Params.simplewidth = ' width="%s" ' % Params.simplewidth
+    return u''.join(html)
 
-    # calendar view: monthly, list, simple
-    # default: 'monthly'
-    Params.firstview = params.get('firstview', 'monthly')
 
-    # calendar date: in YYYYMM format (in monthly, simple view)
-    # default: current month
-    Params.curdate = params.get('curdate', '')
+def comp_cal_events(xid, yid):
+    """Sort events in cal_events by length of days of the event"""
 
-    # upcoming range: # of days for upcoming event list
-    # default: 7
-    try:
-        Params.upcomingrange = int(params.get('upcomingrange', Globs.upcomingrange))
-    except (TypeError, ValueError):
-        Params.upcomingrange = Globs.upcomingrange
+    xevent = Globs.events[xid]
+    yevent = Globs.events[yid]
 
-    # number of calendar: # of calendar for monthly & simple view
-    # default: 1
-    try:
-        Params.numcal = int(params.get('numcal', '1'))
-    except (TypeError, ValueError):
-        Params.numcal = 1
+    if xevent.date_len > yevent.date_len:
+        return -1
+    elif xevent.date_len == yevent.date_len:
+        if xevent.date_len == 1:
+            # no start time (None) comes first
+            if xevent.startminute == yevent.startminute:
+                return cmp(yevent.time_len, xevent.time_len)
+            else:
+                return cmp(xevent.startminute, yevent.startminute)
+        else:
+            return 0
+    else:
+        return 1
 
-    # change view enabled?
-    # default: 1
-    try:
-        Params.changeview = int(params.get('changeview', '1'))
-    except (TypeError, ValueError):
-        Params.changeview = 1
 
-    # shows the event at the last weekday if the recurred weekday is not available.
-    # default: 0
-    try:
-        Params.showlastweekday = int(params.get('showlastweekday', '0'))
-    except (TypeError, ValueError):
-        Params.showlastweekday = 0
+def comp_list_events(xid, yid):
+    """ Sort events in the list by start date of the event """
+    events = Globs.events
 
-    # show error message?
-    # default: 1
-    try:
-        Params.showerror = int(params.get('showerror', '1'))
-    except (TypeError, ValueError):
-        Params.showerror = 1
+    return cmp(events[xid].startday, events[yid].startday)
 
-    # show week number?
-    # default: 0
-    try:
-        Params.showweeknumber = int(params.get('showweeknumber', '0'))
-    except (TypeError, ValueError):
-        Params.showweeknumber = 0
 
-    # default bgcolor
-    Params.bgcolor = '#ddffdd'
+def loadMonthsEvents(year, month, numcal):
+    """ load the events of numcal months from year/month at once
 
+    The views showing several months share one expansion of the recurrences
+    and one event index, over the days of all the months (and the days around
+    them), instead of loading the events month by month.
+    """
 
-def setglobalvalues(macro):
+    lastyear, lastmonth = yearmonthplusoffset(year, month, numcal - 1)
 
-    request = macro.request
-    formatter = macro.formatter
+    prev_month = datetime.date(year, month, 1) - datetime.timedelta(days=1)
+    next_month = datetime.date(lastyear, lastmonth, 25) + datetime.timedelta(days=15)
 
-    # Useful variables
-    Globs.baseurl = request.getBaseURL() + '/'
-    Globs.pagename = formatter.page.page_name
-    Globs.request = request
-    Globs.formatter = formatter
-    Globs.pageurl = '%s/%s' % (request.getScriptname(), wikiutil.quoteWikinameURL(formatter.page.page_name))
+    # set ranges of events
+    datefrom = u'%04d%02d21' % (prev_month.year, prev_month.month)
+    dateto = u'%04d%02d06' % (next_month.year, next_month.month)
 
-    # This fixes the subpages bug. subname is now used instead of pagename when creating certain urls
-    Globs.subname = Globs.pagename.split('/')[-1]
+    return loadEvents(datefrom, dateto)
 
-    pagepath = formatter.page.getPagePath()
-    Globs.pagepath = formatter.page.getPagePath()
 
-    # european / US differences
-    months = ('January','February','March','April','May','June','July','August','September','October','November','December')
+def getrawevents():
+    """ returns the events and labels of the event store, bringing them up to date
+    on the first call of the request only
 
-    # Set things up for Monday or Sunday as the first day of the week
-    if calendar.firstweekday() == calendar.MONDAY:
-        wkend = 6
-        wkdays = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
-    elif calendar.firstweekday() == calendar.SUNDAY:
-        wkend = 0
-        wkdays = ('Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat')
+    The view cache, the views and the months they show share them, instead of
+    validating the event store each.
+    """
 
-    Globs.months = months
-    Globs.wkdays = wkdays
-    Globs.wkend = wkend
+    if Globs.rawevents is None:
+        Globs.rawevents, Globs.rawlabels = loadEventsFromWikiPages()
 
-    year, month, day, h, m, s, wd, yd, ds = request.user.getTime(time.time())
-    Globs.today = datetime.date(year, month, day)
-    Globs.now = datetime.time(h, m, s)
+    return Globs.rawevents, Globs.rawlabels
 
-    Globs.debugmsg = ''
-    Globs.errormsg = ''
 
+def loadEvents(datefrom='', dateto='', nocache=0):
+    """ load events from wiki pages """
 
-def showReferPageParsed(event, targettext='title', showdesc=0):
     request = Globs.request
-    pagename = Globs.pagename
-
-    refer = event['refer']
-    targettext = event[targettext]
-    startdate = event['startdate']
-    enddate = event['enddate']
-    description = event['description']
-    starttime = event['starttime']
-    endtime = event['endtime']
-    hid = event['hid']
-
-    refer_url = '%s/%s' % (request.getScriptname(), wikiutil.quoteWikinameURL(refer))
 
-    if not Params.changeview:
-        refer_url = ''
-        hid = ''
+    debug('Loading event information.')
 
-    if showdesc:
-        if (startdate == enddate) and (starttime and endtime):
-            timedescription = '(%s:%s ~ %s:%s)' % (starttime[:2], starttime[2:], endtime[:2], endtime[2:])
-            if description:
-                timedescription = '%s ' % timedescription
-        else:
-            timedescription = ''
+    events = {}
+    labels = {}
+    eventindex = EventIndex()
+    raw_events = {}
 
-        targetlink = '<a href="%s#%s" title="%s%s">%s</a>' % ( refer_url, hid, timedescription, wikiutil.escape(description), wikiutil.escape(targettext) )
+    raw_events, labels = getrawevents()
 
-    else:
-        targetlink = '<a href="%s#%s">%s</a>' % ( refer_url, hid, wikiutil.escape(targettext))
+    # handling eventindex
+    if datefrom or dateto:
 
-    return targetlink
+        try:
+            dayfrom, dayto = getdateordinal(datefrom), getdateordinal(dateto)
+        except (TypeError, ValueError):
+            dayfrom, dayto = 0, 0
 
+        # recurrences are expanded (and cached) by calendar month, so that
+        # windows overlapping the same months share the expansion
+        recurrences = {}
+        updated = 0
 
-def showReferPageParsedForLabel(thelabel, targettext='name', showdesc=1):
-    request = Globs.request
-    pagename = Globs.pagename
+        if dayfrom and dayto:
+            cur_date = datetime.date.fromordinal(dayfrom).replace(day=1)
+            lastmonth = datetime.date.fromordinal(dayto).replace(day=1)
 
-    labels = Globs.labels
+            while cur_date <= lastmonth:
+                month_recurrences, month_updated = loadMonthRecurrences(raw_events, cur_date.year, cur_date.month, nocache)
+                updated = updated or month_updated
 
-    label_bgcolor = ''
-    refer = ''
+                for e_id, startdays in month_recurrences.items():
+                    if not recurrences.has_key(e_id):
+                        recurrences[e_id] = []
+                    recurrences[e_id].extend(startdays)
 
-    if labels and labels.has_key(thelabel):
-        targettext = labels[thelabel][targettext]
-        refer = labels[thelabel]['refer']
-        if showdesc:
-            label_bgcolor = labels[thelabel]['bgcolor']
+                cyear, cmonth = yearmonthplusoffset(cur_date.year, cur_date.month, 1)
+                cur_date = datetime.date(cyear, cmonth, 1)
 
-    if not refer:
-        return '<i>%s</i>' % thelabel
+        if updated or Globs.page_action == 'refresh':
+            sweeprangecaches()
 
-    refer_url = '%s/%s' % (request.getScriptname(), wikiutil.quoteWikinameURL(refer))
+        debug('Building new eventindex information')
 
-    if showdesc:
-        targetlink = '<a href="%s" title="%s">%s</a>' % ( refer_url, label_bgcolor, wikiutil.escape(targettext) )
-    else:
-        targetlink = '<a href="%s">%s</a>' % ( refer_url, wikiutil.escape(targettext))
+        clone_num = 0
 
-    return targetlink
+        for e_id in raw_events.keys():
 
+            cur_event = raw_events[e_id]
 
-def getheadingid(request, referpage, title):
+            # handling event recurrence
+            recur_freq = cur_event.recur_freq
 
-    pntt = (referpage + title).encode(config.charset)
-    hid = "head-" + sha.new(pntt).hexdigest()
+            if recur_freq or recur_freq == -1:
 
-    if not hasattr(request, '_eventcal_headings'):
-        request._eventcal_headings = {}
+                if not (cur_event.untilday and cur_event.untilday < dayfrom) or cur_event.startday > dayto:
 
-    request._eventcal_headings.setdefault(pntt, 0)
-    request._eventcal_headings[pntt] += 1
-    if request._eventcal_headings[pntt] > 1:
-        hid += '-%d'%(request._eventcal_headings[pntt],)
+                    if not (cur_event.endday < dayfrom or cur_event.startday > dayto):
+                        # indexing the event itself
+                        events[e_id] = cur_event
+                        insertcalevents(eventindex, dayfrom, dayto, e_id, cur_event.startday, cur_event.endday)
 
-    return hid
+                    for new_startday in recurrences.get(e_id, []):
 
+                        # the first and last months may hold recurrences out of the window
+                        if new_startday < dayfrom or new_startday > dayto:
+                            continue
 
-def getquerystring(req_fields):
+                        new_endday = new_startday + cur_event.date_len - 1
 
-    m_query = []
-    tmp_form_vals = Globs.form_vals
+                        clone_num += 1
+                        clone_id = 'c%d' % clone_num
 
-    # format querystring
-    # action should be poped out
-    for field in req_fields:
-        if tmp_form_vals.has_key(field):
-            m_query.append(u'%s=%s' % (field, tmp_form_vals[field]) )
+                        events[clone_id] = EventOccurrence(clone_id, cur_event, new_startday, new_endday)
 
-    if 'prevcalaction' in req_fields:
-        if not tmp_form_vals.has_key('prevcalaction'):
-            m_query.append(u'%s=%s' % ('prevcalaction', tmp_form_vals['calaction']) )
+                        insertcalevents(eventindex, dayfrom, dayto, clone_id, new_startday, new_endday)
 
-    m_query = u'&'.join(m_query)
+            else:
 
-    if m_query:
-        m_query = '&%s' % m_query
+                if not (cur_event.endday < dayfrom or cur_event.startday > dayto):
+                    events[e_id] = cur_event
+                    insertcalevents(eventindex, dayfrom, dayto, e_id, cur_event.startday, cur_event.endday)
 
-    return m_query
+        eventindex.build()
 
+    else:
+        events = raw_events
 
-def showmenubar():
-    """ Bottom menu bar """
+    # store event list into global variables in order to sort them
+    Globs.events = events
+    Globs.labels = labels
 
-    request = Globs.request
-    cal_action = Globs.cal_action
-    page_name = Globs.pagename
+    debug(u'Total %d events are loaded finally.' % len(events))
+    debug(u'Total %d labels are loaded finally.' % len(labels))
 
-    page_url = Globs.pageurl
+    return events, eventindex, labels
 
-    if not Params.menubar: return ''
 
-    if cal_action == 'simple':
-        menuwidth = Params.simplewidth
-    elif cal_action == 'monthly':
-        menuwidth = Params.monthlywidth
-    else:
-        menuwidth = ''
+def loadUpcomingEvents(datefrom, dateto):
+    """ returns the events of the upcoming event list, sorted by start date, and the labels
 
-    left_menu_selected = []
-    right_menu_selected = []
+    The list of the window (its event ids and days) is cached (upcoming_<range>)
+    until the day changes or the events are rebuilt, so that the requests of the
+    day only look the events up, without expanding and sorting them again.
+    """
 
-    # Go Today
-    year, month, day = gettodaydate()
-    mnu_curmonthcal = u'<a href="%s?calaction=%s&caldate=%d%02d%02d%s" title="Go Today">[Today]</a>' % (page_url, cal_action, year, month, day, getquerystring(['numcal']))
+    request = Globs.request
 
-    # List View
-    mnu_listview = u'<a href="%s?calaction=list%s" title="List of all events">[List]</a>' % (page_url, getquerystring(['caldate', 'numcal']))
+    raw_events, labels = getrawevents()
 
-    # Monthly View
-    mnu_monthview = u'<a href="%s?calaction=monthly%s" title="Monthly view">[Monthly]</a>' % (page_url, getquerystring(['caldate', 'numcal']) )
+    arena = geteventstore()
+    upcomingkey = 'upcoming_%d' % Params.upcomingrange
 
-    # Simple Calendar View
-    mnu_simpleview = u'<a href="%s?calaction=simple%s" title="Simple calendar view">[Simple]</a>' % (page_url, getquerystring(['caldate', 'numcal']) )
+    # the weekday rules depend on it
+    if Params.showlastweekday:
+        upcomingkey = '%s_lastweekday' % upcomingkey
 
-    # Upcoming Event List
-    mnu_upcomingview = u'<a href="%s?calaction=upcoming%s" title="Upcoming event list">[Upcoming]</a>' % (page_url, getquerystring(['caldate', 'numcal']) )
+    cache_events = caching.CacheEntry(request, arena, 'events', scope='wiki')
+    cache_upcoming = caching.CacheEntry(request, arena, upcomingkey, scope='wiki')
 
-    # Daily View
-    mnu_dayview = u'<a href="%s?calaction=daily%s" title="Daily view">[Daily]</a>' % (page_url, getquerystring(['caldate', 'numcal']) )
+    upcoming = None
 
-    # Weekly View
-    mnu_weekview = u'<a href="%s?calaction=weekly%s" title="Weekly view">[Weekly]</a>' % (page_url, getquerystring(['caldate', 'numcal']) )
+    if not cache_upcoming.needsUpdate(cache_events._filename()):
+        try:
+            cachedfrom, upcoming = loadcache(cache_upcoming)
+            if cachedfrom != datefrom:
+                upcoming = None
+        except (pickle.UnpicklingError, IOError, EOFError, ValueError, TypeError, caching.CacheError):
+            debug('Picke error at fetching cached upcoming events')
 
-    # iCalendar download
-    # mnu_ical = u'<a href="%s/?calaction=ical&action=AttachFile&do=get&target=events.ics" title="icalendar download">[ical]</a>' % (page_url)
-    mnu_ical = u'<a href="%s/?action=AttachFile&do=get&target=events.ics" title="icalendar download">[ical]</a>' % (page_url)
+    if upcoming is None:
+        # no month caches are written for the window, as before
+        events, eventindex, labels = loadEvents(datefrom, dateto, 1)
 
-    html = [
-        u'\r\n',
-        u'<table class="eventcalendar_menubar" %s>',
-        u'  <tr>',
-        u'  <td class="eventcalendar_menubar" align="left">%s</td>',
-        u'  <td class="eventcalendar_menubar" align="right">%s</td>',
-        u'  </tr>',
-        u'</table>',
-        ]
+        # sort events
+        sorted_eventids = events.keys()
+        sorted_eventids.sort(comp_list_events)
 
-    if cal_action == 'list':
-        left_menu_selected.append(mnu_monthview)
-        left_menu_selected.append(mnu_weekview)
-        left_menu_selected.append(mnu_dayview)
-        left_menu_selected.append(mnu_simpleview)
-        left_menu_selected.append(mnu_ical)
-        right_menu_selected.append(mnu_upcomingview)
+        upcoming = []
 
-    elif cal_action == 'simple':
-        left_menu_selected.append(mnu_monthview)
-        left_menu_selected.append(mnu_weekview)
-        left_menu_selected.append(mnu_dayview)
-        left_menu_selected.append(mnu_ical)
-        right_menu_selected.append(mnu_listview)
-        right_menu_selected.append(mnu_upcomingview)
-        right_menu_selected.append(mnu_curmonthcal)
+        for e_id in sorted_eventids:
+            cur_event = events[e_id]
 
-    elif cal_action == 'upcoming':
-        left_menu_selected.append(mnu_monthview)
-        left_menu_selected.append(mnu_weekview)
-        left_menu_selected.append(mnu_dayview)
-        left_menu_selected.append(mnu_simpleview)
-        left_menu_selected.append(mnu_ical)
-        right_menu_selected.append(mnu_listview)
+            if cur_event.clone:
+                upcoming.append((e_id, cur_event.master.id, cur_event.startday, cur_event.endday))
+            else:
+                upcoming.append((e_id, e_id, cur_event.startday, cur_event.endday))
 
-    elif cal_action == 'weekly':
-        left_menu_selected.append(mnu_monthview)
-        left_menu_selected.append(mnu_dayview)
-        left_menu_selected.append(mnu_simpleview)
-        left_menu_selected.append(mnu_ical)
-        right_menu_selected.append(mnu_upcomingview)
-        right_menu_selected.append(mnu_listview)
-        right_menu_selected.append(mnu_curmonthcal)
+        storecache(cache_upcoming, (datefrom, upcoming))
 
-    elif cal_action == 'daily':
-        left_menu_selected.append(mnu_monthview)
-        left_menu_selected.append(mnu_weekview)
-        left_menu_selected.append(mnu_simpleview)
-        left_menu_selected.append(mnu_ical)
-        right_menu_selected.append(mnu_upcomingview)
-        right_menu_selected.append(mnu_listview)
-        right_menu_selected.append(mnu_curmonthcal)
+        debug('Upcoming events of %s ~ %s are listed: %d events' % (datefrom, dateto, len(upcoming)))
 
-    else:
-        left_menu_selected.append(mnu_weekview)
-        left_menu_selected.append(mnu_dayview)
-        left_menu_selected.append(mnu_simpleview)
-        left_menu_selected.append(mnu_ical)
-        right_menu_selected.append(mnu_upcomingview)
-        right_menu_selected.append(mnu_listview)
-        right_menu_selected.append(mnu_curmonthcal)
+    upcoming_events = []
 
-    left_menu_selected = u'\r\n'.join(left_menu_selected)
-    right_menu_selected = u'\r\n'.join(right_menu_selected)
+    for e_id, master_id, startday, endday in upcoming:
 
-    html = u'\r\n'.join(html)
-    html = html % (menuwidth, left_menu_selected, right_menu_selected)
+        # the events may have been rebuilt meanwhile
+        if not raw_events.has_key(master_id):
+            continue
 
-    return html
+        if e_id == master_id:
+            upcoming_events.append(raw_events[e_id])
+        else:
+            upcoming_events.append(EventOccurrence(e_id, raw_events[master_id], startday, endday))
 
+    Globs.labels = labels
 
-def getdatefield(str_date):
-    str_year = ''
-    str_month = ''
-    str_day = ''
+    return upcoming_events, labels
 
-    if len(str_date) == 6:
-        # year+month
-        str_year = str_date[:4]
-        str_month = str_date[4:]
-        str_day = '1'
 
-    elif len(str_date) == 8:
-        # year+month+day
-        str_year = str_date[:4]
-        str_month = str_date[4:6]
-        str_day = str_date[6:]
+def loadMonthRecurrences(raw_events, year, month, nocache=0):
+    """ returns the start days of the recurrences starting in the month, by event id,
+    and whether the month cache was rewritten
 
-    elif len(str_date) == 10:
-        # year+?+month+?+day
-        str_year = str_date[:4]
-        str_month = str_date[5:7]
-        str_day = str_date[8:]
+    They are cached per month (recurrences_<yyyymm>) until the events are rebuilt.
+    """
 
-    else:
-        raise ValueError
+    request = Globs.request
 
-    # It raises exception if the input date is incorrect
-    temp = datetime.date(int(str_year), int(str_month), int(str_day))
+    arena = geteventstore()
+    recurrencekey = 'recurrences_%04d%02d' % (year, month)
 
-    return temp.year, temp.month, temp.day
+    # the weekday rules depend on it
+    if Params.showlastweekday:
+        recurrencekey = '%s_lastweekday' % recurrencekey
 
+    cache_events = caching.CacheEntry(request, arena, 'events', scope='wiki')
+    cache_recurrences = caching.CacheEntry(request, arena, recurrencekey, scope='wiki')
 
-def gettimefield(str_time):
-    str_hour = ''
-    str_min = ''
+    if not cache_recurrences.needsUpdate(cache_events._filename()):
+        try:
+            recurrences = loadcache(cache_recurrences)
+            userangecache(cache_recurrences)
+            return recurrences, 0
+        except (pickle.UnpicklingError, IOError, EOFError, ValueError, caching.CacheError):
+            debug('Picke error at fetching cached recurrences of %04d/%02d' % (year, month))
 
-    if len(str_time) == 4:
-        # hour+minute
-        str_hour = str_time[:2]
-        str_min = str_time[2:]
+    monthfrom = datetime.date(year, month, 1).toordinal()
+    monthto = monthfrom + calendar.monthrange(year, month)[1] - 1
 
-    elif len(str_time) == 5:
-        # hour+?+minute
-        str_hour = str_time[:2]
-        str_min = str_time[3:]
+    recurrences = {}
 
-    else:
-        raise ValueError
+    for e_id, cur_event in raw_events.items():
+        if cur_event.recur_freq or cur_event.recur_freq == -1:
+            startdays = [recurred_startdate.toordinal() for recurred_startdate in getrecurrences(cur_event, monthfrom, monthto)]
+            if startdays:
+                recurrences[e_id] = startdays
 
-    # It raises exception if the input date is incorrect
-    temp = datetime.time(int(str_hour), int(str_min))
+    debug('Recurrences of %04d/%02d are expanded: %d events' % (year, month, len(recurrences)))
 
-    return temp.hour, temp.minute
+    if nocache:
+        return recurrences, 0
 
+    storecache(cache_recurrences, recurrences)
 
-def gettodaydate():
-    today = Globs.today
-    return today.year, today.month, today.day
+    return recurrences, 1
 
 
-def cal_listhead():
+def userangecache(cache):
+    """ records the use of a range cache entry in its access time
 
-    html = [
-        u'  <tr>',
-        u'      <td class="list_head">Title</td>',
-        u'      <td class="list_head">Start Date</td>',
-        u'      <td class="list_head">End Date</td>',
-        u'      <td class="list_head">Recurrence</td>',
-        u'      <td class="list_head">Label</td>',
-        u'      <td class="list_head">Description</td>',
-        u'      <td class="list_head">Reference</td>',
-        u'  </tr>',
-        ]
+    The modification time is kept, as it tells whether the entry is still valid.
+    """
 
-    return u'\r\n'.join(html)
+    try:
+        filestat = os.stat(cache._filename())
+        os.utime(cache._filename(), (time.time(), filestat.st_mtime))
+    except OSError:
+        pass
 
 
-def showeventlist():
+def getviewcache(args):
+    """ returns the cache entry of the html of the requested view, None if it is not cached
 
-    debug('Show Calendar: List view')
+    The key is made of everything the html depends on but the events: the view,
+    its date and number of calendars, the macro arguments and page, and the date
+    format and language of the user. The day (and for the upcoming event list the
+    minute) and the event store version go into the stamp stored with the html.
+    """
 
     request = Globs.request
-    formatter = Globs.formatter
+    form_vals = Globs.form_vals
 
-    html_event_rows = []
-    html_list_header = cal_listhead()
+    if not Globs.viewcache or Params.debug or Globs.page_action == 'refresh':
+        return None
 
-    # read all the events
-    events, cal_events, labels = loadEvents()
+    viewkey = [Globs.cal_action, form_vals.get('caldate', ''), form_vals.get('numcal', ''),
+               args or '', Globs.pageurl, request.lang, request.user.date_fmt or '', request.user.datetime_fmt or '']
 
-    # sort events
-    sorted_eventids = events.keys()
-    sorted_eventids.sort(comp_list_events)
+    viewkey = u'\n'.join([u'%s' % item for item in viewkey])
+    viewkey = 'view_%s' % sha.new(viewkey.encode('utf-8')).hexdigest()
 
-    for eid in sorted_eventids:
-        if not events[eid]['clone']:
-            html_event_rows.append( listshow_event(events[eid]) )
+    return caching.CacheEntry(request, geteventstore(), viewkey, scope='wiki')
 
-    html_event_rows = u'\r\n'.join(html_event_rows)
 
-    html_list_table = [
-        u'\r\n<div id="eventlist">',
-        u'<table class="eventlist">',
-        u'%s' % html_list_header,
-        u'%s' % html_event_rows,
-        u'</table>',
-        u'</div>',
-        ]
-    html_list_table = u'\r\n'.join(html_list_table)
+def getviewstamp():
+    """ the stamp of the html of a view: the event store version and the day, and the minute
+    for the upcoming event list, which starts now
+    """
 
-    return html_list_table
+    if Globs.cal_action == 'upcoming':
+        return (Globs.eventversion, Globs.today.toordinal(), Globs.now.hour * 60 + Globs.now.minute)
 
+    return (Globs.eventversion, Globs.today.toordinal())
 
-def listshow_event(event):
 
-    if event['recur_freq']:
-        if event['recur_freq'] == -1:
-            recur_desc = 'last %s' % event['recur_type']
-        else:
-            recur_desc = 'every %d %s' % (event['recur_freq'], event['recur_type'])
+def loadviewcache(cache_view):
+    """ returns the cached html of the view if it was made of the current events, else None
 
-        if event['recur_until']:
-             recur_desc = '%s until %s' % (recur_desc, formatcfgdatetime(event['recur_until']))
-    else:
-        recur_desc = ''
+    The events are brought up to date first, as the views would do.
+    """
 
-    html = [
-        u'  <tr>',
-        u'  <td class="list_entry">%s</td>' % converttext(event['title']),
-        u'  <td class="list_entry">%s</td>' % formatcfgdatetime(event['startdate'], event['starttime']),
-        u'  <td class="list_entry">%s</td>' % formatcfgdatetime(event['enddate'], event['endtime']),
-        u'  <td class="list_entry">%s</td>' % recur_desc,
-        u'  <td class="list_entry">%s</td>' % showReferPageParsedForLabel(event['label']),
-        u'  <td class="list_entry">%s</td>' % converttext(event['description']),
-        u'  <td class="list_entry">%s</td>' % showReferPageParsed(event, 'refer'),
-        u'  </tr>',
-        ]
+    if not cache_view:
+        return None
 
-    return u'\r\n'.join(html)
+    getrawevents()
 
+    try:
+        stamp, html, stored_errmsg = loadcache(cache_view)
+    except (pickle.UnpicklingError, IOError, EOFError, ValueError, TypeError, caching.CacheError):
+        return None
 
-def showupcomingeventlist():
+    if stamp != getviewstamp():
+        return None
 
-    debug('Show Calendar: Upcoming Event View')
+    userangecache(cache_view)
 
-    request = Globs.request
-    formatter = Globs.formatter
+    # the messages of the event pages and of the view
+    Globs.errormsg = stored_errmsg
 
-    html_event_rows = []
-    html_list_header = cal_listhead()
+    debug('Cached html of the view is used')
 
-    year, month, day = gettodaydate()
-    day_delta = datetime.timedelta(days=Params.upcomingrange)
-    cur_date = datetime.date(year, month, day)
-    next_range = cur_date + day_delta
+    return html
 
-    # set ranges of events
-    datefrom = u'%04d%02d%02d' % (year, month, day)
-    dateto = u'%04d%02d%02d' % (next_range.year, next_range.month, next_range.day)
 
-    # read all the events (no cache)
-    events, cal_events, labels = loadEvents(datefrom, dateto, 1)
+def storeviewcache(cache_view, html):
+    """ caches the html of the view with its stamp """
 
-    nowtime = formattimeobject(Globs.now)
+    if not cache_view:
+        return
 
-    datefrom = formatcfgdatetime(cur_date, nowtime)
-    #u'%04d-%02d-%02d %s:%s' % (year, month, day, nowtime[:2], nowtime[2:])
-    dateto = formatcfgdatetime(formatdateobject(next_range))
-    #u'%04d-%02d-%02d' % (next_range.year, next_range.month, next_range.day)
+    storecache(cache_view, (getviewstamp(), html, Globs.errormsg))
+    sweeprangecaches()
 
-    # sort events
-    sorted_eventids = events.keys()
-    sorted_eventids.sort(comp_list_events)
 
-    for eid in sorted_eventids:
-        if events[eid]['enddate'] >= formatdateobject(Globs.today):
-            if (not events[eid]['endtime']) or events[eid]['endtime'] >= formattimeobject(Globs.now):
-                html_event_rows.append( listshow_event(events[eid]) )
+def sweeprangecaches():
+    """ removes the stale range caches of the event store, and the least recently used ones
+    beyond Globs.rangecache_maxentries or Globs.rangecache_maxbytes for the month caches,
+    and beyond Globs.viewcache_maxentries or Globs.viewcache_maxbytes for the view caches
 
-    html_event_rows = u'\r\n'.join(html_event_rows)
+    Range caches are the month caches of recurrences and the view caches. Stale are
+    the ones older than the events cache or unused for Globs.rangecache_ttl days.
+    The caches which the former versions kept with the macro page go as well.
+    Returns the number of removed entries.
+    """
 
-    html_list_table = [
-        u'\r\n<div id="eventlist">',
-        u'<table class="eventlist">',
-        u'<tr><td colspan="7" class="list_entry" style="border-width: 0px;"><b>Upcoming Event List: %s ~ %s</b><p><br><p></td></tr>' % (datefrom, dateto),
-        u'%s' % html_list_header,
-        u'%s' % html_event_rows,
-        u'</table>',
-        u'</div>',
-        ]
-    html_list_table = u'\r\n'.join(html_list_table)
+    request = Globs.request
 
-    return html_list_table
+    page = Page(request, Globs.pagename)
 
+    for key in caching.get_cache_list(request, page, 'item'):
+        if LEGACY_CACHE_KEY.match(key):
+            caching.CacheEntry(request, page, key, scope='item').remove()
 
-def showcalendar():
+    arena = geteventstore()
+    arena_dir = caching.get_arena_dir(request, arena, 'wiki')
 
-    request = Globs.request
-    formatter = Globs.formatter
-    form_vals = Globs.form_vals
+    eventsmtime = caching.CacheEntry(request, arena, 'events', scope='wiki').mtime()
+    expire = time.time() - Globs.rangecache_ttl * 86400
 
-    html = []
+    # each kind of range caches has its own budget
+    budgets = {
+        'recurrences': (Globs.rangecache_maxentries, Globs.rangecache_maxbytes),
+        'view': (Globs.viewcache_maxentries, Globs.viewcache_maxbytes),
+    }
 
-    if form_vals.has_key('caldate'):
-        try:
-            year, month, str_temp = getdatefield(form_vals['caldate'])
-        except (TypeError, ValueError):
-            errormsgcode('invalid_caldate')
-            year, month, dy = gettodaydate()
+    stale = []
+    entries = {}
+
+    for key in caching.get_cache_list(request, arena, 'wiki'):
+        if not RANGECACHE_KEY.match(key):
+            continue
 
-    elif Params.curdate:
         try:
-            year, month, str_temp = getdatefield(Params.curdate)
-        except (TypeError, ValueError):
-            errormsgcode('invalid_curdate')
-            year, month, dy = gettodaydate()
+            filestat = os.stat(os.path.join(arena_dir, key))
+        except OSError:
+            continue
 
-    else:
-        year, month, dy = gettodaydate()
+        if filestat.st_mtime < eventsmtime or filestat.st_atime < expire:
+            stale.append(key)
+        else:
+            entries.setdefault(key.split('_')[0], []).append((filestat.st_atime, filestat.st_size, key))
 
-    # check number of calendar
-    numcal = Params.numcal
+    numentries = 0
+    numbytes = 0
 
-    if form_vals.has_key('numcal'):
-        try:
-            numcal = int(form_vals['numcal'])
-        except (TypeError, ValueError):
-            errormsgcode('invalid_numcal')
+    for kind, kindentries in entries.items():
+        maxentries, maxbytes = budgets[kind]
 
-    if numcal < 1:
-        numcal = 1
-    elif numcal > 12:
-        numcal = 12
+        # the most recently used ones are kept
+        kindentries.sort()
+        kindentries.reverse()
 
-    for index in range(numcal):
+        kept = 0
+        keptbytes = 0
 
-        cyear, cmonth = yearmonthplusoffset(year, month, index)
+        for lastuse, size, key in kindentries:
+            if kept >= maxentries or keptbytes + size > maxbytes:
+                # the rest was used even less recently
+                stale.extend([entry[2] for entry in kindentries[kept:]])
+                break
 
-        cal_html = showeventcalendar(cyear, cmonth)
-        html.append(cal_html)
+            kept += 1
+            keptbytes += size
 
-    return u''.join(html)
+        numentries += kept
+        numbytes += keptbytes
 
+    for key in stale:
+        caching.CacheEntry(request, arena, key, scope='wiki').remove()
 
-def showdailycalendar():
+    debug('Range caches are swept: %d removed, %d kept (%d bytes)' % (len(stale), numentries, numbytes))
 
-    request = Globs.request
-    formatter = Globs.formatter
+    return len(stale)
 
-    form_vals = Globs.form_vals
 
-    if form_vals.has_key('caldate'):
-        try:
-            year, month, dy = getdatefield(form_vals['caldate'])
+def getrecurrences(event, dayfrom, dayto):
+    """ yields the start dates of the recurrences of event which start in [dayfrom, dayto] (ordinals)
+
+    The rules are RRULEs (RFC 5545) of dateutil; their dtstart is moved close to
+    datefrom first, so that only the recurrences of the window are generated.
+    The event itself is not yielded.
+    """
+
+    recur_freq = event.recur_freq
+    recur_type = event.recur_type
+
+    if not dayto:
+        return
+
+    startdate = datetime.date.fromordinal(event.startday)
 
-            if len(form_vals['caldate']) <= 6:
-                tyear, tmonth, tdy = gettodaydate()
-                if tyear == year and month == tmonth:
-                    dy = tdy
+    # recurrences start after the event itself
+    lowerdate = startdate + datetime.timedelta(days=1)
+    if dayfrom:
+        lowerdate = max(lowerdate, datetime.date.fromordinal(dayfrom))
 
-        except (TypeError, ValueError):
-            errormsgcode('invalid_caldate')
-            year, month, dy = gettodaydate()
+    upperdate = datetime.date.fromordinal(dayto)
+    if event.untilday:
+        upperdate = min(upperdate, datetime.date.fromordinal(event.untilday))
 
-    elif Params.curdate:
-        try:
-            year, month, dy = getdatefield(Params.curdate)
-        except (TypeError, ValueError):
-            errormsgcode('invalid_curdate')
-            year, month, dy = gettodaydate()
+    if lowerdate > upperdate:
+        return
 
-    else:
-        year, month, dy = gettodaydate()
+    until = datetime.datetime(upperdate.year, upperdate.month, upperdate.day)
 
-    html = showdailyeventcalendar(year, month, dy)
+    if recur_type in ['day', 'week']:
+        if recur_type == 'day':
+            day_delta = recur_freq
+        else:
+            day_delta = recur_freq * 7
 
-    return u''.join(html)
+        q_delta = (lowerdate - startdate).days / day_delta
+        dtstart = startdate + datetime.timedelta(days = q_delta * day_delta)
 
+        rule = rrule.rrule(rrule.DAILY, interval=day_delta, dtstart=datetime.datetime(dtstart.year, dtstart.month, dtstart.day), until=until)
 
-def showweeklycalendar():
+    elif recur_type in ['month', 'year']:
+        # the day is the last day of the month when the month is shorter
+        if startdate.day > 28:
+            bymonthday = (startdate.day, -1)
+        else:
+            bymonthday = startdate.day
 
-    request = Globs.request
-    formatter = Globs.formatter
+        if recur_type == 'month':
+            q_delta = ((lowerdate.year - startdate.year) * 12 + lowerdate.month - startdate.month) / recur_freq
+            cyear, cmonth = yearmonthplusoffset(startdate.year, startdate.month, q_delta * recur_freq)
 
-    form_vals = Globs.form_vals
+            rule = rrule.rrule(rrule.MONTHLY, interval=recur_freq, dtstart=datetime.datetime(cyear, cmonth, 1), until=until, bymonthday=bymonthday, bysetpos=1)
 
-    if form_vals.has_key('caldate'):
-        try:
-            year, month, dy = getdatefield(form_vals['caldate'])
+        else:
+            q_delta = (lowerdate.year - startdate.year) / recur_freq
+            cyear = startdate.year + q_delta * recur_freq
+
+            rule = rrule.rrule(rrule.YEARLY, interval=recur_freq, dtstart=datetime.datetime(cyear, 1, 1), until=until, bymonth=startdate.month, bymonthday=bymonthday, bysetpos=1)
+
+    elif recur_type == 'weekday':
+        # n-th weekday of the month, or the last one with recur_freq == -1
+        if recur_freq == -1:
+            nth = -1
+        elif recur_freq > 4 and Params.showlastweekday:
+            # if no matched weekday, the last weekday will be displayed
+            nth = -1
+        elif recur_freq > 5:
+            # no month has it, so no event will be displayed
+            return
+        else:
+            nth = recur_freq
 
-            if len(form_vals['caldate']) <= 6:
-                tyear, tmonth, tdy = gettodaydate()
-                if tyear == year and month == tmonth:
-                    dy = tdy
+        byweekday = rrule.weekdays[startdate.weekday()](nth)
 
-        except (TypeError, ValueError):
-            errormsgcode('invalid_caldate')
-            year, month, dy = gettodaydate()
+        rule = rrule.rrule(rrule.MONTHLY, dtstart=datetime.datetime(lowerdate.year, lowerdate.month, 1), until=until, byweekday=byweekday)
 
-    elif Params.curdate:
-        try:
-            year, month, dy = getdatefield(Params.curdate)
-        except (TypeError, ValueError):
-            errormsgcode('invalid_curdate')
-            year, month, dy = gettodaydate()
     else:
-        year, month, dy = gettodaydate()
+        return
 
-    html = showweeklyeventcalendar(year, month, dy)
+    for recurrence in rule:
+        recurrence = recurrence.date()
 
-    return u''.join(html)
+        if recurrence >= lowerdate:
+            yield recurrence
 
 
-def create_ical_from_events():
-    """ Creates icalendar file with events' data """
-    debug('Create icalendar file from events')
+class MemCache:
+    """ unpickled cache entries, kept in memory across the requests of a long running process
 
-    request = Globs.request
-    formatter = None
+    Entries are keyed by the cache file and used as long as its uid() is unchanged;
+    at most Globs.memcache_maxentries of them are kept, the least recently used going first.
+    The cached objects are shared, so they must not be modified.
+    """
 
-    # read all the events
-    events, cal_events, labels = loadEvents()
+    entries = {}   # cache file: (uid, content, last use)
+    uses = 0
+    lock = threading.Lock()
 
-    # sort events
-    sorted_eventids = events.keys()
-    sorted_eventids.sort(comp_list_events)
 
-    cal = icalendar.Calendar()
-    cal.add('prodid', '-//moinmo.in//EventCalendar/')
-    cal.add('version', '1.0')
+def loadcache(cache, unpack=None):
+    """ returns the unpickled (and unpacked) content of a cache entry, from memory when possible """
 
-    def display(cal):
-        return cal.to_ical()
+    filename = cache._filename()
+    uid = cache.uid()
 
-    def make_date_time(event, arg_date, arg_time):
-        try:
-            event[arg_time]
-        except NameError:
-            event[arg_time] = u'0000'
-        event_date_time = event[arg_date]+event[arg_time]
-        return parser.parse(event_date_time)
+    MemCache.lock.acquire()
+    try:
+        entry = MemCache.entries.get(filename)
 
-    def make_event(event):
-        new_event = icalendar.Event()
-        new_event.add('summary', item['title'])
-        new_event.add('DTSTART', make_date_time(event,
-                                                'startdate',
-                                                'starttime'))
-        new_event.add('DTEND', make_date_time(event, 'enddate', 'endtime'))
-        new_event.add('description', item['description'])
-        new_event.add('category', item['refer'])
-        if item['label']:
-            new_event.add('labels', item['label'])
-        if item['refer']:
-            new_event.add('url',
-                          request.getQualifiedURL()+getEventURL(item['refer'],
-                                                                item['title'],
-                                                                item['hid']))
+        if entry and uid is not None and entry[0] == uid:
+            MemCache.uses += 1
+            MemCache.entries[filename] = (uid, entry[1], MemCache.uses)
+            return entry[1]
+    finally:
+        MemCache.lock.release()
 
-        """
-        if item['recur_freq']:
-            if item['recur_freq'] == -1:
-                recur_desc = 'last %s' % item['recur_type']
-                print "item['recur_freq'] 1" + str(item['recur_freq'])
-                print "item['recur_type'] 1" + str(item['recur_type'])
-                # print "item['recur_freq'] == -1 " + recur_desc
-            else:
-                recur_desc = 'every %d %s' % (item['recur_freq'], item['recur_type'])
-                print "item['recur_freq'] 2" + str(item['recur_freq'])
-                print "item['recur_type'] 1" + str(item['recur_type'])
-                # print 'ELSE: '+ recur_desc
-
-            if item['recur_until']:
-                recur_until = str(item['recur_until'])
-                new_event.add('RECUR', parameters={'UNTIL': str(item['recur_until']}))
-                recur_desc = '%s until %s' % (recur_desc, formatcfgdatetime(item['recur_until']))
-                # print "item['recur_until']" + str(item['recur_until'])
-                # print "item['recur_until'] "+ recur_desc
-
-        # eventitem['bgcolor'] = e_bgcolor
-        # eventitem['recur_freq'] = e_recur_freq
-        # eventitem['recur_type'] = e_recur_type
-        # eventitem['recur_until'] = e_recur_until
-        # new_event['uid'] = make_uid(event)
-        # new_event['DTSTAMP'] = formatcfgdatetime(event['startdate'], event['starttime'])
-        # new_event['status'] = 'NEEDS-ACTION'
-        # new_event.add('dtstamp', datetime.datetime(2018,1,24,0,10,0,tzinfo=pytz.utc))
-        """
-        cal.add_component(new_event)
-        return new_event
+    content = undumpcache(cache.content())
 
-    for item in events.values():
-        make_event(item)
-        # print '~~~ Item title: ', item['title']
+    if unpack:
+        content = unpack(content)
 
-        # eventitem['recur_freq'] = e_recur_freq
-        # eventitem['recur_type'] = e_recur_type
-        # eventitem['recur_until'] = e_recur_until
+    remembercache(filename, uid, content)
 
-    pagename = Globs.pagename
+    return content
 
-    attach_file = display(cal)
 
-    attach_dir = AttachFile.getAttachDir(request, pagename)
-    new_ics_file = AttachFile.add_attachment(request,
-                                             pagename,
-                                             'events.ics',
-                                             display(cal),
-                                             overwrite=1)
+def storecache(cache, content, pack=None, generation=''):
+    """ pickles (and packs) the content into a cache entry, remembering it in memory """
 
-    pass
+    if pack:
+        # packed contents are remembered when loaded: unpacking does not
+        # give back the same order of the events, and the views must not
+        # depend on which process built them
+        cache.update(dumpcache(pack(content), generation))
+        return
 
+    cache.update(dumpcache(content, generation))
 
-def showsimplecalendar():
+    remembercache(cache._filename(), cache.uid(), content)
 
-    request = Globs.request
-    formatter = Globs.formatter
-    form_vals = Globs.form_vals
 
-    html = []
+def dumpcache(content, generation=''):
+    """ returns the cache data of the content: a header line and the pickled content
 
-    if form_vals.has_key('caldate'):
-        try:
-            year, month, str_temp = getdatefield(form_vals['caldate'])
-        except (TypeError, ValueError):
-            errormsgcode('invalid_caldate')
-            year, month, dy = gettodaydate()
-    elif Params.curdate:
-        try:
-            year, month, str_temp = getdatefield(Params.curdate)
-        except (TypeError, ValueError):
-            errormsgcode('invalid_curdate')
-            year, month, dy = gettodaydate()
-    else:
-        year, month, dy = gettodaydate()
+    CacheEntry.update() replaces the cache file at once, so it is never read half written.
+    """
 
-    # check number of calendar
-    numcal = Params.numcal
+    return '%s %d %d %s\n%s' % (CACHE_MAGIC, EVENTSTORE_VERSION, PARSER_VERSION, generation or '-', pickle.dumps(content, PICKLE_PROTOCOL))
 
-    if form_vals.has_key('numcal'):
-        try:
-            numcal = int(form_vals['numcal'])
-        except (TypeError, ValueError):
-            errormsgcode('invalid_numcal')
 
+def undumpcache(data):
+    """ returns the content of cache data made by dumpcache(), raising caching.CacheError
+    if it was made by other versions of the event store or of the parser
+    """
 
-    if numcal < 1:
-        numcal = 1
-    elif numcal > 12:
-        numcal = 12
+    header, payload = data.split('\n', 1)
 
-    for index in range(numcal):
+    if not iscompatibleheader(parsecacheheader(header)):
+        raise caching.CacheError('incompatible cache format')
 
-        cyear, cmonth = yearmonthplusoffset(year, month, index)
+    return pickle.loads(payload)
 
-        cal_html = showsimpleeventcalendar(cyear, cmonth)
-        html.append(cal_html)
 
-    return u''.join(html)
+def parsecacheheader(header):
+    """ returns the event store version, parser version and source generation of a header line, None if it is invalid """
 
+    fields = header.split()
 
-def comp_cal_events(xid, yid):
-    """Sort events in cal_events by length of days of the event"""
+    if len(fields) != 4 or fields[0] != CACHE_MAGIC:
+        return None
 
-    events = Globs.events
+    try:
+        return int(fields[1]), int(fields[2]), fields[3]
+    except ValueError:
+        return None
 
-    if events[xid]['date_len'] > events[yid]['date_len']:
-        return -1
-    elif events[xid]['date_len'] == events[yid]['date_len']:
-        if events[xid]['date_len'] == 1:
-            if events[xid]['starttime'] == events[yid]['starttime']:
-                return cmp(events[yid]['time_len'], events[xid]['time_len'])
-            else:
-                return cmp(events[xid]['starttime'], events[yid]['starttime'])
-        else:
-            return 0
-    else:
-        return 1
 
+def iscompatibleheader(header):
 
-def comp_list_events(xid, yid):
-    """ Sort events in the list by start date of the event """
-    events = Globs.events
+    return header is not None and header[:2] == (EVENTSTORE_VERSION, PARSER_VERSION)
 
-    return cmp(events[xid]['startdate'], events[yid]['startdate'])
 
+def readcacheheader(cache):
+    """ returns the parsed header of a cache entry (see parsecacheheader()), reading only its first line """
 
-def loadEvents(datefrom='', dateto='', nocache=0):
-    """ load events from wiki pages """
+    try:
+        cachefile = open(cache._filename(), 'rb')
+        try:
+            header = cachefile.readline(256)
+        finally:
+            cachefile.close()
+    except IOError:
+        return None
 
-    request = Globs.request
+    return parsecacheheader(header)
 
-    debug('Loading event information.')
 
-    events = {}
-    labels = {}
-    cal_events = {}
-    raw_events = {}
+def remembercache(filename, uid, content):
 
-    raw_events, labels = loadEventsFromWikiPages()
+    if uid is None:
+        return
 
-    # handling cal_events
-    if datefrom or dateto:
+    MemCache.lock.acquire()
+    try:
+        MemCache.uses += 1
+        MemCache.entries[filename] = (uid, content, MemCache.uses)
 
-        # cache configurations
-        arena = Page(request, Globs.pagename)
-        eventkey = 'events'
-        filteredeventkey = 'events_%s-%s' % (datefrom, dateto)
-        caleventkey = 'calevents_%s-%s' % (datefrom, dateto)
+        if len(MemCache.entries) > Globs.memcache_maxentries:
+            lastuses = [(entry[2], key) for key, entry in MemCache.entries.items()]
+            lastuses.sort()
 
-        cache_events = caching.CacheEntry(request, arena, eventkey,scope='item')
-        cache_filteredevents = caching.CacheEntry(request, arena, filteredeventkey,scope='item')
-        cache_calevents = caching.CacheEntry(request, arena, caleventkey,scope='item')
+            for lastuse, key in lastuses[:len(MemCache.entries) - Globs.memcache_maxentries]:
+                del MemCache.entries[key]
+    finally:
+        MemCache.lock.release()
 
-        dirty = 1
 
-        debug('Checking cal_events cache')
+def packevents(events):
+    """ returns events in a picklable form: (records, occurrences)
 
-        if not (cache_calevents.needsUpdate(cache_events._filename()) or cache_filteredevents.needsUpdate(cache_events._filename())):
+    records maps ids to packed EventRecords, occurrences maps recurrence ids to
+    (packed master, startday, endday); pickle stores each master only once.
+    """
 
-            try:
-                events = pickle.loads(cache_filteredevents.content())
-                cal_events = pickle.loads(cache_calevents.content())
-                debug('Cached event (filtered) information is used: total %d events' % len(events))
-                dirty = 0
-            except (pickle.UnpicklingError, IOError, EOFError, ValueError):
-                debug('Picke error at fetching cached events (filtered)')
-                events = {}
-                cal_events = {}
+    records = {}
+    occurrences = {}
+    packed_masters = {}
 
+    for e_id, event in events.items():
+        if isinstance(event, EventOccurrence):
+            master = event.master
+            if not packed_masters.has_key(master.id):
+                packed_masters[master.id] = master.pack()
+            occurrences[e_id] = (packed_masters[master.id], event.startday, event.endday)
+        else:
+            if not packed_masters.has_key(e_id):
+                packed_masters[e_id] = event.pack()
+            records[e_id] = packed_masters[e_id]
 
-        # if cache is dirty, update the cache
-        if dirty:
+    return records, occurrences
 
-            debug('Checking event cache: it\'s dirty or requested to refresh')
-            debug('Building new cal_event information')
 
-            try:
-                datefrom, dateto = int(datefrom), int(dateto)
-            except (TypeError, ValueError):
-                datefrom, dateto = 0, 0
+def unpackevents(packed):
+    """ reverse of packevents() """
 
-            clone_num = 0
+    events = {}
 
-            for e_id in raw_events.keys():
+    records, occurrences = packed
+    masters = {}
 
-                cur_event = raw_events[e_id]
+    for e_id, record in records.items():
+        events[e_id] = masters[e_id] = EventRecord.unpack(record)
 
-                # handling event recurrence
-                recur_freq = cur_event['recur_freq']
+    for e_id, (record, startday, endday) in occurrences.items():
+        master_id = record[0]
+        if not masters.has_key(master_id):
+            masters[master_id] = EventRecord.unpack(record)
+        events[e_id] = EventOccurrence(e_id, masters[master_id], startday, endday)
 
-                if recur_freq or recur_freq == -1:
+    return events
 
-                    if not (cur_event['recur_until'] and int(cur_event['recur_until']) < datefrom) or int(cur_event['startdate']) > dateto:
 
-                        if not (int(cur_event['enddate']) < datefrom or int(cur_event['startdate']) > dateto):
-                            # generating cal_events for iteself
-                            events[e_id] = cur_event.copy()
-                            insertcalevents(cal_events, datefrom, dateto, e_id, cur_event['startdate'], cur_event['enddate'])
+def packeventrecords(eventrecords):
+    """ returns a list of EventRecords in a picklable form """
 
-                        delta_date_len = datetime.timedelta(days = int(cur_event['date_len']) - 1 )
+    return [event.pack() for event in eventrecords]
 
-                        if cur_event['recur_type'] == 'day':
 
-                            day_delta = int(recur_freq)
-                            startdate = getdatetimefromstring(cur_event['startdate'])
-                            datefrom_date = getdatetimefromstring(datefrom)
+def unpackeventrecords(packed):
+    """ reverse of packeventrecords() """
 
-                            if int(datefrom) > int(cur_event['startdate']):
-                                diffs = datefrom_date - startdate
-                                q_delta = diffs.days / day_delta
-                                if diffs.days % day_delta > 0:
-                                    q_delta += 1
-                            else:
-                                q_delta = 1
+    return [EventRecord.unpack(event) for event in packed]
 
-                            while 1:
 
-                                if q_delta == 0:
-                                    q_delta += 1
-                                    continue
+def geteventstore():
+    """ returns the cache arena (scope 'wiki') of the events of Params.category
 
-                                recurred_startdate = startdate + datetime.timedelta(days = q_delta * day_delta )
-                                recurred_enddate = recurred_startdate + delta_date_len
+    The calendar pages of a category and the icalendar feed share it.
+    """
 
-                                new_startdate = formatdateobject(recurred_startdate)
-                                new_enddate = formatdateobject(recurred_enddate)
+    return 'eventcalendar_%s_v%d' % (wikiutil.quoteWikinameFS(Params.category), EVENTSTORE_VERSION)
 
-                                if int(new_startdate) > dateto or (cur_event['recur_until'] and int(cur_event['recur_until']) < int(new_startdate)):
-                                    break
 
-                                clone_num += 1
-                                clone_id = 'c%d' % clone_num
+def loadPageRecords(pages):
+    """ returns the event records, label records and error messages of each event page,
+    and whether the page had to be parsed, in the order of the pages
 
-                                events[clone_id] = cur_event.copy()
-                                events[clone_id]['id'] = clone_id
-                                events[clone_id]['startdate'] = new_startdate
-                                events[clone_id]['enddate'] = new_enddate
-                                events[clone_id]['clone'] = 1
+    The parsed records are cached by a hash of the page name and its raw body
+    (the records depend on both), so a page saved or restored without change
+    is not parsed again. The hashes of the last Globs.recordcache_revisions
+    revisions are remembered with the page, and the newest one is trusted
+    as long as the page file is not modified.
+    """
 
-                                insertcalevents(cal_events, datefrom, dateto, clone_id, new_startdate, new_enddate)
+    request = Globs.request
 
-                                q_delta += 1
+    arena = 'eventcalendar_records_v%d' % PARSER_VERSION
 
-                        elif cur_event['recur_type'] == 'week':
+    pagerecords = []
+    unparsed = []
 
-                            day_delta = int(recur_freq) * 7
+    for page in pages:
 
-                            startdate = getdatetimefromstring(cur_event['startdate'])
-                            datefrom_date = getdatetimefromstring(datefrom)
+        cache_hashes = caching.CacheEntry(request, page, 'eventcalhashes', scope='item')
 
-                            if int(datefrom) > int(cur_event['startdate']):
-                                diffs = datefrom_date - startdate
-                                q_delta = diffs.days / day_delta
-                                if diffs.days % day_delta > 0:
-                                    q_delta += 1
-                            else:
-                                q_delta = 1
+        try:
+            hashes = undumpcache(cache_hashes.content())
+        except (pickle.UnpicklingError, IOError, EOFError, ValueError, TypeError, caching.CacheError):
+            hashes = []
+
+            # the records cached by the former versions
+            for key in ['eventrecords', 'labelrecords', 'eventcalerrormsg']:
+                caching.CacheEntry(request, page, key, scope='item').remove()
 
-                            while 1:
+        pagecontent = None
 
-                                if q_delta == 0:
-                                    q_delta += 1
-                                    continue
+        if hashes and not cache_hashes.needsUpdate(page._text_filename()):
+            pagehash = hashes[0]
+        else:
+            pagecontent = page.get_raw_body()
+            pagehash = sha.new((u'%s\n%s' % (page.page_name, pagecontent)).encode('utf-8')).hexdigest()
 
-                                recurred_startdate = startdate + datetime.timedelta(days = q_delta * day_delta )
-                                recurred_enddate = recurred_startdate + delta_date_len
+            # the hash is renewed for the current page file
+            newhashes = [pagehash] + [oldhash for oldhash in hashes if oldhash != pagehash]
 
-                                new_startdate = formatdateobject(recurred_startdate)
-                                new_enddate = formatdateobject(recurred_enddate)
+            for oldhash in newhashes[Globs.recordcache_revisions:]:
+                caching.CacheEntry(request, arena, oldhash, scope='wiki').remove()
 
-                                if int(new_startdate) > dateto or (cur_event['recur_until'] and int(cur_event['recur_until']) < int(new_startdate)):
-                                    break
+            cache_hashes.update(dumpcache(newhashes[:Globs.recordcache_revisions]))
 
-                                clone_num += 1
-                                clone_id = 'c%d' % clone_num
+        cache_records = caching.CacheEntry(request, arena, pagehash, scope='wiki')
+        cached = 0
 
-                                events[clone_id] = cur_event.copy()
-                                events[clone_id]['id'] = clone_id
-                                events[clone_id]['startdate'] = new_startdate
-                                events[clone_id]['enddate'] = new_enddate
-                                events[clone_id]['clone'] = 1
+        if not Globs.page_action == 'refresh':
+            try:
+                packedrecords, labelrecords, errmsg = undumpcache(cache_records.content())
+                pagerecords.append((unpackeventrecords(packedrecords), labelrecords, errmsg, 0))
+                cached = 1
+            except (pickle.UnpicklingError, IOError, EOFError, ValueError, KeyError, TypeError, caching.CacheError):
+                cached = 0
 
-                                insertcalevents(cal_events, datefrom, dateto, clone_id, new_startdate, new_enddate)
+        if not cached:
+            if pagecontent is None:
+                pagecontent = page.get_raw_body()
 
-                                q_delta += 1
+            pagerecords.append(None)
+            unparsed.append((len(pagerecords) - 1, cache_records, (page.page_name, pagecontent)))
 
+    parsedrecords = parsepages([item[2] for item in unparsed])
 
-                        elif cur_event['recur_type'] == 'weekday':
+    for (index, cache_records, item), (packedrecords, labelrecords, errmsg) in zip(unparsed, parsedrecords):
+        cache_records.update(dumpcache((packedrecords, labelrecords, errmsg)))
+        pagerecords[index] = (unpackeventrecords(packedrecords), labelrecords, errmsg, 1)
 
-                            syear, smonth, sday = getdatefield(cur_event['startdate'])
-                            cyear, cmonth, cday = getdatefield(str(datefrom))
+    return pagerecords
 
-                            recur_weekday = calendar.weekday(syear, smonth, sday)
 
-                            while 1:
+def parsepages(items):
+    """ parses the (page name, page content) items, returns their packed event records,
+    label records and error messages in the same order
 
-                                firstweekday, daysinmonth = calendar.monthrange(cyear, cmonth)
-                                firstmatch = (recur_weekday - firstweekday) % 7 + 1
+    With Globs.parse_processes > 1 and at least Globs.parse_minpages pages, the pages
+    are parsed by a pool of processes; otherwise, or if the pool fails, one by one.
+    """
 
-                                if recur_freq == -1:
-                                    therecur_day = xrange(firstmatch, daysinmonth + 1, 7)[-1]
-                                else:
-                                    #XXX should handle error
-                                    try:
-                                        therecur_day = xrange(firstmatch, daysinmonth + 1, 7)[recur_freq-1]
-                                    except IndexError:
-                                        if Params.showlastweekday:
-                                            # if no matched weekday, the last weekday will be displayed
-                                            therecur_day = xrange(firstmatch, daysinmonth + 1, 7)[-1]
-                                        else:
-                                            # if no matched weekday, no event will be displayed
-                                            cyear, cmonth = yearmonthplusoffset(cyear, cmonth, 1)
-                                            continue
+    if Globs.parse_processes > 1 and len(items) >= Globs.parse_minpages:
+        try:
+            import multiprocessing
 
+            pool = multiprocessing.Pool(Globs.parse_processes)
+            try:
+                parsedrecords = pool.map(parsepage, items)
+            finally:
+                pool.terminate()
+                pool.join()
 
-                                recurred_startdate = datetime.date(cyear, cmonth, therecur_day)
-                                recurred_enddate = recurred_startdate + delta_date_len
+            debug('%d pages are parsed by %d processes' % (len(items), Globs.parse_processes))
 
-                                new_startdate = formatdateobject(recurred_startdate)
-                                new_enddate = formatdateobject(recurred_enddate)
+            return parsedrecords
 
-                                if int(new_startdate) < int(datefrom) or new_startdate == cur_event['startdate']:
-                                    cyear, cmonth = yearmonthplusoffset(cyear, cmonth, 1)
-                                    continue
+        # e.g. processes can not be started by a daemonic process
+        except (ImportError, OSError, AssertionError, pickle.PicklingError), err:
+            debug('Failed to parse the pages in parallel: %s' % err)
 
-                                if int(new_startdate) > dateto or (cur_event['recur_until'] and int(cur_event['recur_until']) < int(new_startdate)):
-                                    break
+    stored_errmsg = Globs.errormsg
 
-                                clone_num += 1
-                                clone_id = 'c%d' % clone_num
+    parsedrecords = map(parsepage, items)
 
-                                events[clone_id] = cur_event.copy()
-                                events[clone_id]['id'] = clone_id
-                                events[clone_id]['startdate'] = new_startdate
-                                events[clone_id]['enddate'] = new_enddate
-                                events[clone_id]['clone'] = 1
+    Globs.errormsg = stored_errmsg
 
-                                insertcalevents(cal_events, datefrom, dateto, clone_id, new_startdate, new_enddate)
+    return parsedrecords
 
-                                cyear, cmonth = yearmonthplusoffset(cyear, cmonth, 1)
 
+def parsepage(item):
+    """ parses one page for parsepages(), also in a worker process """
 
-                        elif cur_event['recur_type'] == 'month':
+    pagename, pagecontent = item
 
-                            cyear, cmonth, therecurday = getdatefield(cur_event['startdate'])
+    Globs.errormsg = ''
 
-                            while 1:
+    eventrecords, labelrecords = getEventRecordFromPage(pagecontent, pagename)
 
-                                cyear, cmonth = yearmonthplusoffset(cyear, cmonth, recur_freq)
-                                firstweekday, daysinmonth = calendar.monthrange(cyear, cmonth)
-                                recur_day = therecurday
-                                if daysinmonth < recur_day:
-                                    recur_day = daysinmonth
-                                new_startdate = formatDate(cyear, cmonth, recur_day)
+    return packeventrecords(eventrecords), labelrecords, Globs.errormsg
 
-                                if int(new_startdate) < int(datefrom):
-                                    continue
 
-                                recurred_startdate = datetime.date(cyear, cmonth, recur_day)
-                                recurred_enddate = recurred_startdate + delta_date_len
+def loadPageList(cache_pages, category):
+    """ returns the pages of the category, the cached pages, and the page list to store
+    with the events (None if it did not change)
 
-                                new_startdate = formatdateobject(recurred_startdate)
-                                new_enddate = formatdateobject(recurred_enddate)
+    The page list cache holds the pages of the category and the position in the
+    edit-log up to which they are known, so that only the pages changed since
+    then are searched again.
+    """
 
-                                if int(new_startdate) > dateto or (cur_event['recur_until'] and int(cur_event['recur_until']) < int(new_startdate)):
-                                    break
+    request = Globs.request
 
-                                clone_num += 1
-                                clone_id = 'c%d' % clone_num
+    debug('Checking page list cache')
 
-                                events[clone_id] = cur_event.copy()
-                                events[clone_id]['id'] = clone_id
-                                events[clone_id]['startdate'] = new_startdate
-                                events[clone_id]['enddate'] = new_enddate
-                                events[clone_id]['clone'] = 1
+    log = editlog.EditLog(request)
+    position = -1
+    cachedpages = []
+    pagelist = None
 
-                                insertcalevents(cal_events, datefrom, dateto, clone_id, new_startdate, new_enddate)
+    if not Globs.page_action == 'refresh':
+        try:
+            position, cachedpages = loadcache(cache_pages)
+        except (pickle.UnpicklingError, IOError, EOFError, ValueError, TypeError, caching.CacheError):
+            position = -1
 
-                        elif cur_event['recur_type'] == 'year':
+    logsize = log.size()
 
-                            ryear, rmonth, rday = getdatefield(cur_event['startdate'])
-                            cyear, cmonth, cday = getdatefield(str(datefrom))
+    if position < 0 or position > logsize:
+        # the changes of the pages before the current end of the edit-log
+        # are found by the search
+        position = logsize
 
-                            while 1:
+        categorypages = searchPages(request, category)
+        eventpages = [page.page_name for page in categorypages]
 
-                                ryear += recur_freq
-                                new_startdate = formatDate(ryear, rmonth, rday)
+        pagelist = (position, eventpages)
+        debug('New page list is built: %d pages' % len(eventpages))
 
-                                if int(new_startdate) < int(datefrom):
-                                    continue
+    else:
+        position, changedpages = getpagechanges(log, position)
 
-                                if int(new_startdate) > dateto or (cur_event['recur_until'] and int(cur_event['recur_until']) < int(new_startdate)):
-                                    break
+        if changedpages:
+            eventpages = updatePageList(request, category, cachedpages, changedpages)
+            pagelist = (position, eventpages)
+            debug('Page list is updated with %d changed pages: %d pages' % (len(changedpages), len(eventpages)))
+        else:
+            eventpages = cachedpages
+            debug('Cached page list is used: %d pages' % len(eventpages))
 
-                                recurred_startdate = datetime.date(ryear, rmonth, rday)
-                                recurred_enddate = recurred_startdate + delta_date_len
+    return eventpages, cachedpages, pagelist
 
-                                new_startdate = formatdateobject(recurred_startdate)
-                                new_enddate = formatdateobject(recurred_enddate)
 
-                                clone_num += 1
-                                clone_id = 'c%d' % clone_num
+def loadEventCache(cache_events, cache_labels, cache_errmsglist):
+    """ returns the cached events, labels and error messages, None if they can not be read """
 
-                                events[clone_id] = cur_event.copy()
-                                events[clone_id]['id'] = clone_id
-                                events[clone_id]['startdate'] = new_startdate
-                                events[clone_id]['enddate'] = new_enddate
-                                events[clone_id]['clone'] = 1
+    try:
+        return loadcache(cache_events, unpackevents), loadcache(cache_labels), loadcache(cache_errmsglist)
+    except (pickle.UnpicklingError, IOError, EOFError, ValueError, KeyError, IndexError, TypeError, caching.CacheError):
+        debug('Picke error at fetching cached events')
+        return None
 
-                                insertcalevents(cal_events, datefrom, dateto, clone_id, new_startdate, new_enddate)
 
-                else:
+def lockrebuild(arena, cache_events, generation):
+    """ locks the rebuild of the events across processes
 
-                    if not (int(cur_event['enddate']) < datefrom or int(cur_event['startdate']) > dateto):
-                        events[e_id] = cur_event.copy()
-                        insertcalevents(cal_events, datefrom, dateto, e_id, cur_event['startdate'], cur_event['enddate'])
+    Returns the acquired lock (or None), and whether the events are to be
+    rebuilt: not when another request rebuilt them at the same change
+    generation while this one waited for the lock (a rebuild started before
+    may miss the changes this request has seen), nor when the lock is still held after Globs.rebuild_wait seconds
+    and the previous version of the events can be used (but by the
+    EventCalendarRebuild action, which then rebuilds them without the lock).
+    """
 
+    request = Globs.request
 
-            # sort cal_events
-            # store event list into global variables in order to sort them
-            Globs.events = events
+    lockdir = os.path.join(caching.get_arena_dir(request, arena, 'wiki'), '__rebuild__')
+    rebuildlock = lock.ExclusiveLock(lockdir, Globs.rebuild_locktimeout)
 
-            for eachdate in cal_events.keys():
-                cal_events[eachdate].sort(comp_cal_events)
+    eventsmtime = cache_events.mtime()
 
-            # cache update
-            if not nocache:
-                cache_filteredevents.update(pickle.dumps(events, PICKLE_PROTOCOL))
-                cache_calevents.update(pickle.dumps(cal_events, PICKLE_PROTOCOL))
+    if rebuildlock.acquire(Globs.rebuild_wait):
+        if eventsmtime and cache_events.mtime() != eventsmtime and not Globs.page_action == 'refresh':
+            header = readcacheheader(cache_events)
 
-    else:
-        events = raw_events
+            if generation and iscompatibleheader(header) and header[2] == generation:
+                rebuildlock.release()
+                debug('Events are rebuilt by another request')
+                return None, 0
 
-        # store event list into global variables in order to sort them
-        Globs.events = events
+            debug('Events are rebuilt by another request before the last changes')
 
-    Globs.labels = labels
+        return rebuildlock, 1
 
-    debug(u'Total %d events are loaded finally.' % len(events))
-    debug(u'Total %d labels are loaded finally.' % len(labels))
+    # the EventCalendarRebuild action does not give up, as it is called to rebuild the stale events
+    if eventsmtime and not Globs.page_action == 'rebuild' and iscompatibleheader(readcacheheader(cache_events)):
+        debug('Events are being rebuilt by another request: the previous version is used')
+        return None, 0
 
-    return events, cal_events, labels
+    return None, 1
 
 
 def loadEventsFromWikiPages():
 
     events = {}
     labels = {}
-    cached_event_loaded = 0
     dirty = 0
+    cache_mtime = 0
+    stalesince = 0
 
     eventrecord_list = []
     labelrecord_list = []
     eventpages = []
+    pagelist = None
     stored_errmsg = ''
 
     request = Globs.request
     category = Params.category
 
-    # cache configurations
-    arena = Page(request, Globs.pagename)
+    # cache configurations: the event store of the category
+    arena = geteventstore()
 
     eventkey = 'events'
     labelkey = 'labels'
     pagelistkey = 'eventpages'
     errmsglistkey = 'eventcalerrormsglist'
+    generationkey = 'eventsgeneration'
+
+    cache_events = caching.CacheEntry(request, arena, eventkey, scope='wiki')
+    cache_labels = caching.CacheEntry(request, arena, labelkey, scope='wiki')
+    cache_pages = caching.CacheEntry(request, arena, pagelistkey, scope='wiki')
+    cache_errmsglist = caching.CacheEntry(request, arena, errmsglistkey, scope='wiki')
+    cache_generation = caching.CacheEntry(request, arena, generationkey, scope='wiki')
+
+    # change generation of the wiki: when it is the one the event cache was
+    # validated with, no page was saved, renamed or deleted since then and the
+    # page list and page by page checks below are skipped
+    generation = getchangegeneration(request)
+    cachedgeneration = ''
+    unchanged = 0
+
+    # events of other versions of the event store or the parser are rebuilt
+    eventsheader = readcacheheader(cache_events)
+    compatible = iscompatibleheader(eventsheader)
+
+    if not Globs.page_action == 'refresh' and generation and compatible:
+        try:
+            cachedgeneration = cache_generation.content()
+        except caching.CacheError:
+            cachedgeneration = ''
 
-    cache_events = caching.CacheEntry(request, arena, eventkey,scope='item')
-    cache_labels = caching.CacheEntry(request, arena, labelkey,scope='item')
-    cache_pages = caching.CacheEntry(request, arena, pagelistkey,scope='item')
-    cache_errmsglist = caching.CacheEntry(request, arena, errmsglistkey,scope='item')
+        # attachments may have changed since, e.g. the events.ics of the calendar pages
+        unchanged = cachedgeneration == generation or onlyattachmentchanges(request, cachedgeneration)
 
-    # page list cache
+    if unchanged:
+        debug('No change in the wiki since the event cache was validated')
 
-    debug('Checking page list cache')
+    else:
+        # the page list is stored with the events below
+        eventpages, cachedpages, pagelist = loadPageList(cache_pages, category)
 
-    # check the time at which page list cache has been created
+        # the events of the pages which left the category must go
+        if set(eventpages) != set(cachedpages):
+            dirty = 1
 
-    cp_mtime = cache_pages.mtime()
-    timedelta_days = 9999
+        if not Globs.page_action == 'refresh':
+            # check the cache validity: no page may be newer than the oldest of the caches
+            cache_mtime = min(cache_events.mtime(), cache_labels.mtime(), cache_errmsglist.mtime())
 
-    if cp_mtime:
-        cp_date = datetime.datetime.fromtimestamp(cp_mtime)
-        today = datetime.datetime.fromtimestamp(time.time())
-        datediff = today - cp_date
-        timedelta_days = datediff.days
-        debug('Time from page list cache built = %s' % datediff)
+            if not cache_mtime or not compatible:
+                dirty = 1
 
+            for page_name in eventpages:
 
-    if Globs.page_action == 'refresh' or cache_pages.needsUpdate(arena._text_filename()) or timedelta_days >= 1:
-        categorypages = searchPages(request, category)
-        for page in categorypages:
-            eventpages.append(page.page_name)
-        cache_pages.update('\n'.join(eventpages).encode('utf-8'))
-        debug('New page list is built: %d pages' % len(eventpages))
-    else:
-        eventpages = cache_pages.content().decode('utf-8').split('\n')
-        debug('Cached page list is used: %d pages' % len(eventpages))
+                if dirty:
+                    break
 
-    if not Globs.page_action == 'refresh':
-        # check the cache validity
-        for page_name in eventpages:
+                p = Page(request, page_name)
 
-            p = Page(request, page_name)
-            e_ref = page_name
+                try:
+                    stalesince = os.path.getmtime(p._text_filename())
+                    dirty = stalesince > cache_mtime
+                except os.error:
+                    dirty = 1
+        else:
+            dirty = 1
 
-            if cache_events.needsUpdate(p._text_filename()) or cache_labels.needsUpdate(p._text_filename()) or cache_errmsglist.needsUpdate(p._text_filename()):
-                dirty = 1
-                break
-    else:
-        dirty = 1
+    rebuildlock = None
+    validated = 1
 
-    if dirty:
-        # generating events
+    # the previous events may be used for Globs.stale_maxage seconds after
+    # the change, until the EventCalendarRebuild action rebuilds them
+    if dirty and Globs.stale_maxage and cache_mtime and compatible and not Globs.page_action in ['refresh', 'rebuild']:
+        staleage = time.time() - max(stalesince, cache_mtime)
+
+        if staleage <= Globs.stale_maxage:
+            debug('Events are stale for %d seconds: the previous version is used' % staleage)
+            dirty = 0
+            validated = 0
+
+    # the cached events are used while they are valid; unreadable ones are rebuilt
+    if not dirty:
+        debug('Checking event cache: still valid')
 
-        dirty_local = 0
-        debug_records = {}
+        cachedevents = loadEventCache(cache_events, cache_labels, cache_errmsglist)
 
-        eventrecordkey = 'eventrecords'
-        labelrecordkey = 'labelrecords'
-        errmsgkey = 'eventcalerrormsg'
+        if cachedevents is None:
+            dirty = 1
+            validated = 1
 
-        # fetch event records from each page in the category
-        for page_name in eventpages:
+            # the page list was not needed so far
+            if unchanged:
+                eventpages, cachedpages, pagelist = loadPageList(cache_pages, category)
 
-            p = Page(request, page_name)
-            e_ref = page_name
+    # one request rebuilds the events at a time; the others wait for it,
+    # or meanwhile use the previous version
+    if dirty:
+        rebuildlock, dirty = lockrebuild(arena, cache_events, generation)
+        validated = dirty
 
+        if not dirty:
+            cachedevents = loadEventCache(cache_events, cache_labels, cache_errmsglist)
 
-            cache_errmsg = caching.CacheEntry(request, p, errmsgkey,scope='item')
-            cache_eventrecords = caching.CacheEntry(request, p, eventrecordkey,scope='item')
-            cache_labelrecords = caching.CacheEntry(request, p, labelrecordkey,scope='item')
+            # there is no version to use meanwhile: rebuilt without the lock
+            if cachedevents is None:
+                dirty = 1
+                validated = 1
 
-            if cache_eventrecords.needsUpdate(p._text_filename()) or cache_labelrecords.needsUpdate(p._text_filename()) or Globs.page_action == 'refresh':
-                page_content = p.get_raw_body()
-                eventrecords, labelrecords = getEventRecordFromPage(page_content, e_ref)
+    if dirty:
+        # the lock is released also when the rebuild fails; it expires after
+        # Globs.rebuild_locktimeout only if the process dies
+        try:
+            # generating events
 
-                debug_records[e_ref] = '%d events are fetched from %s' % (len(eventrecords), e_ref)
+            debug('Checking event cache: it\'s dirty or requested to refresh')
 
-                # XXXXX
-                #debug('events: %s' % eventrecords)
-                #debug('labels: %s' % labelrecords)
+            debug_records = {}
 
-                cache_eventrecords.update(pickle.dumps(eventrecords, PICKLE_PROTOCOL))
-                cache_labelrecords.update(pickle.dumps(labelrecords, PICKLE_PROTOCOL))
-                cache_errmsg.update(pickle.dumps(Globs.errormsg, PICKLE_PROTOCOL))
+            # fetch event records from each page in the category
+            pagerecords = loadPageRecords([Page(request, page_name) for page_name in eventpages])
 
-                stored_errmsg += Globs.errormsg
-                Globs.errormsg = ''
+            for page_name, (eventrecords, labelrecords, page_errmsg, parsed) in zip(eventpages, pagerecords):
 
-            else:
-                try:
-                    eventrecords = pickle.loads(cache_eventrecords.content())
-                    labelrecords = pickle.loads(cache_labelrecords.content())
-                    Globs.errormsg = pickle.loads(cache_errmsg.content())
+                e_ref = page_name
 
+                if parsed:
+                    debug_records[e_ref] = '%d events are fetched from %s' % (len(eventrecords), e_ref)
+                else:
                     debug_records[e_ref] = '%d cached eventrecords are used from %s' % (len(eventrecords), e_ref)
 
-                except (pickle.UnpicklingError, IOError, EOFError, ValueError):
-                    dirty = 1
-                    page_content = p.get_raw_body()
-                    eventrecords, labelrecords = getEventRecordFromPage(page_content, e_ref)
-                    debug_records[e_ref] = '%d eventrecords are fetched from %s due to pickle error' % (len(eventrecords), e_ref)
+                eventrecord_list.append(eventrecords)
+                labelrecord_list.append(labelrecords)
+
+                stored_errmsg += page_errmsg
+
+            # XXX: just for debugging
+            debug('Building new event information')
+            for page_name in eventpages:
+                debug(debug_records[page_name])
 
-                    cache_eventrecords.update(pickle.dumps(eventrecords, PICKLE_PROTOCOL))
-                    cache_labelrecords.update(pickle.dumps(labelrecords, PICKLE_PROTOCOL))
-                    cache_errmsg.update(pickle.dumps(Globs.errormsg, PICKLE_PROTOCOL))
+            for eventrecords in eventrecord_list:
+                for evtrecord in eventrecords:
+                    events[evtrecord.id] = evtrecord
 
-            eventrecord_list.append(eventrecords)
-            labelrecord_list.append(labelrecords)
+            for labelrecords in labelrecord_list:
+                for label in labelrecords:
+                    c_id = label['name']
+                    if not labels.has_key(c_id):
+                        labels[c_id] = label
+                    else:
+                        stored_errmsg += u'<li>%s\n' % geterrormsg('redefined_label', label['refer'], label['name'])
+
+            # after generating updated events, update the cache
+            storecache(cache_events, events, packevents, generation)
+            storecache(cache_labels, labels)
+            storecache(cache_errmsglist, stored_errmsg)
 
-            stored_errmsg += Globs.errormsg
-            Globs.errormsg = ''
+            debug('Event information is newly built: total %d events' % len(events))
 
-        debug('Checking event cache: it\'s dirty or requested to refresh')
+        finally:
+            if rebuildlock:
+                rebuildlock.release()
 
     else:
+        events, labels, stored_errmsg = cachedevents
 
-        debug('Checking event cache: still valid')
+        debug('Cached event information is used: total %d events' % len(events))
 
-        try:
-            events = pickle.loads(cache_events.content())
-            labels = pickle.loads(cache_labels.content())
-            stored_errmsg = pickle.loads(cache_errmsglist.content())
+        if eventsheader:
+            debug('Event cache of store version %d, parser version %d, generation %s' % eventsheader)
 
-            cached_event_loaded = 1
+    # the page list is stored only with the events validated against it, so
+    # that the pages which left the category are noticed until the events are
+    # rebuilt, also when the previous events are used meanwhile
+    if pagelist and validated:
+        storecache(cache_pages, pagelist)
 
-            debug('Cached event information is used: total %d events' % len(events))
+    # the caches are up to date with this generation now
+    if generation and generation != cachedgeneration and validated:
+        cache_generation.update(generation)
 
-        except (pickle.UnpicklingError, IOError, EOFError, ValueError):
-            events = {}
-            labels = {}
-            stored_errmsg = ''
+    Globs.errormsg = stored_errmsg
+    Globs.eventversion = cache_events.mtime()
 
-            debug('Picke error at fetching cached events')
+    debug('Event snapshot is %d seconds old' % (time.time() - Globs.eventversion))
 
-    # if it needs refreshed, generate events dictionary
-    if not cached_event_loaded:
+    # end of updating events block
 
-        # XXX: just for debugging
-        debug('Building new event information')
-        for page_name in eventpages:
-            debug(debug_records[page_name])
+    return events, labels
 
-        for eventrecords in eventrecord_list:
-            for evtrecord in eventrecords:
-                e_id = evtrecord['id']
-                events[e_id] = evtrecord
 
-        for labelrecords in labelrecord_list:
-            for label in labelrecords:
-                c_id = label['name']
-                if not labels.has_key(c_id):
-                    labels[c_id] = label
-                else:
-                    stored_errmsg += u'<li>%s\n' % geterrormsg('redefined_label', label['refer'], label['name'])
+def tokenizeeventpage(pagecontent):
+    """ Splits an event page into headings, fields and page defaults in one pass over its lines
 
-        # after generating updated events, update the cache
-        cache_events.update(pickle.dumps(events, PICKLE_PROTOCOL))
-        cache_labels.update(pickle.dumps(labels, PICKLE_PROTOCOL))
-        cache_errmsglist.update(pickle.dumps(stored_errmsg, PICKLE_PROTOCOL))
+    Returns (pagefields, labeldefs, eventitems):
+        pagefields: default_bgcolor/default_description -> offset of their first line
+        labeldefs: offsets of the label_def lines
+        eventitems: (eventtitle, detailstart, detailend, fields) for each heading, where fields
+                    maps start/end/bgcolor/description/recur/label -> offset of their first
+                    line in the event detail
 
-        debug('Event information is newly built: total %d events' % len(events))
+    The values themselves are left to the field patterns, matched at those offsets.
+    """
 
-    Globs.errormsg = stored_errmsg
+    pattern_heading = EventPageParser.pattern_heading
+    pattern_fieldline = EventPageParser.pattern_fieldline
 
-    # end of updating events block
+    pagefields = {}
+    labeldefs = []
+    eventitems = []
 
-    return events, labels
+    eventtitle = None
+    detailstart = 0
+    fields = {}
+
+    contentlen = len(pagecontent)
+    pos = 0
+    blankstart = -1
+
+    while pos < contentlen:
+        lineend = pagecontent.find(u'\n', pos)
+        if lineend < 0:
+            lineend = contentlen
+
+        line = pagecontent[pos:lineend].lstrip()
+
+        if not line:
+            # blank lines in front of a heading belong to the heading
+            if blankstart < 0 and pos >= detailstart:
+                blankstart = pos
+
+        elif line[0] == u'=' and pos >= detailstart:
+            if blankstart < 0:
+                headingstart = pos
+            else:
+                headingstart = blankstart
+
+            match = pattern_heading.match(pagecontent, headingstart)
+
+            if match:
+                if eventtitle is not None:
+                    eventitems.append((eventtitle, detailstart, headingstart, fields))
+
+                # the title may span lines, those only count for page fields
+                eventtitle = match.group('eventtitle')
+                detailstart = match.end()
+                fields = {}
+
+            blankstart = -1
+
+        else:
+            blankstart = -1
+
+            if pagecontent[pos] == u' ':
+                match = pattern_fieldline.match(pagecontent, pos, lineend)
+
+                if match:
+                    field = match.group('field').lower()
+
+                    if field == 'label_def':
+                        labeldefs.append(pos)
+                    elif field.startswith('default_'):
+                        if not pagefields.has_key(field):
+                            pagefields[field] = pos
+                    elif eventtitle is not None and pos >= detailstart and not fields.has_key(field):
+                        fields[field] = pos
+
+        pos = lineend + 1
+
+    if eventtitle is not None:
+        eventitems.append((eventtitle, detailstart, contentlen, fields))
+
+    return pagefields, labeldefs, eventitems
 
 
 def getEventRecordFromPage(pagecontent, referpage):
@@ -1687,20 +2980,12 @@ def getEventRecordFromPage(pagecontent, referpage):
 
     e_num = 0
 
-    # fetch the page default bgcolor
-    regex_page_bgcolor = r"""
-(?P<req_field>^[ ]+default_bgcolor::[ ]+)
-(
-    (?P<pagebgcolor>\#[0-9a-fA-F]{6})
-    \s*?
-    $
-)?
-"""
+    pagefields, labeldefs, eventitems = tokenizeeventpage(pagecontent)
 
-    pattern = re.compile(regex_page_bgcolor, re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE)
-    match = pattern.search(pagecontent)
+    # fetch the page default bgcolor
+    if pagefields.has_key('default_bgcolor'):
+        match = EventPageParser.pattern_page_bgcolor.match(pagecontent, pagefields['default_bgcolor'])
 
-    if match:
         if match.group('pagebgcolor'):
             page_bgcolor = match.group('pagebgcolor')
         else:
@@ -1708,48 +2993,25 @@ def getEventRecordFromPage(pagecontent, referpage):
 
 
     # fetch the page default description
-    regex_page_description = r"""
-(?P<req_field>^[ ]+default_description::[ ]+)
-(
-    (?P<pagedescription>.*?)
-    \s*?
-    $
-)?
-"""
+    if pagefields.has_key('default_description'):
+        match = EventPageParser.pattern_page_description.match(pagecontent, pagefields['default_description'])
 
-    pattern = re.compile(regex_page_description, re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE)
-    match = pattern.search(pagecontent)
-
-    if match:
         if match.group('pagedescription'):
             page_description = match.group('pagedescription')
         else:
             errormsg( geterrormsg('empty_default_description', referpage) )
 
     # fetch the label definition
-    regex_label_definition = r"""
-(?P<reqfield>^[ ]+label_def::[ ]+)
-(
-	(?P<name>[^,^:^\s]+?)
-	[,: ]+
-	(?P<bgcolor>\#[0-9a-fA-F]{6})
-	\s*?
-	$
-)?
-"""
-
-
-    pattern = re.compile(regex_label_definition, re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE)
-    match = pattern.findall(pagecontent)
-
-    if match:
+    if labeldefs:
 
-        for matchitem in match:
+        for labelpos in labeldefs:
 
             labelitem = {}
 
-            label_name = matchitem[2]
-            label_bgcolor = matchitem[3]
+            match = EventPageParser.pattern_label_definition.match(pagecontent, labelpos)
+
+            label_name = match.group('name')
+            label_bgcolor = match.group('bgcolor')
 
             if label_name and label_bgcolor:
                 labelitem['name'] = label_name
@@ -1763,40 +3025,19 @@ def getEventRecordFromPage(pagecontent, referpage):
 
 
     # fetch event item
-    regex_eventitem = r"""
-(?P<eventitem>
-	(?P<heading>^\s*(?P<hmarker>=+)\s(?P<eventtitle>.*?)\s(?P=hmarker) $)
-	(?P<eventdetail>
-		.*?
-		(?=
-			^\s*(?P<nexthmarker>=+)\s(?P<nexteventtitle>.*?)\s(?P=nexthmarker) $
-			| \Z
-        )
-	)
-)
-"""
-
-    pattern = re.compile(regex_eventitem, re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE)
-    match = pattern.findall(pagecontent)
-
-    if match:
-
-        for matchitem in match:
-
-            eventitem = {}
+    if eventitems:
 
-            eventtitle = matchitem[3]
-            eventdetail = matchitem[4]
+        for eventtitle, detailstart, detailend, fields in eventitems:
 
             e_headid = getheadingid(request, referpage, eventtitle)
 
-            if not eventdetail:
+            if detailstart == detailend:
                 continue
 
             #debug('Examininng "%s" event from %s ..' % (eventtitle, referpage))
 
             try:
-                e_start_date, e_start_time, e_end_date, e_end_time, e_bgcolor, e_label, e_description, e_recur_freq, e_recur_type, e_recur_until = geteventfield(eventdetail)
+                e_start_date, e_start_time, e_end_date, e_end_time, e_bgcolor, e_label, e_description, e_recur_freq, e_recur_type, e_recur_until = geteventfield(pagecontent, fields, detailend)
             except EventcalError, errmsgcode:
 
                 if not errmsgcode.value == 'pass':
@@ -1818,36 +3059,28 @@ def getEventRecordFromPage(pagecontent, referpage):
             e_num += 1
             e_id = 'e_%s_%d' % (referpage, e_num)
 
-            eventitem['id'] = e_id
-            eventitem['title'] = eventtitle
-            eventitem['startdate'] = e_start_date
-            eventitem['starttime'] = e_start_time
-            eventitem['enddate'] = e_end_date
-            eventitem['endtime'] = e_end_time
-            eventitem['title'] = eventtitle
-            eventitem['refer'] = referpage
-            eventitem['bgcolor'] = e_bgcolor
-            eventitem['label'] = e_label
-            eventitem['description'] = e_description
-            eventitem['recur_freq'] = e_recur_freq
-            eventitem['recur_type'] = e_recur_type
-            eventitem['recur_until'] = e_recur_until
-
             try:
-                eventitem['date_len'] = diffday(e_start_date, e_end_date) + 1
-                eventitem['clone'] = 0
-                eventitem['hid'] = e_headid
+                date_len = diffday(e_start_date, e_end_date) + 1
 
-                if eventitem['date_len'] == 1 and e_start_time and e_end_time:
-                    eventitem['time_len'] = difftime(e_start_time, e_end_time) + 1
+                if date_len == 1 and e_start_time and e_end_time:
+                    time_len = difftime(e_start_time, e_end_time) + 1
                 else:
-                    eventitem['time_len'] = 0
+                    time_len = 0
 
             except EventcalError, errmsgcode:
                 debug('Failed to add "%s" event from %s ..' % (eventtitle, referpage))
                 errormsg( geterrormsg(errmsgcode.value, referpage, eventtitle, e_headid) )
                 continue
 
+            if e_recur_until:
+                e_until_day = getdateordinal(e_recur_until)
+            else:
+                e_until_day = None
+
+            eventitem = EventRecord(e_id, eventtitle, referpage, e_headid, e_bgcolor, e_label, e_description,
+                                    getdateordinal(e_start_date), getminute(e_start_time), getdateordinal(e_end_date), getminute(e_end_time),
+                                    e_recur_freq, e_recur_type, e_until_day, date_len, time_len)
+
             eventrecords.append(eventitem)
 
             #debug('Added "%s" event from %s ..' % (eventtitle, referpage))
@@ -1855,235 +3088,23 @@ def getEventRecordFromPage(pagecontent, referpage):
     return eventrecords, labelrecords
 
 
-def geteventfield(detail):
-
-
-    # START DATE REGEX ----------------------------
-    regex_startdate = r"""
-(?P<reqfield>^[ ]+start::(?=[ ]+))
-(
-    (?P<startdate>
-        [ ]+
-        (
-            (?P<startdate1>
-            	(?P<startyear1>19\d{2} | 20\d{2} | \d{2} )
-            	[./-]
-            	(?P<startmonth1>1[012] | 0[1-9] | [1-9])
-            	[./-]
-            	(?P<startday1>3[01] | 0[1-9] | [12]\d | [1-9])
-            )
-            |
-            (?P<startdate2>
-            	(?P<startmonth2>january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug|september|sep|october|oct|november|nov|december|dec)
-            	[ ]+
-            	(?P<startday2>3[01] | 0[1-9] | [12]\d | [1-9])
-            	(?: st | nd | rd | th )?
-            	[ ,]+
-            	(?P<startyear2>19\d{2} | 20\d{2} | \d{2})
-            )
-            |
-            (?P<startdate3>
-            	(?P<startyear3>19\d{2} | 20\d{2} | \d{2} )
-            	(?P<startmonth3>1[012] | 0[1-9])
-            	(?P<startday3>3[01] | 0[1-9] | [12]\d)
-            )
-        )
-    )
-    (?P<starttime>
-        [ ,]+
-        (
-            (?P<starttime1>
-            	(?P<starthour1> 1[0-2] | [0]?[1-9] )
-            	(
-            		(?: [.:])
-            		(?P<startminute1>[0-5]\d{0,1} | [6-9])
-            	)?
-            	[ ]*
-            	(?P<am1> am | pm | p | a )
-            )
-            |
-            (?P<starttime2>
-            	(?P<starthour2> | [01]\d{0,1} | 2[0-3] | [1-9])
-            	(
-            		(?: [.:])
-            		(?P<startminute2>[0-5]\d{0,1} | [6-9])
-            	)?
-            )
-            |
-            (?P<starttime3>
-            	(?P<starthour3> [01]\d | 2[0-3])
-            	(?P<startminute3> [0-5]\d)?
-            )
-            |
-            (?P<starttime4>
-            	(?P<starthour4> 0[1-9] | 1[0-2])
-            	(?P<startminute4> [0-5]\d)?
-            	[ ]*
-            	(?P<am4> am | pm | p | a )
-            )
-        )
-    )?
-    \s*?
-    $
-)?
-"""
-
-
-
-    # END DATE REGEX ----------------------------
-    regex_enddate = r"""
-(?P<reqfield>^[ ]+end::(?=[ ]+))
-(
-    (?P<enddate>
-        [ ]+
-        (
-            (?P<enddate1>
-            	(?P<endyear1>19\d{2} | 20\d{2} | \d{2} )
-            	[./-]
-            	(?P<endmonth1>1[012] | 0[1-9] | [1-9])
-            	[./-]
-            	(?P<endday1>3[01] | 0[1-9] | [12]\d | [1-9])
-            )
-            |
-            (?P<enddate2>
-            	(?P<endmonth2>january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug|september|sep|october|oct|november|nov|december|dec)
-            	[ ]+
-            	(?P<endday2>3[01] | 0[1-9] | [12]\d | [1-9])
-            	(?: st | nd | rd | th )?
-            	[ ,]+
-            	(?P<endyear2>19\d{2} | 20\d{2} | \d{2})
-            )
-            |
-            (?P<enddate3>
-            	(?P<endyear3>19\d{2} | 20\d{2} | \d{2} )
-            	(?P<endmonth3>1[012] | 0[1-9])
-            	(?P<endday3>3[01] | 0[1-9] | [12]\d)
-            )
-        )
-    )?
-    (?P<endtime>
-        [ ,]+
-        (
-            (?P<endtime1>
-            	(?P<endhour1> 1[0-2] | [0]?[1-9] )
-            	(
-            		(?: [.:])
-            		(?P<endminute1>[0-5]\d{0,1} | [6-9])
-            	)?
-            	[ ]*
-            	(?P<am1> am | pm | p | a )
-            )
-            |
-            (?P<endtime2>
-            	(?P<endhour2> | [01]\d{0,1} | 2[0-3] | [1-9])
-            	(
-            		(?: [.:])
-            		(?P<endminute2>[0-5]\d{0,1} | [6-9])
-            	)?
-            )
-            |
-            (?P<endtime3>
-            	(?P<endhour3> [01]\d | 2[0-3])
-            	(?P<endminute3> [0-5]\d)?
-            )
-            |
-            (?P<endtime4>
-            	(?P<endhour4> 0[1-9] | 1[0-2])
-            	(?P<endminute4> [0-5]\d)?
-            	[ ]*
-            	(?P<am4> am | pm | p | a )
-            )
-        )
-    )?
-    \s*?
-    $
-)?
-"""
-
-    regex_bgcolor = r"""
-(?P<reqfield>^[ ]+bgcolor::[ ]+)
-(
-    (?P<bgcolor>\#[0-9a-fA-F]{6})?
-    \s*?
-    $
-)?
-"""
-
-    regex_description = r"""
-(?P<reqfield>^[ ]+description::[ ]+)
-(
-    (?P<description>.*?)
-    \s*?
-    $
-)?
-"""
-
-
-    regex_recur = r"""
-(?P<reqfield>^[ ]+recur::[ ]+)
-(
-    (?P<recur_freq>\d+|last)
-    \s+
-    (?P<recur_type>weekday|day|week|month|year)
-    (
-    	\s+
-    	(?P<recur_until_req>until)
-    	\s+
-    	(?P<recur_until>
-            (?P<enddate>
-                (?P<enddate1>
-                	(?P<endyear1>19\d{2} | 20\d{2} | \d{2} )
-                	[./-]
-                	(?P<endmonth1>1[012] | 0[1-9] | [1-9])
-                	[./-]
-                	(?P<endday1>3[01] | 0[1-9] | [12]\d | [1-9])
-                )
-                |
-                (?P<enddate2>
-                	(?P<endmonth2>january|jan|february|feb|march|mar|april|apr|may|june|jun|july|jul|august|aug|september|sep|october|oct|november|nov|december|dec)
-                	\s+
-                	(?P<endday2>3[01] | 0[1-9] | [12]\d | [1-9])
-                	(?: st | nd | rd | th )?
-                	[\s,]+
-                	(?P<endyear2>19\d{2} | 20\d{2} | \d{2})
-                )
-                |
-                (?P<enddate3>
-                	(?P<endyear3>19\d{2} | 20\d{2} | \d{2} )
-                	(?P<endmonth3>1[012] | 0[1-9])
-                	(?P<endday3>3[01] | 0[1-9] | [12]\d)
-                )
-            )?
-        )?
-    )?
-    \s*?
-    $
-)?
-"""
-
-    regex_label = r"""
-(?P<reqfield>^[ ]+label::[ ]+)
-(
-	(?P<name>[^,^:^\s]+?)
-	\s*?
-	$
-)?
-"""
-
-
-    # need help on regular expressions for more efficient/flexible form
+def geteventfield(pagecontent, fields, detailend):
+    """ fields maps each field name to the offset of its line in pagecontent (see tokenizeeventpage) """
 
-    # compile regular expression objects
+    def matchfield(pattern, field):
+        if fields.has_key(field):
+            return pattern.match(pagecontent, fields[field], detailend)
+        return None
 
-    pattern_startdate = re.compile(regex_startdate, re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE)
-    pattern_enddate = re.compile(regex_enddate, re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE)
-    pattern_bgcolor = re.compile(regex_bgcolor, re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE)
-    pattern_label = re.compile(regex_label, re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE)
-    pattern_description = re.compile(regex_description, re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE)
-    pattern_recur = re.compile(regex_recur, re.UNICODE + re.MULTILINE + re.IGNORECASE + re.DOTALL + re.VERBOSE)
+    pattern_startdate = EventPageParser.pattern_startdate
+    pattern_enddate = EventPageParser.pattern_enddate
+    pattern_bgcolor = EventPageParser.pattern_bgcolor
+    pattern_label = EventPageParser.pattern_label
+    pattern_description = EventPageParser.pattern_description
+    pattern_recur = EventPageParser.pattern_recur
 
     ##################### retrieve startdate
-    match = pattern_startdate.search(detail)
+    match = matchfield(pattern_startdate, 'start')
 
     if match:
 
@@ -2198,7 +3219,7 @@ def geteventfield(detail):
         raise EventcalError('pass')
 
     ##################### retrieve enddate
-    match = pattern_enddate.search(detail)
+    match = matchfield(pattern_enddate, 'end')
 
     if match:
 
@@ -2315,7 +3336,7 @@ def geteventfield(detail):
 
 
     ##################### retrieve bgcolor
-    match = pattern_bgcolor.search(detail)
+    match = matchfield(pattern_bgcolor, 'bgcolor')
 
     if match:
         if match.group('bgcolor'):
@@ -2328,7 +3349,7 @@ def geteventfield(detail):
         bgcolor = ''
 
     ##################### retrieve label
-    match = pattern_label.search(detail)
+    match = matchfield(pattern_label, 'label')
 
     if match:
         if match.group('name'):
@@ -2341,7 +3362,7 @@ def geteventfield(detail):
         label = ''
 
     ##################### retrieve description
-    match = pattern_description.search(detail)
+    match = matchfield(pattern_description, 'description')
 
     if match:
         if match.group('description'):
@@ -2353,7 +3374,7 @@ def geteventfield(detail):
         description = ''
 
     ##################### retrieve recurrence
-    match = pattern_recur.search(detail)
+    match = matchfield(pattern_recur, 'recur')
 
     if match:
 
@@ -2530,7 +3551,7 @@ def converttext(targettext):
 
 
 # monthly view
-def showeventcalendar(year, month):
+def showeventcalendar(year, month, monthsevents=None):
 
     debug('Show Calendar: Monthly View')
 
@@ -2580,8 +3601,15 @@ def showeventcalendar(year, month):
     datefrom = u'%04d%02d21' % (prev_month.year, prev_month.month)
     dateto = u'%04d%02d06' % (next_month.year, next_month.month)
 
-    # read all the events
-    events, cal_events, labels = loadEvents(datefrom, dateto)
+    # read all the events, unless they are read with the other months shown
+    if monthsevents:
+        events, eventindex, labels = monthsevents
+    else:
+        events, eventindex, labels = loadEvents(datefrom, dateto)
+
+    # event lists of the days shown
+    first_date_shown = cur_month - datetime.timedelta(days=monthcal[0].index(1))
+    cal_events = eventindex.daylists([formatdateobject(first_date_shown + datetime.timedelta(days=dayindex)) for dayindex in range(7 * len(monthcal))])
 
     #debug(u'  events: %s' % events)
     #debug(u'  cal_events: %s' % cal_events)
@@ -2612,155 +3640,58 @@ def showeventcalendar(year, month):
         # dummy rows
         html_headdummy_cols = []
 
-        for wkday in r7:
-            day = week[wkday]
-            if not day:
-                html_headdummy_cols.append( calshow_blankbox('head_dummy_nbmonth') )
-            else:
-                html_headdummy_cols.append( calshow_blankbox('head_dummy') )
-
-        html_headdummy_cols = u'\r\n'.join(html_headdummy_cols)
-        html_week_rows.append(' <tr>\r\n%s </tr>\r\n' % html_headdummy_cols)
-
-        # pending events for next row
-        pending = next_pending
-        next_pending = []
-
-        # show events
-        while 1:
-            event_left = 7
-            colspan = -1
-            html_events_cols = []
-
-            for wkday in r7:
-
-                day = week[wkday]
-
-                if not day:
-                    if week == monthcal[0]:
-                        cur_date = formatDate(prev_month.year, prev_month.month, prev_monthcal[-1][wkday])
-                    else:
-                        cur_date = formatDate(next_month.year, next_month.month, next_monthcal[0][wkday])
-                else:
-                    cur_date = formatDate(year, month, day)
-
-                # if an event is already displayed with colspan
-                if colspan > 0:
-                    colspan -= 1
-                    if cal_events.has_key(cur_date) and lastevent in cal_events[cur_date]:
-                        cal_events[cur_date].remove(lastevent)
-
-                    continue
-
-                # if there is any event for this date
-                if cal_events.has_key(cur_date):
-                    if len(cal_events[cur_date]) > 0:
-
-                        # if there is any pending event in the previous week
-                        if wkday == 0 and len(pending) > 0:
-                            todo_event_id = pending.pop(0)
-                            if todo_event_id in cal_events[cur_date]:
-                                cur_event = events[todo_event_id]
-                                temp_len = diffday(cur_date, cur_event['enddate']) + 1
-
-                                # calculate colspan value
-                                if (7-wkday) < temp_len:
-                                    colspan = 7 - wkday
-                                    next_pending.append(cur_event['id'])
-                                    html_events_cols.append( calshow_eventbox(cur_event, colspan, 'append_pending', cur_date) )
-
-                                else:
-                                    colspan = temp_len
-                                    html_events_cols.append( calshow_eventbox(cur_event, colspan, 'append', cur_date) )
-
-
-                                cal_events[cur_date].remove(todo_event_id)
-
-                                colspan -= 1
-                                lastevent = todo_event_id
-                            else:
-                                debug('Warning: no such event in cal_events')
+        for wkday in r7:
+            day = week[wkday]
+            if not day:
+                html_headdummy_cols.append( calshow_blankbox('head_dummy_nbmonth') )
+            else:
+                html_headdummy_cols.append( calshow_blankbox('head_dummy') )
 
-                            continue
+        html_headdummy_cols = u'\r\n'.join(html_headdummy_cols)
+        html_week_rows.append(' <tr>\r\n%s </tr>\r\n' % html_headdummy_cols)
 
-                        # if there is no pending event in the previous week, start a new event
-                        event_found = 0
-                        for e_id in cal_events[cur_date]:
+        # dates of the week
+        week_dates = []
 
-                            # if the start date of the event is current date
-                            if events[e_id]['startdate'] == cur_date:
+        for wkday in r7:
 
-                                cur_event = events[cal_events[cur_date].pop(cal_events[cur_date].index(e_id))]
+            day = week[wkday]
 
-                                # calculate colspan value
-                                if (7-wkday) < cur_event['date_len']:
-                                    colspan = 7 - wkday
-                                    next_pending.append(cur_event['id'])
-                                    html_events_cols.append( calshow_eventbox(cur_event, colspan, 'pending', cur_date) )
+            if not day:
+                if week == monthcal[0]:
+                    week_dates.append(formatDate(prev_month.year, prev_month.month, prev_monthcal[-1][wkday]))
+                else:
+                    week_dates.append(formatDate(next_month.year, next_month.month, next_monthcal[0][wkday]))
+            else:
+                week_dates.append(formatDate(year, month, day))
 
-                                else:
-                                    colspan = cur_event['date_len']
-                                    html_events_cols.append( calshow_eventbox(cur_event, colspan, '', cur_date) )
+        # pending events for next row
+        pending = next_pending
 
-                                colspan -= 1
-                                lastevent = cur_event['id']
-                                event_found = 1
-                                break
+        event_rows, next_pending = layoutweek(week_dates, cal_events, events, pending, week == monthcal[0])
 
-                            # if the start date of the event is NOT current date
-                            else:
+        # show events
+        for event_row in event_rows:
+            html_events_cols = []
 
-                                # pending event from previous month
-                                if wkday == 0 and week == monthcal[0]:
-
-                                    cur_event = events[cal_events[cur_date].pop(0)]
-                                    temp_len = diffday(cur_date, cur_event['enddate']) + 1
-
-                                    # calculate colspan value
-                                    if (7-wkday) < temp_len:
-                                        colspan = 7 - wkday
-                                        next_pending.append(cur_event['id'])
-                                        html_events_cols.append( calshow_eventbox(cur_event, colspan, 'append_pending', cur_date) )
-                                    else:
-                                        colspan = temp_len
-                                        html_events_cols.append( calshow_eventbox(cur_event, colspan, 'append', cur_date) )
-
-                                    colspan -= 1
-                                    lastevent = cur_event['id']
-                                    event_found = 1
-                                    break
-
-                        # if there is no event to start
-                        if not event_found:
-                            if not day:
-                                html_events_cols.append( calshow_blankbox('cal_nbmonth') )
-                            else:
-                                html_events_cols.append( calshow_blankbox('cal_noevent') )
-                            event_left -= 1
+            for wkday in r7:
 
-                    else:
-                        if not day:
-                            html_events_cols.append( calshow_blankbox('cal_nbmonth') )
-                        else:
-                            html_events_cols.append( calshow_blankbox('cal_noevent') )
+                day = week[wkday]
+                cell = event_row[wkday]
 
-                        event_left -= 1
+                # an event is already displayed with colspan
+                if cell == 0:
+                    continue
 
-                # if there is NO event for this date
+                if cell:
+                    cur_event, colspan, status = cell
+                    html_events_cols.append( calshow_eventbox(cur_event, colspan, status, week_dates[wkday]) )
+                elif not day:
+                    html_events_cols.append( calshow_blankbox('cal_nbmonth') )
                 else:
-                    if not day:
-                        html_events_cols.append( calshow_blankbox('cal_nbmonth') )
-                    else:
-                        html_events_cols.append( calshow_blankbox('cal_noevent') )
+                    html_events_cols.append( calshow_blankbox('cal_noevent') )
 
-                    event_left -= 1
-
-            # if no event for this entry
-            if not event_left:
-                # ignore the previous entry
-                break
-            else:
-                html_events_rows.append(' <tr>\r\n%s </tr>\r\n' % u'\r\n'.join(html_events_cols))
+            html_events_rows.append(' <tr>\r\n%s </tr>\r\n' % u'\r\n'.join(html_events_cols))
 
         # show dummy blank slots for week height
         left_blank_rows = 2 - len(html_events_rows)
@@ -2809,173 +3740,235 @@ def showeventcalendar(year, month):
     return html_cal_table
 
 
-def showdailyeventcalendar(year, month, day):
-    """ Daily view """
-
-    debug('Show Calendar: Daily View')
+def layoutweek(week_dates, cal_events, events, pending, firstweek):
+    """ lays the events of a week of the monthly view out in rows
 
-    request = Globs.request
-    formatter = Globs.formatter
-    _ = request.getText
+    Sweeping the days, each event goes to the lowest free row on its first day in
+    the week, in the order of the day list: the events pending from the previous
+    week come first, in the order of their rows, and on the first day of the first
+    week every event of the day goes, not only the ones starting on it.
 
-    wkend = Globs.wkend
-    months= Globs.months
-    wkdays = Globs.wkdays
+    Returns the rows, lists of 7 cells: None for a free day, (event, colspan, status)
+    where an event box starts and 0 where it spans; and the ids of the events
+    continuing into the next week, in the order of their rows.
+    """
 
-    cur_date = formatDate(year, month, day)
+    event_rows = []
+    free_rows = []   # heap of rows free on the current day
+    busy_rows = []   # heap of (last day, row) of the rows taken by an event
+    continued = []
 
-    # gets previous, next month
-    day_delta = datetime.timedelta(days=-1)
-    cur_month = datetime.date(year, month, 1)
-    prev_month = cur_month + day_delta
+    for wkday in range(7):
 
-    day_delta = datetime.timedelta(days=15)
-    cur_month_end = datetime.date(year, month, 25)
-    next_month = cur_month_end + day_delta
+        cur_date = week_dates[wkday]
+        cur_day = getdateordinal(cur_date)
+        day_events = cal_events.get(cur_date, [])
 
-    # set ranges of events
-    datefrom = u'%04d%02d21' % (prev_month.year, prev_month.month)
-    dateto = u'%04d%02d06' % (next_month.year, next_month.month)
+        while busy_rows and busy_rows[0][0] < wkday:
+            heapq.heappush(free_rows, heapq.heappop(busy_rows)[1])
 
-    # read all the events
-    events, cal_events, labels = loadEvents(datefrom, dateto)
+        if wkday == 0 and firstweek:
+            starting = day_events
+        else:
+            starting = [e_id for e_id in day_events if events[e_id].startday == cur_day]
 
-    #debug(u'  events: %s' % events)
-    #debug(u'  cal_events: %s' % cal_events)
+            if wkday == 0 and pending:
+                starting = [e_id for e_id in pending if e_id in day_events] + starting
 
-    # calculates hour_events
-    hour_events = {}
+        for e_id in starting:
 
-    if cal_events.has_key(cur_date):
-        for e_id in cal_events[cur_date]:
             cur_event = events[e_id]
+            temp_len = cur_event.endday - cur_day + 1
+
+            if free_rows:
+                row = heapq.heappop(free_rows)
+            else:
+                row = len(event_rows)
+                event_rows.append([None] * 7)
+
+            if cur_event.startday == cur_day:
+                status = ''
+            else:
+                status = 'append'
 
-            if cur_event['date_len'] == 1 and cur_event['time_len'] > 0:
-                start_hour, start_min = gettimefield(cur_event['starttime'])
+            # calculate colspan value
+            if (7-wkday) < temp_len:
+                colspan = 7 - wkday
+                continued.append((row, e_id))
 
-                if not hour_events.has_key(start_hour):
-                    hour_events[start_hour] = []
+                if status:
+                    status = 'append_pending'
+                else:
+                    status = 'pending'
+            else:
+                colspan = temp_len
 
-                hour_events[start_hour].append(e_id)
+            event_rows[row][wkday] = (cur_event, colspan, status)
 
-    #debug(u'hour_events: %s' % hour_events)
+            for spanday in range(wkday + 1, wkday + colspan):
+                event_rows[row][spanday] = 0
 
-    # in-day events
-    html_calendar_rows = []
-    html_hour_cols = {}
+            heapq.heappush(busy_rows, (wkday + colspan - 1, row))
+
+    continued.sort()
+
+    return event_rows, [e_id for row, e_id in continued]
+
+
+def layoutdayslots(events, day_events):
+    """ lays the timed events of a day out in the hour rows of the daily and weekly views
+
+    The columns are allocated by minute: sweeping the events by start minute, each
+    goes to the lowest column free since the end of its last event, so a block of
+    events overlapping in time gets as many columns as there are events at once,
+    and the events following each other share a column.
+
+    The hour rows are only for display: an event takes the time_len rows from its
+    start hour, and the events of a column whose rows meet are shown in one box,
+    one below the other. The rows where some box continues from the row above, and
+    the row it starts in, show the same columns, so the blocks sharing rows show the
+    columns of the wider one. The rows without events have a single column.
+
+    Returns the 24 rows, lists of cells: None for a free column, (row span, events)
+    where a box starts and 0 where it spans; and the number of columns of every block.
+    """
+
+    timed_events = [events[e_id] for e_id in day_events if events[e_id].date_len == 1 and events[e_id].time_len > 0]
+    timed_events.sort(key=lambda cur_event: cur_event.startminute)
+
+    slotted_events = []
+    num_slots = 0
+    free_slots = []   # heap of the free columns
+    busy_slots = []   # heap of (end minute, column) of the columns taken by an event
+
+    for cur_event in timed_events:
+
+        while busy_slots and busy_slots[0][0] <= cur_event.startminute:
+            heapq.heappush(free_slots, heapq.heappop(busy_slots)[1])
 
-    slot_pending = {}
-    max_num_slots = 0
-    hour_max_slots = {}
+        if free_slots:
+            slot_index = heapq.heappop(free_slots)
+        else:
+            slot_index = num_slots
+            num_slots += 1
+
+        # an event without duration still takes its start minute
+        heapq.heappush(busy_slots, (max(cur_event.endminute, cur_event.startminute + 1), slot_index))
+
+        slotted_events.append((cur_event, slot_index))
+
+    hour_rows = [[None] for hour_index in range(24)]
     block_slots = []
+    block_start = 0
+    block_end = -1
+    boxes = []
+    open_boxes = {}   # column: the last box of the column in the block
 
-    start_hour_index = 0
+    def addblock():
+        num_slots = max([box[3] for box in boxes]) + 1
 
-    r24 = range(24)
+        for hour_lines in range(block_start, block_end + 1):
+            hour_rows[hour_lines] = [None] * num_slots
 
-    for hour_index in r24:
+        for first_hour, last_hour, box_events, slot_index in boxes:
+            hour_rows[first_hour][slot_index] = (last_hour - first_hour + 1, box_events)
 
-        html_hour_cols[hour_index] = []
-        hour_max_slots[hour_index] = 1
-        html_hour_cols[hour_index].append ( calshow_daily_hourhead(hour_index) )
+            for hour_lines in range(first_hour + 1, last_hour + 1):
+                hour_rows[hour_lines][slot_index] = 0
 
-        if len(slot_pending) > 0 or hour_events.has_key(hour_index):
+        block_slots.append(num_slots)
 
-            #debug('start: hour_index = %d, slot_pending = %s' % (hour_index, slot_pending))
-            if len(slot_pending) == 0:
-                if max_num_slots < 1:
-                    max_num_slots = 1
+    for cur_event, slot_index in slotted_events:
 
-                for hour_lines in range(start_hour_index, hour_index):
-                    hour_max_slots[hour_lines] = max_num_slots
+        first_hour = cur_event.startminute / 60
+        last_hour = min(first_hour + cur_event.time_len, 24) - 1
 
-                #debug('block ended: %d ~ %d, max=%d' % (start_hour_index, hour_index-1, max_num_slots))
+        if first_hour > block_end:
+            if boxes:
+                addblock()
 
-                block_slots.append(max_num_slots)
+            # the rows between the blocks
+            block_slots.extend([1] * (first_hour - block_end - 1))
 
-                max_num_slots = 0
-                start_hour_index = hour_index
+            block_start = first_hour
+            boxes = []
+            open_boxes = {}
 
-            for slot_index in range(max_num_slots):
-                if slot_pending.has_key(slot_index) and slot_pending[slot_index] > 0:
-                    if slot_pending[slot_index] == 1:
-                        del slot_pending[slot_index]
-                    else:
-                        slot_pending[slot_index] -= 1
-                    html_hour_cols[hour_index].append ( '' )
+        block_end = max(block_end, last_hour)
 
-                else:
-                    if hour_events.has_key(hour_index) and len(hour_events[hour_index]) > 0:
-                        e_id = hour_events[hour_index][0]
-                        cur_event = events[hour_events[hour_index].pop(hour_events[hour_index].index(e_id))]
-                        html_hour_cols[hour_index].append ( calshow_daily_eventbox(cur_event) )
-                        slot_pending[slot_index] = cur_event['time_len'] - 1
-                    else:
-                        if not ((len(slot_pending) > 0 and slot_index > max(slot_pending.keys())) or len(slot_pending) == 0):
-                            html_hour_cols[hour_index].append ( calshow_blankeventbox() )
-
-            if hour_events.has_key(hour_index):
-                for tmp_cnt in range(len(hour_events[hour_index])):
-                    e_id = hour_events[hour_index][0]
-                    cur_event = events[hour_events[hour_index].pop(hour_events[hour_index].index(e_id))]
-                    html_hour_cols[hour_index].append ( calshow_daily_eventbox(cur_event) )
-                    slot_pending[max_num_slots] = cur_event['time_len'] - 1
-                    if slot_pending[max_num_slots] == 0:
-                        del slot_pending[max_num_slots]
-                    max_num_slots += 1
+        box = open_boxes.get(slot_index)
 
+        if box and first_hour <= box[1]:
+            box[1] = max(box[1], last_hour)
+            box[2].append(cur_event)
         else:
-            html_hour_cols[hour_index].append ( calshow_blankeventbox() )
-            #hour_max_slots[hour_index] = 1
+            box = [first_hour, last_hour, [cur_event], slot_index]
+            boxes.append(box)
+            open_boxes[slot_index] = box
+
+    if boxes:
+        addblock()
 
-            if max_num_slots < 1:
-                max_num_slots = 1
+    block_slots.extend([1] * (23 - block_end))
 
-            for hour_lines in range(start_hour_index, hour_index):
-                hour_max_slots[hour_lines] = max_num_slots
+    return hour_rows, block_slots
 
-            #debug('block ended: %d ~ %d, max=%d' % (start_hour_index, hour_index-1, max_num_slots))
 
-            block_slots.append(max_num_slots)
+def showdailyeventcalendar(year, month, day):
+    """ Daily view """
+
+    debug('Show Calendar: Daily View')
+
+    request = Globs.request
+    formatter = Globs.formatter
+    _ = request.getText
+
+    wkend = Globs.wkend
+    months= Globs.months
+    wkdays = Globs.wkdays
 
-            max_num_slots = 0
-            start_hour_index = hour_index
+    cur_date = formatDate(year, month, day)
+    cur_day = getdateordinal(cur_date)
 
+    # gets previous, next month
+    day_delta = datetime.timedelta(days=-1)
+    cur_month = datetime.date(year, month, 1)
+    prev_month = cur_month + day_delta
 
-        #debug('end: hour_index = %d, slot_pending = %s' % (hour_index, slot_pending))
+    day_delta = datetime.timedelta(days=15)
+    cur_month_end = datetime.date(year, month, 25)
+    next_month = cur_month_end + day_delta
 
-    if max_num_slots < 1:
-        max_num_slots = 1
+    # set ranges of events
+    datefrom = u'%04d%02d21' % (prev_month.year, prev_month.month)
+    dateto = u'%04d%02d06' % (next_month.year, next_month.month)
 
-    for hour_lines in range(start_hour_index, 24):
-        hour_max_slots[hour_lines] = max_num_slots
+    # read all the events
+    events, eventindex, labels = loadEvents(datefrom, dateto)
 
-    #debug('block ended: %d ~ %d, max=%d' % (start_hour_index, 23, max_num_slots))
+    day_events = eventindex.eventsofday(cur_date)
 
-    block_slots.append(max_num_slots)
+    #debug(u'  events: %s' % events)
+    #debug(u'  day_events: %s' % day_events)
 
-    #debug('hour_max_slots: %s' % hour_max_slots)
+    # in-day events
+    hour_rows, block_slots = layoutdayslots(events, day_events)
 
+    #debug(u'hour_rows: %s' % hour_rows)
 
     # calculates global colspan
-    if len(block_slots):
-        global_colspan = LCM(block_slots)
-    else:
-        global_colspan = 1
-
-    for hour_index in r24:
+    global_colspan = LCM(block_slots)
 
-        colspan = global_colspan / hour_max_slots[hour_index]
-        width = 96 / hour_max_slots[hour_index]
+    html_calendar_rows = []
 
-        left_slots = hour_max_slots[hour_index] - (len(html_hour_cols[hour_index]) - 1)
+    for hour_index in range(24):
 
-        if left_slots > 0:
-            #debug('appending left %d slots: %d' % (left_slots, hour_index))
-            html_hour_cols[hour_index].append ( calshow_blankeventbox2( left_slots * colspan, left_slots * width ) )
+        num_slots = len(hour_rows[hour_index])
+        colspan = global_colspan / num_slots
+        width = 96 / num_slots
 
-        html_cols = u'\r\n'.join(html_hour_cols[hour_index]) % {'colspan': colspan, 'width': u'%d%%' % width}
-        html_cols = u'<tr>%s</tr>\r\n' % html_cols
+        html_cols = calshow_hourslots(hour_rows[hour_index], calshow_daily_eventbox, colspan, width)
+        html_cols = u'<tr>%s\r\n%s</tr>\r\n' % (calshow_daily_hourhead(hour_index), html_cols)
 
         html_calendar_rows.append (html_cols)
 
@@ -2987,37 +3980,30 @@ def showdailyeventcalendar(year, month, day):
     # one-day long events
     html_oneday_rows = []
 
-    #debug('before cal_events[cur_date] = %s' % cal_events[cur_date])
+    if day_events:
+        for e_id in day_events:
+            #debug('test events[%s] = %s' % (e_id, events[e_id]))
+            if events[e_id].time_len <= 0 or events[e_id].date_len > 1:
+                cur_event = events[e_id]
 
-    if cal_events.has_key(cur_date):
-        if len(cal_events[cur_date]) > 0:
-            for e_id in cal_events[cur_date]:
-                #debug('before cal_events[cur_date] = %s' % cal_events[cur_date])
-                #debug('test events[%s] = %s' % (e_id, events[e_id]))
-                if events[e_id]['time_len'] <= 0 or events[e_id]['date_len'] > 1:
-                    #cur_event = events[cal_events[cur_date].pop(cal_events[cur_date].index(e_id))]
-                    cur_event = events[e_id]
-
-                    if cur_event['startdate'] == cur_date:
-                        if cur_event['enddate'] == cur_date:
-                            str_status = ''
-                        else:
-                            str_status = 'pending'
+                if cur_event.startday == cur_day:
+                    if cur_event.endday == cur_day:
+                        str_status = ''
                     else:
-                        if cur_event['enddate'] == cur_date:
-                            str_status = 'append'
-                        else:
-                            str_status = 'append_pending'
+                        str_status = 'pending'
+                else:
+                    if cur_event.endday == cur_day:
+                        str_status = 'append'
+                    else:
+                        str_status = 'append_pending'
 
-                    tmp_html = u'<tr><td width="4%%" style="border-width: 0px; ">&nbsp;</td>%s</tr>' % calshow_daily_eventbox2(cur_event, global_colspan, str_status, cur_date)
-                    html_oneday_rows.append( tmp_html )
+                tmp_html = u'<tr><td width="4%%" style="border-width: 0px; ">&nbsp;</td>%s</tr>' % calshow_daily_eventbox2(cur_event, global_colspan, str_status, cur_date)
+                html_oneday_rows.append( tmp_html )
 
-                #debug('after cal_events[cur_date] = %s' % cal_events[cur_date])
     else:
         tmp_html = u'<tr><td width="4%%" style="border-width: 0px; ">&nbsp;</td>%s</tr>' % calshow_blankbox2('cal_daily_noevent', global_colspan)
         html_oneday_rows.append( tmp_html )
 
-    #debug('after cal_events[cur_date] = %s' % cal_events[cur_date])
     #debug('html_oneday_rows = %s' % html_oneday_rows)
 
     html_oneday_rows = u'\r\n'.join(html_oneday_rows)
@@ -3069,174 +4055,47 @@ def showweeklyeventcalendar(year, month, day):
     dateto = u'%04d%02d06' % (next_month.year, next_month.month)
 
     # read all the events
-    events, cal_events, labels = loadEvents(datefrom, dateto)
-
-    #debug(u'  events: %s' % events)
-    #debug(u'  cal_events: %s' % cal_events)
-
-    # calculates hour_events
-    hour_events = {}
+    events, eventindex, labels = loadEvents(datefrom, dateto)
 
     first_date_week = getFirstDateOfWeek(year, month, day)
 
+    # working lists of the week, the one-day rows below consume them
+    cal_events = eventindex.daylists([formatdateobject(first_date_week + datetime.timedelta(dayindex)) for dayindex in range(7)])
 
-    for dayindex in range(7):
-        hour_events[dayindex] = {}
-
-        cur_date = first_date_week + datetime.timedelta(dayindex)
-        cur_date = formatDate(cur_date.year, cur_date.month, cur_date.day)
-
-        if cal_events.has_key(cur_date):
-            for e_id in cal_events[cur_date]:
-                cur_event = events[e_id]
-
-                if cur_event['date_len'] == 1 and cur_event['time_len'] > 0:
-                    start_hour, start_min = gettimefield(cur_event['starttime'])
-
-                    if not hour_events[dayindex].has_key(start_hour):
-                        hour_events[dayindex][start_hour] = []
-
-                    hour_events[dayindex][start_hour].append(e_id)
-
-    #debug(u'hour_events: %s' % hour_events)
+    #debug(u'  events: %s' % events)
+    #debug(u'  cal_events: %s' % cal_events)
 
     # in-day events
-    html_calendar_rows = []
-    html_hour_cols = {}
-
-    slot_pending = {}
-    max_num_slots = {}
-    hour_max_slots = {}
-    block_slots = {}
-
-    start_hour_index = {}
-
-    r24 = range(24)
-
-    for hour_index in r24:
-
-        html_hour_cols[hour_index] = {}
-        hour_max_slots[hour_index] = {}
-
-        #html_hour_cols[hour_index].append ( calshow_daily_hourhead(hour_index) )
-
-        for dayindex in range(7):
-
-            if not max_num_slots.has_key(dayindex):
-                max_num_slots[dayindex] = 0
-
-            if not slot_pending.has_key(dayindex):
-                slot_pending[dayindex] = {}
-
-            if not start_hour_index.has_key(dayindex):
-                start_hour_index[dayindex] = 0
-
-            if not block_slots.has_key(dayindex):
-                block_slots[dayindex] = []
-
-            html_hour_cols[hour_index][dayindex] = []
-            hour_max_slots[hour_index][dayindex] = 1
-
-            if len(slot_pending[dayindex]) > 0 or hour_events[dayindex].has_key(hour_index):
-
-                #debug('start: hour_index = %d, slot_pending = %s' % (hour_index, slot_pending[dayindex]))
-                if len(slot_pending[dayindex]) == 0:
-                    if max_num_slots[dayindex] < 1:
-                        max_num_slots[dayindex] = 1
-
-                    for hour_lines in range(start_hour_index[dayindex], hour_index):
-                        hour_max_slots[hour_lines][dayindex] = max_num_slots[dayindex]
-
-                    #debug('block ended: %d ~ %d, max=%d' % (start_hour_index[dayindex], hour_index-1, max_num_slots[dayindex]))
-
-                    block_slots[dayindex].append(max_num_slots[dayindex])
-
-                    max_num_slots[dayindex] = 0
-                    start_hour_index[dayindex] = hour_index
-
-                for slot_index in range(max_num_slots[dayindex]):
-                    if slot_pending[dayindex].has_key(slot_index) and slot_pending[dayindex][slot_index] > 0:
-                        if slot_pending[dayindex][slot_index] == 1:
-                            del slot_pending[dayindex][slot_index]
-                        else:
-                            slot_pending[dayindex][slot_index] -= 1
-                        html_hour_cols[hour_index][dayindex].append ( '' )
-
-                    else:
-                        if hour_events[dayindex].has_key(hour_index) and len(hour_events[dayindex][hour_index]) > 0:
-                            e_id = hour_events[dayindex][hour_index][0]
-                            cur_event = events[hour_events[dayindex][hour_index].pop(hour_events[dayindex][hour_index].index(e_id))]
-                            html_hour_cols[hour_index][dayindex].append ( calshow_weekly_eventbox(cur_event) )
-                            slot_pending[dayindex][slot_index] = cur_event['time_len'] - 1
-                        else:
-                            if not ((len(slot_pending[dayindex]) > 0 and slot_index > max(slot_pending[dayindex].keys())) or len(slot_pending[dayindex]) == 0):
-                                html_hour_cols[hour_index][dayindex].append ( calshow_blankeventbox() )
-
-                if hour_events[dayindex].has_key(hour_index):
-                    for tmp_cnt in range(len(hour_events[dayindex][hour_index])):
-                        e_id = hour_events[dayindex][hour_index][0]
-                        cur_event = events[hour_events[dayindex][hour_index].pop(hour_events[dayindex][hour_index].index(e_id))]
-                        html_hour_cols[hour_index][dayindex].append ( calshow_weekly_eventbox(cur_event) )
-                        slot_pending[dayindex][max_num_slots[dayindex]] = cur_event['time_len'] - 1
-                        if slot_pending[dayindex][max_num_slots[dayindex]] == 0:
-                            del slot_pending[dayindex][max_num_slots[dayindex]]
-                        max_num_slots[dayindex] += 1
-
-            else:
-                html_hour_cols[hour_index][dayindex].append ( calshow_blankeventbox() )
-                #hour_max_slots[hour_index][dayindex] = 1
-
-                if max_num_slots[dayindex] < 1:
-                    max_num_slots[dayindex] = 1
-
-                for hour_lines in range(start_hour_index[dayindex], hour_index):
-                    hour_max_slots[hour_lines][dayindex] = max_num_slots[dayindex]
-
-                #debug('block ended: %d ~ %d, max=%d' % (start_hour_index[dayindex], hour_index-1, max_num_slots[dayindex]))
-
-                block_slots[dayindex].append(max_num_slots[dayindex])
-
-                max_num_slots[dayindex] = 0
-                start_hour_index[dayindex] = hour_index
-
+    hour_rows = {}
     global_colspan = {}
     header_colspan = 0
 
     for dayindex in range(7):
-        if max_num_slots[dayindex] < 1:
-            max_num_slots[dayindex] = 1
 
-        for hour_lines in range(start_hour_index[dayindex], 24):
-            hour_max_slots[hour_lines][dayindex] = max_num_slots[dayindex]
+        cur_date = first_date_week + datetime.timedelta(dayindex)
+        cur_date = formatDate(cur_date.year, cur_date.month, cur_date.day)
 
-        block_slots[dayindex].append(max_num_slots[dayindex])
+        hour_rows[dayindex], block_slots = layoutdayslots(events, cal_events.get(cur_date, []))
 
         # calculates global colspan
-        if len(block_slots[dayindex]):
-            global_colspan[dayindex] = LCM(block_slots[dayindex])
-        else:
-            global_colspan[dayindex] = 1
-
+        global_colspan[dayindex] = LCM(block_slots)
         header_colspan += global_colspan[dayindex]
 
+    #debug(u'hour_rows: %s' % hour_rows)
+
+    html_calendar_rows = []
 
-    for hour_index in r24:
+    for hour_index in range(24):
 
         html_cols_days = []
 
         for dayindex in range(7):
 
-            colspan = global_colspan[dayindex] / hour_max_slots[hour_index][dayindex]
-            width = (100 - 2) / 7 / hour_max_slots[hour_index][dayindex]
-
-            left_slots = hour_max_slots[hour_index][dayindex] - len(html_hour_cols[hour_index][dayindex])
+            num_slots = len(hour_rows[dayindex][hour_index])
+            colspan = global_colspan[dayindex] / num_slots
+            width = (100 - 2) / 7 / num_slots
 
-            if left_slots > 0:
-                #debug('appending left %d slots: %d' % (left_slots, hour_index))
-                html_hour_cols[hour_index][dayindex].append ( calshow_blankeventbox2( left_slots * colspan, left_slots * width ) )
-
-            html_cols = u'\r\n'.join(html_hour_cols[hour_index][dayindex]) % {'colspan': colspan, 'width': u'%d%%' % width}
-            html_cols_days.append(html_cols)
+            html_cols_days.append( calshow_hourslots(hour_rows[dayindex][hour_index], calshow_weekly_eventbox, colspan, width) )
 
         html_cols_collected = u'\r\n'.join(html_cols_days)
         html_cols = u'<tr>%s\r\n%s</tr>\r\n' % (calshow_weekly_hourhead(hour_index), html_cols_collected)
@@ -3272,6 +4131,7 @@ def showweeklyeventcalendar(year, month, day):
                 pending = -1
 
             cur_date = first_date_week + datetime.timedelta(dayindex)
+            cur_day = cur_date.toordinal()
             cur_date = formatDate(cur_date.year, cur_date.month, cur_date.day)
 
             if cal_events.has_key(cur_date) and len(cal_events[cur_date]) > 0:
@@ -3282,12 +4142,12 @@ def showweeklyeventcalendar(year, month, day):
 
                     #debug('event poped out at %s: %s' % (cur_date, cur_event))
 
-                    if (cur_event['startdate'] <= cur_date and dayindex == 0) or cur_event['startdate'] == cur_date:
-                        if cur_event['time_len'] <= 0 or cur_event['date_len'] > 1:
+                    if (cur_event.startday <= cur_day and dayindex == 0) or cur_event.startday == cur_day:
+                        if cur_event.time_len <= 0 or cur_event.date_len > 1:
 
-                            temp_len = diffday(cur_date, cur_event['enddate']) + 1
+                            temp_len = cur_event.endday - cur_day + 1
 
-                            if cur_event['startdate'] == cur_date:
+                            if cur_event.startday == cur_day:
                                 if temp_len <= 7 - dayindex:
                                     str_status = ''
                                 else:
@@ -3356,7 +4216,7 @@ def showweeklyeventcalendar(year, month, day):
     return html_cal_table
 
 
-def showsimpleeventcalendar(year, month):
+def showsimpleeventcalendar(year, month, monthsevents=None):
 
     """ Simple view """
 
@@ -3406,8 +4266,11 @@ def showsimpleeventcalendar(year, month):
     datefrom = u'%04d%02d21' % (prev_month.year, prev_month.month)
     dateto = u'%04d%02d06' % (next_month.year, next_month.month)
 
-    # read all the events
-    events, cal_events, labels = loadEvents(datefrom, dateto)
+    # read all the events, unless they are read with the other months shown
+    if monthsevents:
+        events, eventindex, labels = monthsevents
+    else:
+        events, eventindex, labels = loadEvents(datefrom, dateto)
 
     maketip_js = []
 
@@ -3430,8 +4293,9 @@ def showsimpleeventcalendar(year, month):
                 html_headday_cols.append( simple_eventbox(year, month, day, nb_day, 'simple_nb') )
             else:
                 cur_date = formatDate(year, month, day)
+                day_events = eventindex.eventsofday(cur_date)
 
-                if cal_events.has_key(cur_date):
+                if day_events:
                     html_headday_cols.append( simple_eventbox(year, month, day, wkday, 'simple_event') )
 
                     if monthstyle_us:
@@ -3444,7 +4308,7 @@ def showsimpleeventcalendar(year, month):
 
                     tiptext = []
 
-                    for e_id in cal_events[cur_date]:
+                    for e_id in day_events:
                         cur_event = events[e_id]
                         if cur_event['starttime']:
                             time_string = u'(%s:%s)' % (cur_event['starttime'][:2], cur_event['starttime'][2:])
@@ -3881,7 +4745,7 @@ def calshow_daily_eventbox2(event, colspan, status, cur_date):
     return u'\r\n'.join(html)
 
 
-def calshow_daily_eventbox(event):
+def calshow_daily_eventbox(event, rowspan):
     """ Show daily eventbox """
 
     title = event['title']
@@ -3892,7 +4756,6 @@ def calshow_daily_eventbox(event):
     endtime = event['endtime']
     description = event['description']
     bgcolor = event['bgcolor']
-    time_len = event['time_len']
 
     if not bgcolor:
         labels = Globs.labels
@@ -3913,7 +4776,7 @@ def calshow_daily_eventbox(event):
         u'  <td colspan="%(colspan)d"',
         u'      style="%s border-width: 2px; border-color: #000000; vertical-align: top; font-size: 9pt; ' % bgcolor,
         u'      width: %(width)s;" ',
-        u'      rowspan="%(rowspan)d">' % { 'rowspan': time_len },
+        u'      rowspan="%(rowspan)d">' % { 'rowspan': rowspan },
         u'      %02d:%02d ~ %02d:%02d<br>%s' % (shour, smin, ehour, emin, showReferPageParsed(event, 'title', 1)),
         u'  </td>',
         ]
@@ -3921,7 +4784,7 @@ def calshow_daily_eventbox(event):
     return u'\r\n'.join(html)
 
 
-def calshow_weekly_eventbox(event):
+def calshow_weekly_eventbox(event, rowspan):
     """ Show weekly eventbox """
 
     title = event['title']
@@ -3932,7 +4795,6 @@ def calshow_weekly_eventbox(event):
     endtime = event['endtime']
     description = event['description']
     bgcolor = event['bgcolor']
-    time_len = event['time_len']
 
     if not bgcolor:
         labels = Globs.labels
@@ -3953,7 +4815,7 @@ def calshow_weekly_eventbox(event):
         u'  <td colspan="%(colspan)d"',
         u'      style="%s;' % bgcolor,
         u'      width: %(width)s;" ',
-        u'      rowspan="%(rowspan)d"' % { 'rowspan': time_len },
+        u'      rowspan="%(rowspan)d"' % { 'rowspan': rowspan },
         u'      class="cal_weekly_eventbox">',
         u'      %s' % showReferPageParsed(event, 'title', 1),
         u'  </td>',
@@ -4023,6 +4885,58 @@ def calshow_blankeventbox2(colspan, width):
 
 
 
+def calshow_eventstack(box_events, eventbox, rowspan):
+    """ Show the events sharing a column of the hour rows, one below the other """
+
+    html = [
+        u'  <td colspan="%%(colspan)d" rowspan="%d"' % rowspan,
+        u'      style="width: %(width)s; padding: 0px; vertical-align: top;" class="cal_eventstack">',
+        u'      <table class="cal_event" style="width: 100%%;">',
+        ]
+
+    for event in box_events:
+        # the placeholders of the stack are filled by calshow_hourslots()
+        box = eventbox(event, 1) % {'colspan': 1, 'width': u'100%'}
+        html.append(u'      <tr>%s</tr>' % box.replace(u'%', u'%%'))
+
+    html.append(u'      </table></td>')
+
+    return u'\r\n'.join(html)
+
+
+def calshow_hourslots(cells, eventbox, colspan, width):
+    """ Show the columns of an hour row of the daily or weekly view (see layoutdayslots) """
+
+    html = []
+
+    # free columns after the last event are merged into one box
+    used_slots = len(cells)
+    while used_slots and cells[used_slots - 1] is None:
+        used_slots -= 1
+
+    if not used_slots:
+        html.append( calshow_blankeventbox() )
+
+    else:
+        for cell in cells[:used_slots]:
+            if cell is None:
+                html.append( calshow_blankeventbox() )
+            elif cell:
+                rowspan, box_events = cell
+
+                if len(box_events) == 1:
+                    html.append( eventbox(box_events[0], rowspan) )
+                else:
+                    html.append( calshow_eventstack(box_events, eventbox, rowspan) )
+
+        left_slots = len(cells) - used_slots
+
+        if left_slots > 0:
+            html.append( calshow_blankeventbox2( left_slots * colspan, left_slots * width ) )
+
+    return u'\r\n'.join(html) % {'colspan': colspan, 'width': u'%d%%' % width}
+
+
 def calshow_daily_hourhead(hour):
 
     if hour >= Globs.dailystart and hour <= Globs.dailyend:
@@ -4031,7 +4945,7 @@ def calshow_daily_hourhead(hour):
         bgcolor = "#ffeeee"
 
     html = [
-        u'  <td class="cal_hourhead" style="background-color: %s; width: 4%%%%;">%02d</td>' % (bgcolor, hour),
+        u'  <td class="cal_hourhead" style="background-color: %s; width: 4%%;">%02d</td>' % (bgcolor, hour),
         ]
 
     return u'\r\n'.join(html)
@@ -4051,28 +4965,10 @@ def calshow_weekly_hourhead(hour):
 
 
 
-def insertcalevents(cal_events, datefrom, dateto, e_id, e_start_date, e_end_date):
-
-    if not (int(e_start_date) > dateto or int(e_end_date) < datefrom):
-
-        e_start_date = str(max(int(e_start_date), datefrom))
-        e_end_date = str(min(int(e_end_date), dateto))
-
-        day_delta = datetime.timedelta(days=1)
-        e_start_year, e_start_month, e_start_day = getdatefield(e_start_date)
-        cur_datetime = datetime.date(e_start_year, e_start_month, e_start_day)
+def insertcalevents(eventindex, dayfrom, dayto, e_id, e_start_day, e_end_day):
 
-        while 1:
-            tmp_record_date = formatdateobject(cur_datetime)
-
-            if not cal_events.has_key(tmp_record_date):
-                cal_events[tmp_record_date] = []
-            cal_events[tmp_record_date].append(e_id)
-
-            if tmp_record_date == e_end_date:
-                break
-
-            cur_datetime = cur_datetime + day_delta
+    if not (e_start_day > dayto or e_end_day < dayfrom):
+        eventindex.add(e_id, max(e_start_day, dayfrom), min(e_end_day, dayto))
 
 # date format should be like '20051004' for 2005, Oct., 04
 def diffday(date1, date2):
@@ -4119,6 +5015,30 @@ def formatdateobject(obj_date):
 
     return formatDate(obj_date.year, obj_date.month, obj_date.day)
 
+def getdateordinal(str_date):
+
+    year, month, day = getdatefield(str_date)
+    return datetime.date(year, month, day).toordinal()
+
+def formatdateordinal(ordinal):
+
+    return formatdateobject(datetime.date.fromordinal(ordinal))
+
+def getminute(str_time):
+    # minute of the day, None for no time
+    if not str_time:
+        return None
+
+    hour, min = gettimefield(str_time)
+    return hour * 60 + min
+
+def formatminute(minute):
+    # returns like: '1700', '' for no time
+    if minute is None:
+        return u''
+
+    return u'%02d%02d' % divmod(minute, 60)
+
 def formattimeobject(obj_time):
 
     return formatTime(obj_time.hour, obj_time.minute)
@@ -4224,15 +5144,9 @@ def errormsg(astring):
 
 
 def yearmonthplusoffset(year, month, offset):
-    month = month+offset
-    # handle offset and under/overflows - quick and dirty, yes!
-    while month < 1:
-        month = month + 12
-        year = year - 1
-    while month > 12:
-        month = month - 12
-        year = year + 1
-    return year, month
+    # handle offset and under/overflows in one step, whatever the offset is
+    year, month = divmod(year * 12 + month - 1 + offset, 12)
+    return year, month + 1
 
 
 def formatcfgdatetime(strdate, strtime=''):
@@ -4273,20 +5187,101 @@ def getdatetimefromstring(strdate):
     return datetime.date( year, month, day )
 
 
+def getchangegeneration(request):
+    """ returns a stamp of the global edit-log, '' if there is none
+
+    MoinMoin appends to the edit-log on every page save, rename, revert, delete
+    and attachment change, so its size and mtime change with every change in
+    the wiki: one stat tells whether anything changed since the stamp was taken.
+    """
+
+    try:
+        stat = os.stat(request.rootpage.getPagePath('edit-log', isfile=1))
+    except os.error:
+        return ''
+
+    return '%d-%d' % (stat.st_size, int(stat.st_mtime * 1000))
+
+
+def getpagechanges(log, position):
+    """ returns the position of the end of the edit-log and the pages changed after position
+
+    Like EditLog.news(), but the attachment changes are left out: they don't
+    change the events, and the calendar pages make them when exporting events.ics.
+    """
+
+    changedpages = []
+
+    if position != log.size():
+        log.seek(position)
+
+        for line in log:
+            if line.action.startswith('ATT'):
+                continue
+
+            changedpages.append(line.pagename)
+
+            if line.action == 'SAVE/RENAME':
+                # the old page name
+                changedpages.append(line.extra)
+
+        position = log.position()
+
+    return position, changedpages
+
+
+def onlyattachmentchanges(request, generation):
+    """ tells whether the edit-log got only attachment changes since the generation was taken """
+
+    try:
+        position = int(generation.split('-')[0])
+    except ValueError:
+        return 0
+
+    log = editlog.EditLog(request)
+
+    if position > log.size():
+        return 0
+
+    position, changedpages = getpagechanges(log, position)
+
+    return not changedpages
+
+
 def searchPages(request, needle):
-    """ Search the pages and return the results """
+    """ Search the pages and return the results
+
+    The page list and the events of the category are shared by all the users,
+    so the pages are searched whoever may read them, unlike search.searchPages().
+    """
     query = search.QueryParser().parse_query(needle)
-    results = search.searchPages(request, query)
-    #results.sortByPagename()
 
-    return results.hits
+    return [page for page in request.rootpage.getPageList(user='', return_objects=True) if query.search(page)]
 
-    html = []
-    for page in results.hits:
-        html.append(page.page_name)
 
-    html = u',<br>'.join(html)
-    return u'%s<p>%s' % (Params.category, html)
+def updatePageList(request, needle, pagenames, changedpages):
+    """ Returns the list of pages found by the search, updated with the changed pages
+
+    The changed pages are searched one by one, as searchPages() would do:
+    whoever may read them.
+    """
+
+    query = search.QueryParser().parse_query(needle)
+
+    changed = {}
+    for pagename in changedpages:
+        changed[pagename] = 1
+
+    # the order of the other pages is kept
+    newpagenames = [pagename for pagename in pagenames if not changed.has_key(pagename)]
+
+    for pagename in changed.keys():
+        page = Page(request, pagename)
+
+        if page.exists() and query.search(page):
+            newpagenames.append(pagename)
+
+    return newpagenames
 
 
 def getFirstDateOfWeek(year, month, day):
@@ -0,0 +1,137 @@
+"""
+    Tests of the event cache of the EventCalendar macro.
+
+    The tests run against a wiki instance made in a temporary directory from
+    the data directory shipped with MoinMoin; each test starts without caches.
+
+    Usage: python test_eventcache.py
+
+    The macro imports MoinMoin, so run it with MoinMoin (and its dependencies)
+    on the python path.
+"""
+import imp, os, shutil, sys, tempfile, unittest
+
+MACRO_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'macro', 'EventCalendar-099b.py')
+
+WIKICONFIG = '''
+import os
+from MoinMoin.config import multiconfig
+
+class Config(multiconfig.DefaultConfig):
+    instance_dir = os.path.dirname(os.path.abspath(__file__))
+    data_dir = os.path.join(instance_dir, 'data', '')
+    data_underlay_dir = os.path.join(instance_dir, 'underlay', '')
+    sitename = u'EventCalendar test'
+    acl_rights_default = u'All:read,write,delete,revert,admin'
+    surge_action_limits = None
+'''
+
+EVENT_PAGE = u'''=== %s ===
+ start:: 2018-02-14 10:00
+ end:: 2018-02-14 11:00
+
+----
+CategoryEventCalendar
+'''
+
+
+class EventCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.instancedir = tempfile.mkdtemp()
+
+        shutil.copytree(os.path.join(sys.prefix, 'share', 'moin', 'data'), os.path.join(cls.instancedir, 'data'))
+        os.makedirs(os.path.join(cls.instancedir, 'underlay', 'pages'))
+        open(os.path.join(cls.instancedir, 'wikiconfig.py'), 'w').write(WIKICONFIG)
+
+        sys.path.insert(0, cls.instancedir)
+
+        cls.macro = imp.load_source('EventCalendar', MACRO_FILE)
+
+        cls.savepage(u'MeetingOne', EVENT_PAGE % u'Meeting one')
+        cls.savepage(u'MeetingTwo', EVENT_PAGE % u'Meeting two')
+        cls.savepage(u'CalendarPage', u'<<EventCalendar>>')
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.path.remove(cls.instancedir)
+        shutil.rmtree(cls.instancedir)
+
+    @classmethod
+    def request(cls):
+        from MoinMoin.web.contexts import ScriptContext
+
+        return ScriptContext('http://localhost/')
+
+    @classmethod
+    def savepage(cls, pagename, text):
+        from MoinMoin.PageEditor import PageEditor
+
+        PageEditor(cls.request(), pagename).saveText(text, 0)
+
+    def setUp(self):
+        from MoinMoin import caching
+
+        request = self.request()
+
+        self.macro.getparams(u'')
+        arena = self.macro.geteventstore()
+
+        for key in caching.get_cache_list(request, arena, 'wiki'):
+            caching.CacheEntry(request, arena, key, scope='wiki').remove()
+
+        self.macro.MemCache.entries.clear()
+
+    def loadevents(self):
+        from MoinMoin.Page import Page
+
+        macro = self.macro
+        request = self.request()
+
+        macro.setrequestvalues(request, Page(request, u'CalendarPage'))
+        macro.getparams(u'')
+        macro.Globs.page_action = 'show'
+        macro.Globs.form_vals = {}
+
+        events, labels = macro.loadEventsFromWikiPages()
+
+        return sorted([event['title'] for event in events.values()])
+
+    def corruptevents(self):
+        """ keeps the valid header of the events cache, but not its payload """
+
+        from MoinMoin import caching
+
+        cache_events = caching.CacheEntry(self.request(), self.macro.geteventstore(), 'events', scope='wiki')
+
+        header = open(cache_events._filename(), 'rb').readline()
+        cache_events.update(header + 'not a pickle\x00\x01')
+
+        self.macro.MemCache.entries.clear()
+
+        self.assertTrue(self.macro.iscompatibleheader(self.macro.parsecacheheader(header)))
+
+    def test_events(self):
+        self.assertEqual(self.loadevents(), [u'Meeting one', u'Meeting two'])
+
+    def test_unreadable_events_are_rebuilt(self):
+        self.loadevents()
+        self.corruptevents()
+
+        # no change in the wiki since the events were validated
+        self.assertEqual(self.loadevents(), [u'Meeting one', u'Meeting two'])
+        self.assertEqual(self.loadevents(), [u'Meeting one', u'Meeting two'])
+
+    def test_unreadable_events_are_rebuilt_after_changes(self):
+        self.loadevents()
+        self.corruptevents()
+
+        self.savepage(u'OtherPage', u'no events here')
+
+        self.assertEqual(self.loadevents(), [u'Meeting one', u'Meeting two'])
+        self.assertEqual(self.loadevents(), [u'Meeting one', u'Meeting two'])
+
+
+if __name__ == '__main__':
+    unittest.main()